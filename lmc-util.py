@@ -1,24 +1,1342 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+import time
+startup_times = {'script_start': time.perf_counter()}
 import argparse
+import base64
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import hmac
+import json
 import logging
 import os
-import socket
-import subprocess
-import time
-from random import randint
-import tempfile
+import queue
+import re
+import urllib.parse
+import uuid
+from random import randint, uniform
 from time import sleep
-import logicmonitor_sdk
-from logicmonitor_sdk.rest import ApiException
+
+class LMApiError(Exception):
+    """Raised by the raw HTTP backend when the LogicMonitor API returns a non-2xx response."""
+    def __init__(self, status: int = 0, reason: str = '', body: str = ''):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        super().__init__(f'({status}) Reason: {reason} Body: {body}')
+
+# The LogicMonitor SDK imports every generated model class when it loads, which costs far more
+# than the rest of the script combined.  It is only imported by load_sdk(), after the command line
+# has been parsed and validated, so --help and argument errors never pay for it.  With the raw
+# backend it is never imported at all.
+logicmonitor_sdk = None
+ApiException = (LMApiError,)   # load_sdk() adds the SDK's own ApiException
+asyncio = None                 # Only imported by main() for --engine async, it is slow to import too
 
 logger = logging.getLogger(__name__)
 
-def get_dflt_ipaddr(test_addr: str = '8.8.8.8', test_port: int = 80) -> str:
-    """Return the IP address of the NIC used for default route traffic """
-    my_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    my_sock.connect((test_addr, test_port)) # connect() wants a pair
+def load_sdk() -> None:
+    """Import the LogicMonitor SDK on first use and record how long the import took."""
+    global logicmonitor_sdk, ApiException
+    if logicmonitor_sdk is not None:
+        return
+
+    import_start = time.perf_counter()
+    import logicmonitor_sdk as sdk
+    from logicmonitor_sdk.rest import ApiException as sdk_api_exception
+    logicmonitor_sdk = sdk
+    ApiException = (sdk_api_exception, LMApiError)
+    startup_times['sdk_import'] = time.perf_counter() - import_start
+
+def get_process_age() -> float:
+    """
+    Return the number of seconds since this process was started by the kernel, or None if that
+    can't be determined.  Used to account for interpreter startup that happens before any of our
+    code runs.  Linux only.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces, so split after the closing paren
+            stat_fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        start_ticks = int(stat_fields[19])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+def report_startup_times(to_stderr: bool = False) -> None:
+    """
+    Log a breakdown of where startup time went, in milliseconds.  With to_stderr the same line is
+    also printed to stderr so it can be collected from cloud-init output.
+    """
+    now = time.perf_counter()
+    phases = []
+    if startup_times.get('interpreter') is not None:
+        phases.append(('interpreter', startup_times['interpreter']))
+    phases.append(('imports', startup_times['imports_done'] - startup_times['script_start']))
+    for phase in ('argparse', 'sdk_import', 'client_setup', 'action'):
+        if phase in startup_times:
+            phases.append((phase, startup_times[phase]))
+    phases.append(('total', now - startup_times['script_start'] + (startup_times.get('interpreter') or 0)))
+
+    breakdown = ' '.join('%s=%.1fms' % (name, secs * 1000) for name, secs in phases)
+    logger.info('Timing: %s', breakdown)
+    if to_stderr:
+        import sys
+        print(f'Timing: {breakdown}', file=sys.stderr)
+
+# Correlation fields added to every log record: run_id identifies one run of the script or one
+# daemon request, step the bootstrap step and portal the portal the record was logged for.  Being a
+# ContextVar, concurrent asyncio tasks each see their own values.
+log_context = contextvars.ContextVar('log_context', default={})
+log_listener = None
+dump_limit = 512
+profile_file = ''
+
+def set_log_context(**fields) -> None:
+    """Add or replace correlation fields for log records from the current thread or task."""
+    log_context.set({**log_context.get(), **fields})
+
+class LogContextFilter(logging.Filter):
+    """Copy the current log_context onto each record as it is logged."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get()
+        record.run_id = context.get('run_id', '-')
+        record.step = context.get('step', '-')
+        record.portal = context.get('portal', '-')
+        return True
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including the log_context correlation fields."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'func': record.funcName,
+            'line': record.lineno,
+            'run_id': getattr(record, 'run_id', '-'),
+            'step': getattr(record, 'step', '-'),
+            'portal': getattr(record, 'portal', '-'),
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+class Dump:
+    """
+    Log argument wrapper for dumping API objects.  Nothing is formatted unless the record is
+    actually emitted, and then only the selected fields, at most dump_limit characters of them.
+    Works with SDK models, LMRecords, dicts and anything else with a str().
+
+        obj    : Object to dump.
+        fields : Attribute/key names to include, all of them if not given.
+    """
+    __slots__ = ('obj', 'fields')
+
+    def __init__(self, obj, fields: tuple = ()):
+        self.obj = obj
+        self.fields = fields
+
+    def _items(self):
+        obj = self.obj
+        if isinstance(obj, LMRecord):
+            obj = obj.to_dict()
+        if isinstance(obj, dict):
+            return ((k, obj[k]) for k in (self.fields or obj) if k in obj)
+        if hasattr(obj, 'swagger_types'):
+            # SDK model: read attributes one at a time rather than to_dict()ing the whole tree
+            return ((k, getattr(obj, k, None)) for k in (self.fields or obj.swagger_types))
+        return None
+
+    def __str__(self) -> str:
+        items = self._items()
+        if items is None:
+            text = str(self.obj)
+            return text if len(text) <= dump_limit else text[:dump_limit] + '...'
+
+        parts = []
+        length = 0
+        for key, value in items:
+            if value is None:
+                continue
+            part = f'{key}={value!r}'[:dump_limit]
+            parts.append(part)
+            length += len(part) + 2
+            if length > dump_limit:
+                return ('{' + ', '.join(parts))[:dump_limit] + '...}'
+
+        return '{' + ', '.join(parts) + '}'
+
+def setup_logging(log_file: str, log_level: str, log_format: str = 'text') -> None:
+    """
+    Send log records through a queue to a background thread that writes them to log_file, so
+    logging never blocks on file I/O.  log_format is text for the usual format, or json for one
+    JSON object per line.  Call shutdown_logging() before exiting to flush the queue.
+    """
+    global log_listener
+    import logging.handlers
+
+    numeric_loglevel = getattr(logging, log_level.upper(), None)
+    if not isinstance(numeric_loglevel, int):
+        raise ValueError('Invalid log level: %s' % log_level)
+
+    file_handler = logging.FileHandler(log_file, mode='a')
+    if log_format == 'json':
+        file_handler.setFormatter(JsonLinesFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            "[%(asctime)s %(filename)s:%(lineno)s - %(levelname)s - %(funcName)20s()] %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(numeric_loglevel)
+
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    log_listener.start()
+
+def shutdown_logging() -> None:
+    """Write out any queued log records and stop the logging thread."""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+def exit_script(code: int) -> None:
+    """Write out any trace or profile, flush the log and exit immediately with the given status."""
+    write_diagnostics()
+    shutdown_logging()
+    os._exit(code)
+
+# Span tracing, see --trace-file.  tracer stays None unless tracing was asked for, in which case
+# the traced helpers and trace_span() cost one global lookup.  current_span is the innermost
+# open span of the running thread or asyncio task, the parent of any span opened under it.
+tracer = None
+profiler = None
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Tracer:
+    """
+    Collects finished spans and writes them out at exit, either as a Chrome trace that opens in
+    Perfetto or chrome://tracing, or as OTLP JSON that can be shipped to a collector later.
+
+        trace_file   : File to write.
+        trace_format : chrome or otlp.
+        max_spans    : Spans kept, later ones are counted but dropped so a long running daemon
+                       can't grow without bound.
+    """
+    def __init__(self, trace_file: str, trace_format: str = 'chrome', max_spans: int = 100000):
+        self.trace_file = trace_file
+        self.trace_format = trace_format
+        self.max_spans = max_spans
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self.dropped = 0
+        self._tracks = {}
+        # Spans are timed with perf_counter, this turns those times into epoch nanoseconds
+        self._epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    def track(self) -> int:
+        """
+        Small number identifying the running asyncio task, or thread outside of asyncio.  Spans
+        on one Chrome track have to nest, and concurrent tasks' spans don't.
+        """
+        import threading
+        key = threading.get_ident()
+        if asyncio is not None:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                task = None
+            if task is not None:
+                key = id(task)
+        return self._tracks.setdefault(key, len(self._tracks) + 1)
+
+    def record(self, name: str, cat: str, start: float, end: float, parent_id: str = '',
+               attrs: dict = None, error: str = '', span_id: str = '', track: int = 0) -> None:
+        """Add a finished span, start and end being time.perf_counter() values."""
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return
+        self.spans.append((name, cat, start, end, span_id or os.urandom(8).hex(), parent_id,
+                           track or self.track(), attrs or {}, error))
+
+    def write(self) -> None:
+        """Write the collected spans to trace_file, replacing it."""
+        if self.trace_format == 'otlp':
+            document = self._otlp()
+        else:
+            document = self._chrome()
+
+        tmp_file = f'{self.trace_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(document, f)
+        os.replace(tmp_file, self.trace_file)
+        logger.info('Wrote %s spans to %s (%s dropped)', len(self.spans), self.trace_file, self.dropped)
+
+    def _chrome(self) -> dict:
+        pid = os.getpid()
+        events = []
+        for name, cat, start, end, span_id, parent_id, track, attrs, error in self.spans:
+            args = dict(attrs)
+            if error:
+                args['error'] = error
+            events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': track,
+                           'ts': (start * 1e9 + self._epoch_offset_ns) / 1000,
+                           'dur': (end - start) * 1e6, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'trace_id': self.trace_id, 'dropped_spans': self.dropped}}
+
+    def _otlp(self) -> dict:
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {'key': key, 'value': {'boolValue': value}}
+            if isinstance(value, int):
+                return {'key': key, 'value': {'intValue': str(value)}}
+            if isinstance(value, float):
+                return {'key': key, 'value': {'doubleValue': value}}
+            return {'key': key, 'value': {'stringValue': str(value)}}
+
+        spans = []
+        for name, cat, start, end, span_id, parent_id, track, attrs, error in self.spans:
+            span = {
+                'traceId': self.trace_id,
+                'spanId': span_id,
+                'name': name,
+                # SPAN_KIND_CLIENT for API calls, SPAN_KIND_INTERNAL for everything else
+                'kind': 3 if cat == 'http' else 1,
+                'startTimeUnixNano': str(int(start * 1e9) + self._epoch_offset_ns),
+                'endTimeUnixNano': str(int(end * 1e9) + self._epoch_offset_ns),
+                'attributes': [attribute('category', cat)] + [attribute(k, v) for k, v in attrs.items()],
+            }
+            if parent_id:
+                span['parentSpanId'] = parent_id
+            if error:
+                span['status'] = {'code': 2, 'message': error}
+            spans.append(span)
+
+        return {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name', 'lmc-util'),
+                                        attribute('process.pid', os.getpid())]},
+            'scopeSpans': [{'scope': {'name': 'lmc-util'}, 'spans': spans}],
+        }]}
+
+class Span:
+    """
+    Context manager that records one span with the global tracer, nested under the current span.
+    Use trace_span() rather than creating these directly.
+    """
+    __slots__ = ('name', 'cat', 'attrs', 'span_id', 'parent', 'parent_id', 'start', '_token')
+
+    def __init__(self, name: str, cat: str, attrs: dict):
+        self.name = name
+        self.cat = cat
+        self.attrs = attrs
+
+    def set(self, key: str, value) -> None:
+        """Add an attribute to the span, eg: the HTTP status once it's known."""
+        self.attrs[key] = value
+
+    def __enter__(self):
+        self.parent = current_span.get()
+        self.parent_id = self.parent.span_id if self.parent else ''
+        self.span_id = os.urandom(8).hex()
+        self._token = current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        current_span.reset(self._token)
+        if tracer is not None:
+            error = f'{exc_type.__name__}: {exc}' if exc_type else ''
+            tracer.record(self.name, self.cat, self.start, end, self.parent_id, self.attrs, error,
+                          self.span_id)
+        return False
+
+class NullSpan:
+    """Stand-in for Span when tracing is off."""
+    __slots__ = ()
+
+    def set(self, key: str, value) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+null_span = NullSpan()
+
+def trace_span(name: str, cat: str = 'function', **attrs):
+    """Return a context manager recording a span named name, or doing nothing if tracing is off."""
+    if tracer is None:
+        return null_span
+    return Span(name, cat, attrs)
+
+def span_args(args: tuple) -> dict:
+    """Span attributes for a helper's positional arguments, kept short."""
+    return {f'arg{i}': v if isinstance(v, (int, float, bool)) else str(v)[:64]
+            for i, v in enumerate(args) if v is not None}
+
+def traced(func):
+    """Decorator recording a span around each call of a helper when tracing is on."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if tracer is None:
+            return func(*args, **kwargs)
+        with Span(func.__name__, 'helper', span_args(args)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def traced_async(func):
+    """Same as traced, for the async helpers."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if tracer is None:
+            return await func(*args, **kwargs)
+        with Span(func.__name__, 'helper', span_args(args)):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+def start_profiler(path: str) -> None:
+    """Start a cProfile capture of the action, written to path by exit_script()."""
+    global profiler, profile_file
+    import cProfile
+    profile_file = path
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+def write_diagnostics() -> None:
+    """Write out the trace and profile if they were asked for.  Failures here only get logged."""
+    global tracer, profiler
+    if profiler is not None:
+        profiler.disable()
+        try:
+            profiler.dump_stats(profile_file)
+            logger.info('Wrote cProfile stats to %s', profile_file)
+        except OSError as e:
+            logger.error('  FAILURE: Could not write cProfile stats to %s: %s', profile_file, e)
+        profiler = None
+    if tracer is not None:
+        # Spans still open when exit_script() is called from inside an action
+        span = current_span.get()
+        while span is not None:
+            tracer.record(span.name, span.cat, span.start, time.perf_counter(), span.parent_id,
+                          span.attrs, 'exited before the span ended', span.span_id)
+            span = span.parent
+        try:
+            tracer.write()
+        except OSError as e:
+            logger.error('  FAILURE: Could not write trace to %s: %s', tracer.trace_file, e)
+        tracer = None
+
+@functools.lru_cache(maxsize=None)
+def snake_to_camel(name: str) -> str:
+    """Convert an SDK attribute name such as collector_device_id to its API key, collectorDeviceId."""
+    first, *rest = name.split('_')
+    return first + ''.join(word.title() for word in rest)
+
+def lmv1_auth(access_id: str, access_key: str, verb: str, resource_path: str, body: bytes = b'') -> str:
+    """
+    Return an LMv1 Authorization header value for a request.
+
+        resource_path : API path without the /santaba/rest prefix or query string, eg: /device/devices/1
+        body          : Exact request body bytes that will be sent, if any.
+    """
+    epoch = str(int(time.time() * 1000))
+    message = verb.encode() + epoch.encode() + body + resource_path.encode()
+    digest = hmac.new(access_key.encode(), message, hashlib.sha256).hexdigest()
+    signature = base64.b64encode(digest.encode()).decode()
+
+    return f'LMv1 {access_id}:{signature}:{epoch}'
+
+def wrap_api_value(value):
+    """Wrap JSON objects (and lists of them) returned by the API in LMRecord, pass anything else through."""
+    if isinstance(value, dict):
+        return LMRecord(value)
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        return [LMRecord(v) for v in value]
+    return value
+
+class LMRecord:
+    """
+    Lightweight stand-in for the SDK's generated model classes.  It keeps the decoded JSON as-is
+    and maps snake_case attribute access (response.collector_device_id) onto the camelCase keys the
+    API uses, so the helpers work unchanged with either backend.  Attributes the API didn't return
+    read as None, the same as an unset SDK model attribute.
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data: dict = None):
+        object.__setattr__(self, '_data', {} if data is None else data)
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return wrap_api_value(self._data.get(snake_to_camel(name)))
+
+    def __setattr__(self, name: str, value) -> None:
+        self._data[snake_to_camel(name)] = value
+
+    def __repr__(self) -> str:
+        return f'LMRecord({self._data!r})'
+
+    def to_dict(self) -> dict:
+        return self._data
+
+class LMRawResponse:
+    """Undecoded API response, only used for the collector installer download."""
+    __slots__ = ('status', 'data')
+
+    def __init__(self, status: int, data: bytes):
+        self.status = status
+        self.data = data
+
+def encode_api_body(body) -> bytes:
+    """Serialize a dict or LMRecord (or a list of them) into a compact JSON request body."""
+    def record_data(o):
+        if isinstance(o, LMRecord):
+            return o._data
+        raise TypeError(f'Cannot serialize {type(o).__name__} for the LogicMonitor API')
+
+    return json.dumps(body, default=record_data, separators=(',', ':')).encode()
+
+class LMRawApi:
+    """
+    Minimal LogicMonitor REST client that signs LMv1 requests itself and skips the SDK's model
+    deserialization.  It implements the subset of logicmonitor_sdk.LMApi methods this script uses,
+    with the same names and keyword arguments, and returns LMRecord objects instead of models.
+    Connections are kept alive and reused from a small pool.
+
+        company    : LogicMonitor portal name, the "foo" in foo.logicmonitor.com.
+        access_id  : LMv1 API token ID.
+        access_key : LMv1 API token key.
+        base_url   : Override the API base URL, mostly for testing against a mock portal.
+        pool_size  : Maximum number of idle connections to keep open.
+        timeout    : Socket timeout in seconds for each request.
+    """
+    def __init__(self, company: str, access_id: str, access_key: str, base_url: str = '',
+                 pool_size: int = 4, timeout: int = 30):
+        self.access_id = access_id
+        self.access_key = access_key
+        self.base_url = base_url or f'https://{company}.logicmonitor.com/santaba/rest'
+        url = urllib.parse.urlsplit(self.base_url)
+        self._scheme = url.scheme
+        self._host = url.hostname
+        self._port = url.port
+        self._base_path = url.path.rstrip('/')
+        self._timeout = timeout
+        self._pool_size = pool_size
+        self._pool = queue.LifoQueue()
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            import http.client
+            if self._scheme == 'https':
+                import ssl
+                return http.client.HTTPSConnection(self._host, self._port, timeout=self._timeout,
+                    context=ssl.create_default_context()), False
+            return http.client.HTTPConnection(self._host, self._port, timeout=self._timeout), False
+
+    def _put_connection(self, conn) -> None:
+        if self._pool.qsize() < self._pool_size:
+            self._pool.put(conn)
+        else:
+            conn.close()
+
+    def request(self, verb: str, path: str, query: dict = None, body=None, raw: bool = False):
+        """
+        Send one signed request and return the decoded response.
+
+            verb  : HTTP method.
+            path  : API path without the /santaba/rest prefix, eg: /device/devices/1
+            query : Query parameters, empty values are dropped.
+            body  : dict or LMRecord to send as JSON.
+            raw   : Return an LMRawResponse with the undecoded body instead of an LMRecord.
+        """
+        import http.client
+        payload = encode_api_body(body) if body is not None else b''
+        url = self._base_path + path
+        if query:
+            query = {k: v for k, v in query.items() if v not in (None, '')}
+            if query:
+                url += '?' + urllib.parse.urlencode(query, quote_via=urllib.parse.quote)
+        headers = {
+            'Authorization': lmv1_auth(self.access_id, self.access_key, verb, path, payload),
+            'Content-Type': 'application/json',
+            'Accept': 'application/json' if not raw else '*/*',
+            'X-Version': '3',
+        }
+
+        # A pooled keep-alive connection may have been closed by the server while idle, in which
+        # case retry once on a fresh one.
+        with trace_span(f'{verb} {path}', 'http') as span:
+            for attempt in (1, 2):
+                conn, reused = self._get_connection()
+                try:
+                    conn.request(verb, url, body=payload or None, headers=headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    conn.close()
+                    if not reused or attempt == 2:
+                        raise
+            span.set('status', response.status)
+            span.set('bytes', len(data))
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_connection(conn)
+
+        if response.status >= 400:
+            raise LMApiError(response.status, response.reason, data.decode(errors='replace'))
+        if raw:
+            return LMRawResponse(response.status, data)
+        return LMRecord(json.loads(data)) if data else LMRecord()
+
+    def get_collector_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return self.request('GET', f'/setting/collector/collectors/{id}', {'fields': fields})
+
+    def get_collector_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return self.request('GET', '/setting/collector/collectors', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    def get_collector_group_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return self.request('GET', f'/setting/collector/groups/{id}', {'fields': fields})
+
+    def get_collector_group_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return self.request('GET', '/setting/collector/groups', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    def get_device_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return self.request('GET', f'/device/devices/{id}', {'fields': fields})
+
+    def get_device_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return self.request('GET', '/device/devices', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    def get_device_group_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return self.request('GET', f'/device/groups/{id}', {'fields': fields})
+
+    def get_device_group_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return self.request('GET', '/device/groups', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    def patch_device_group_by_id(self, id: int, body, op_type: str = 'refresh') -> LMRecord:
+        return self.request('PATCH', f'/device/groups/{id}', {'opType': op_type}, body)
+
+    def get_escalation_chain_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return self.request('GET', f'/setting/alert/chains/{id}', {'fields': fields})
+
+    def get_escalation_chain_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return self.request('GET', '/setting/alert/chains', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    def get_immediate_device_list_by_device_group_id(self, id: int, fields: str = '', filter: str = '',
+                                                     size: int = None, offset: int = 0) -> LMRecord:
+        return self.request('GET', f'/device/groups/{id}/devices', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    def patch_device(self, id: int, body, op_type: str = 'refresh') -> LMRecord:
+        return self.request('PATCH', f'/device/devices/{id}', {'opType': op_type}, body)
+
+    def patch_collector_by_id(self, id: int, body) -> LMRecord:
+        return self.request('PATCH', f'/setting/collector/collectors/{id}', body=body)
+
+    def patch_collector_group_by_id(self, id: int, body) -> LMRecord:
+        return self.request('PATCH', f'/setting/collector/groups/{id}', body=body)
+
+    def schedule_auto_discovery_by_device_id(self, id: int) -> LMRecord:
+        return self.request('POST', f'/device/devices/{id}/scheduleAutoDiscovery')
 
-    return my_sock.getsockname()[0]
+    def get_collector_installer(self, collector_id: int, os_and_arch: str, collector_size: str = '',
+                                use_ea: bool = False) -> LMRawResponse:
+        return self.request('GET', f'/setting/collector/collectors/{collector_id}/installers/{os_and_arch}',
+            {'collectorSize': collector_size, 'useEA': str(use_ea).lower()}, raw=True)
+
+class AsyncRateLimiter:
+    """
+    Token bucket shared by every request made through one LMAsyncApi.
+
+        rate  : Requests per second to allow on average, 0 disables the limit.
+        burst : Number of requests that may be sent back to back after a quiet period.
+    """
+    def __init__(self, rate: float, burst: int = 0):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Hold every request back for the given time, used when the portal answers 429."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if not self.rate:
+                return
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class LMAsyncApi:
+    """
+    asyncio counterpart of LMRawApi.  Requests are sent over a small HTTP/1.1 client built on
+    asyncio streams, signed the same way, and return LMRecord objects.  Up to max_connections
+    requests are in flight at once over keep-alive connections; anything beyond that waits its
+    turn without blocking the event loop.  All requests draw from one AsyncRateLimiter, and when
+    the portal answers 429 every request is held back for the X-Rate-Limit-Window it advertises
+    before the throttled one is retried.
+
+        company         : LogicMonitor portal name, the "foo" in foo.logicmonitor.com.
+        access_id       : LMv1 API token ID.
+        access_key      : LMv1 API token key.
+        base_url        : Override the API base URL, mostly for testing against a mock portal.
+        max_connections : Maximum number of requests in flight at the same time.
+        timeout         : Seconds to wait for each request/response exchange.
+        max_retries     : Number of times to retry a request that was rate limited.
+        rate_limit      : Requests per second to stay under, 0 to only react to 429s.
+    """
+    def __init__(self, company: str, access_id: str, access_key: str, base_url: str = '',
+                 max_connections: int = 8, timeout: int = 30, max_retries: int = 5,
+                 rate_limit: float = 0):
+        self.access_id = access_id
+        self.access_key = access_key
+        self.base_url = base_url or f'https://{company}.logicmonitor.com/santaba/rest'
+        url = urllib.parse.urlsplit(self.base_url)
+        self._scheme = url.scheme
+        self._host = url.hostname
+        self._port = url.port or (443 if url.scheme == 'https' else 80)
+        self._base_path = url.path.rstrip('/')
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._max_connections = max_connections
+        self._slots = None   # Created on first use so it binds to the running event loop
+        self._idle = []
+        self.rate_limiter = AsyncRateLimiter(rate_limit)
+        self.stats = {'requests': 0, 'throttled': 0}
+
+    async def _open_connection(self):
+        ssl_ctx = None
+        if self._scheme == 'https':
+            import ssl
+            ssl_ctx = ssl.create_default_context()
+        return await asyncio.open_connection(self._host, self._port, ssl=ssl_ctx)
+
+    async def _exchange(self, reader, writer, request: bytes, sink=None):
+        """Send one request on an open connection and read the response.  Returns a tuple of
+        (status, reason, headers, body, keep_alive), body is empty when written to sink."""
+        writer.write(request)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed before response')
+        _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        chunks = []
+        def consume(chunk):
+            if sink is not None and int(status) < 400:
+                sink.write(chunk)
+            else:
+                chunks.append(chunk)
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                consume(await reader.readexactly(size))
+                await reader.readexactly(2)
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining:
+                chunk = await reader.read(min(remaining, 1 << 20))
+                if not chunk:
+                    raise ConnectionResetError('Connection closed mid-response')
+                remaining -= len(chunk)
+                consume(chunk)
+        else:
+            keep_alive = False
+            while True:
+                chunk = await reader.read(1 << 20)
+                if not chunk:
+                    break
+                consume(chunk)
+
+        return int(status), reason, headers, b''.join(chunks), keep_alive
+
+    async def _send(self, verb: str, url: str, headers: dict, payload: bytes, sink=None):
+        host = self._host if self._port in (80, 443) else f'{self._host}:{self._port}'
+        lines = [f'{verb} {url} HTTP/1.1', f'Host: {host}', f'Content-Length: {len(payload)}']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_connections)
+        async with self._slots:
+            # As with LMRawApi, an idle keep-alive connection may have been dropped by the server,
+            # so retry once on a fresh connection.
+            for attempt in (1, 2):
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._open_connection()
+                try:
+                    status, reason, resp_headers, data, keep_alive = await asyncio.wait_for(
+                        self._exchange(reader, writer, request, sink), self._timeout)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if not reused or attempt == 2:
+                        raise
+                except BaseException:
+                    writer.close()
+                    raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+
+        return status, reason, resp_headers, data
+
+    async def request(self, verb: str, path: str, query: dict = None, body=None, raw: bool = False,
+                      sink=None):
+        """
+        Send one signed request and return the decoded response.  Arguments are the same as
+        LMRawApi.request(), plus:
+
+            sink : File object to stream a successful response body into instead of keeping it
+                   in memory, used for the installer download.
+        """
+        payload = encode_api_body(body) if body is not None else b''
+        url = self._base_path + path
+        if query:
+            query = {k: v for k, v in query.items() if v not in (None, '')}
+            if query:
+                url += '?' + urllib.parse.urlencode(query, quote_via=urllib.parse.quote)
+
+        with trace_span(f'{verb} {path}', 'http') as span:
+            for attempt in range(self._max_retries + 1):
+                headers = {
+                    'Authorization': lmv1_auth(self.access_id, self.access_key, verb, path, payload),
+                    'Content-Type': 'application/json',
+                    'Accept': 'application/json' if not raw else '*/*',
+                    'X-Version': '3',
+                }
+                await self.rate_limiter.acquire()
+                self.stats['requests'] += 1
+                status, reason, resp_headers, data = await self._send(verb, url, headers, payload, sink)
+                if status != 429 or attempt == self._max_retries:
+                    break
+                self.stats['throttled'] += 1
+                window = float(resp_headers.get('x-rate-limit-window') or 2 ** attempt)
+                logger.warning('  Rate limited on %s %s, retrying in %.1f s', verb, path, window)
+                self.rate_limiter.pause(window + randint(0, 1000) / 1000)
+            span.set('status', status)
+            span.set('attempts', attempt + 1)
+
+        if status >= 400:
+            raise LMApiError(status, reason, data.decode(errors='replace'))
+        if raw:
+            return LMRawResponse(status, data)
+        return LMRecord(json.loads(data)) if data else LMRecord()
+
+    async def close(self) -> None:
+        """Close all idle connections."""
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    async def get_collector_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return await self.request('GET', f'/setting/collector/collectors/{id}', {'fields': fields})
+
+    async def get_collector_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return await self.request('GET', '/setting/collector/collectors', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    async def get_collector_group_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return await self.request('GET', f'/setting/collector/groups/{id}', {'fields': fields})
+
+    async def get_collector_group_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return await self.request('GET', '/setting/collector/groups', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    async def get_device_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return await self.request('GET', f'/device/devices/{id}', {'fields': fields})
+
+    async def get_device_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return await self.request('GET', '/device/devices', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    async def get_device_group_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return await self.request('GET', f'/device/groups/{id}', {'fields': fields})
+
+    async def get_device_group_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return await self.request('GET', '/device/groups', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    async def patch_device_group_by_id(self, id: int, body, op_type: str = 'refresh') -> LMRecord:
+        return await self.request('PATCH', f'/device/groups/{id}', {'opType': op_type}, body)
+
+    async def get_escalation_chain_by_id(self, id: int, fields: str = '') -> LMRecord:
+        return await self.request('GET', f'/setting/alert/chains/{id}', {'fields': fields})
+
+    async def get_escalation_chain_list(self, fields: str = '', filter: str = '', size: int = None, offset: int = 0) -> LMRecord:
+        return await self.request('GET', '/setting/alert/chains', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    async def get_immediate_device_list_by_device_group_id(self, id: int, fields: str = '', filter: str = '',
+                                                           size: int = None, offset: int = 0) -> LMRecord:
+        return await self.request('GET', f'/device/groups/{id}/devices', {'fields': fields, 'filter': filter, 'size': size, 'offset': offset})
+
+    async def patch_device(self, id: int, body, op_type: str = 'refresh') -> LMRecord:
+        return await self.request('PATCH', f'/device/devices/{id}', {'opType': op_type}, body)
+
+    async def patch_collector_by_id(self, id: int, body) -> LMRecord:
+        return await self.request('PATCH', f'/setting/collector/collectors/{id}', body=body)
+
+    async def patch_collector_group_by_id(self, id: int, body) -> LMRecord:
+        return await self.request('PATCH', f'/setting/collector/groups/{id}', body=body)
+
+    async def schedule_auto_discovery_by_device_id(self, id: int) -> LMRecord:
+        return await self.request('POST', f'/device/devices/{id}/scheduleAutoDiscovery')
+
+    async def get_collector_installer(self, collector_id: int, os_and_arch: str, collector_size: str = '',
+                                      use_ea: bool = False, sink=None) -> LMRawResponse:
+        return await self.request('GET', f'/setting/collector/collectors/{collector_id}/installers/{os_and_arch}',
+            {'collectorSize': collector_size, 'useEA': str(use_ea).lower()}, raw=True, sink=sink)
+
+def build_lm_api(backend: str, portal: str, access_id: str, access_key: str):
+    """
+    Return an API client for the requested backend.  'sdk' is the LogicMonitor SDK, 'raw' is
+    LMRawApi, which doesn't need the SDK to be installed.
+    """
+    if backend == 'raw':
+        return LMRawApi(portal, access_id, access_key)
+
+    load_sdk()
+    lmsdk_cfg = logicmonitor_sdk.Configuration()
+    lmsdk_cfg.company = portal
+    lmsdk_cfg.access_id  = access_id
+    lmsdk_cfg.access_key = access_key
+
+    return logicmonitor_sdk.LMApi(logicmonitor_sdk.ApiClient(lmsdk_cfg))
+
+class Portal:
+    """
+    One LogicMonitor portal and everything that belongs to it: credentials, API clients with
+    their own connection pools and rate limiter, and the name lookup cache.  Helpers work on the
+    portal of the thread or asyncio task they run in, see use_portal(), so one process can work
+    on several portals at once.
+
+        name            : Label for logs, the credentials file section or the portal name.
+        company         : LogicMonitor portal name, the "foo" in foo.logicmonitor.com.
+        access_id       : LMv1 API token ID.
+        access_key      : LMv1 API token key.
+        rate_limit      : Requests per second for the async client, 0 to only back off on 429s.
+        max_connections : Maximum concurrent requests of the async client.
+    """
+    __slots__ = ('name', 'company', 'access_id', 'access_key', 'rate_limit', 'max_connections',
+                 'api', 'async_api', 'name_cache')
+
+    def __init__(self, name: str, company: str, access_id: str, access_key: str, rate_limit: float = 0,
+                 max_connections: int = 8):
+        self.name = name
+        self.company = company
+        self.access_id = access_id
+        self.access_key = access_key
+        self.rate_limit = rate_limit
+        self.max_connections = max_connections
+        self.api = None
+        self.async_api = None
+        self.name_cache = {}
+
+    def connect(self, backend: str) -> None:
+        """Create the client the sync helpers use."""
+        self.api = build_lm_api(backend, self.company, self.access_id, self.access_key)
+
+    def connect_async(self) -> None:
+        """Create the client the async helpers use."""
+        self.async_api = LMAsyncApi(self.company, self.access_id, self.access_key,
+            max_connections=self.max_connections, rate_limit=self.rate_limit)
+
+current_portal = contextvars.ContextVar('current_portal')
+
+def portal() -> Portal:
+    """Return the portal the running thread or asyncio task works on."""
+    return current_portal.get()
+
+def use_portal(lm_portal: Portal) -> None:
+    """
+    Make the helpers in the running thread or asyncio task, and tasks it starts later, work on
+    lm_portal.
+    """
+    current_portal.set(lm_portal)
+    set_log_context(portal=lm_portal.name)
+
+def load_portals(args: argparse.Namespace) -> list:
+    """
+    Return the Portals to run against: those named by --portals from --credentials-file, or every
+    section of it, or else the one given by --portal/--access-id/--access-key.  The file is INI
+    style, one section per portal:
+
+        [prod]
+        portal = foo
+        access_id = ...
+        access_key = ...
+        rate_limit = 5
+        concurrency = 8
+
+    portal defaults to the section name, rate_limit and concurrency to the command line values.
+    Raises OSError, KeyError or ValueError if a portal can't be loaded.
+    """
+    if not args.credentials_file:
+        return [Portal(args.portal, args.portal, args.access_id, args.access_key, args.rate_limit,
+                       args.concurrency)]
+
+    import configparser
+    config = configparser.ConfigParser(interpolation=None)
+    with open(args.credentials_file) as f:
+        if os.fstat(f.fileno()).st_mode & 0o077:
+            logger.warning('  Credentials file %s is readable by other users', args.credentials_file)
+        try:
+            config.read_file(f)
+        except configparser.Error as e:
+            raise ValueError(str(e)) from e
+
+    portals = []
+    for name in args.portals.split(',') if args.portals else config.sections():
+        if not config.has_section(name):
+            raise KeyError(f'No section [{name}] in {args.credentials_file}')
+        section = config[name]
+        portals.append(Portal(name, section.get('portal', name), section['access_id'], section['access_key'],
+                              section.getfloat('rate_limit', args.rate_limit),
+                              section.getint('concurrency', args.concurrency)))
+    if not portals:
+        raise ValueError(f'No portals in {args.credentials_file}')
+
+    return portals
+
+def get_route_ipaddr() -> str:
+    """
+    Return the IPv4 address of the interface the default route uses, read from /proc/net/route
+    and the interface itself, or None if there is no default route.  No packets are sent.
+    """
+    import fcntl
+    import socket
+    import struct
+
+    routes = []
+    try:
+        with open('/proc/net/route') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                # Destination 0.0.0.0 with the RTF_UP flag set, lowest metric wins
+                if len(fields) >= 7 and fields[1] == '00000000' and int(fields[3], 16) & 0x1:
+                    routes.append((int(fields[6]), fields[0]))
+    except (OSError, StopIteration, ValueError):
+        return None
+    if not routes:
+        return None
+
+    iface = min(routes)[1]
+    siocgifaddr = 0x8915
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            ifreq = fcntl.ioctl(sock.fileno(), siocgifaddr, struct.pack('256s', iface.encode()[:15]))
+        except OSError:
+            return None
+
+    return socket.inet_ntoa(ifreq[20:24])
+
+def read_cgroup_limit(path: str) -> int:
+    """Return the first number in a cgroup v2 limit file such as cpu.max, or None for max/missing."""
+    try:
+        with open(path) as f:
+            value = f.read().split()
+    except OSError:
+        return None
+
+    return int(value[0]) if value and value[0].isdigit() else None
+
+@functools.lru_cache(maxsize=None)
+def get_host_facts() -> dict:
+    """
+    Gather facts about this host, once per run:
+
+        ipaddr   : IPv4 address used for default route traffic.
+        hostname : Short host name.
+        cpus     : CPUs this process may use, taking affinity and any cgroup CPU quota into account.
+        mem_mb   : Memory in MiB, taking any cgroup memory limit into account.
+    """
+    import socket
+    facts = {'ipaddr': get_route_ipaddr(), 'hostname': socket.gethostname()}
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    cpu_quota = read_cgroup_limit('/sys/fs/cgroup/cpu.max')
+    if cpu_quota:
+        try:
+            with open('/sys/fs/cgroup/cpu.max') as f:
+                period = int(f.read().split()[1])
+            cpus = min(cpus, max(1, cpu_quota // period))
+        except (OSError, IndexError, ValueError):
+            pass
+    facts['cpus'] = cpus
+
+    mem_mb = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    mem_mb = int(line.split()[1]) // 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    mem_limit = read_cgroup_limit('/sys/fs/cgroup/memory.max')
+    if mem_limit and mem_mb:
+        mem_mb = min(mem_mb, mem_limit // (1024 * 1024))
+    facts['mem_mb'] = mem_mb
+
+    logger.info('Host facts: %s', facts)
+    return facts
+
+def get_dflt_ipaddr() -> str:
+    """
+    Return the IP address of the NIC used for default route traffic, from the cached host facts.
+    If the host has no default route the host name is returned instead, LogicMonitor accepts
+    either as a device's name.
+    """
+    facts = get_host_facts()
+    if not facts['ipaddr']:
+        logger.warning('  No default route found, using host name %s instead of an IP address', facts['hostname'])
+        return facts['hostname']
+
+    return facts['ipaddr']
+
+# Minimum CPUs and memory (MiB) for each collector size, smallest first, from LogicMonitor's
+# collector capacity guidance.  Memory is compared with 10% slack because the kernel reserves some
+# of a VM's nominal memory.
+COLLECTOR_SIZE_REQUIREMENTS = [
+    ('nano', 1, 1024),
+    ('small', 1, 2048),
+    ('medium', 2, 4096),
+    ('large', 4, 8192),
+    ('extra_large', 8, 16384),
+    ('double_extra_large', 16, 32768),
+]
+
+def choose_collector_size() -> str:
+    """Return the largest collector size this host has the CPUs and memory for."""
+    facts = get_host_facts()
+    chosen = COLLECTOR_SIZE_REQUIREMENTS[0][0]
+    for size, min_cpus, min_mem_mb in COLLECTOR_SIZE_REQUIREMENTS:
+        if facts['cpus'] >= min_cpus and facts['mem_mb'] and facts['mem_mb'] >= min_mem_mb * 0.9:
+            chosen = size
+
+    logger.info('Chose collector size %s for %s CPUs and %s MiB of memory', chosen, facts['cpus'], facts['mem_mb'])
+    return chosen
+
+# The API helpers below are written once, as generators yielding each thing they need done: an
+# API client call, another helper, a sleep, or several of those at once (see LMOp).  both_engines()
+# turns each into a sync function that does those one after the other with the portal's api, and
+# an _async one that does them with its async_api without blocking the event loop, so lookups
+# that don't depend on each other run at the same time.  Patches only send the fields being
+# changed rather than the whole object, so concurrent updates to the same collector or device
+# can't overwrite each other with stale data.
+
+class LMOp:
+    """One thing a helper yields for the engine to do, made by api(), helper(), pause() or concurrently()."""
+    __slots__ = ('kind', 'target', 'args', 'kwargs')
+
+    def __init__(self, kind: str, target: str, args: tuple = (), kwargs: dict = None):
+        self.kind = kind
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+
+def api(method: str, **kwargs) -> LMOp:
+    """Call a method of the portal's API client, which has the same name on api and async_api."""
+    return LMOp('api', method, (), kwargs)
+
+def helper(name: str, *args, **kwargs) -> LMOp:
+    """Call another helper, name() or name_async() depending on the engine, so its span and name cache apply."""
+    return LMOp('helper', name, args, kwargs)
+
+def pause(seconds: float, reason: str) -> LMOp:
+    """Sleep, with an asyncio timer on the async engine."""
+    return LMOp('sleep', reason, (seconds,))
+
+def concurrently(*ops, return_exceptions: bool = False) -> LMOp:
+    """
+    Do several ops at the same time on the async engine, in turn on the sync one.  Yields a list
+    of their results, with return_exceptions the exception an op raised in place of its result.
+    """
+    return LMOp('gather', '', ops, {'return_exceptions': return_exceptions})
+
+# Fields the SDK's models can't be built without, by the API method returning them: required
+# ones, and the type a Device reads to pick its subclass.  A fields= projection on the SDK client
+# has to ask for these too, or deserializing the response raises.  LMRawApi and LMAsyncApi return
+# LMRecords, which take whatever they're given.
+SDK_REQUIRED_FIELDS = {
+    'get_collector_group_by_id': ('name',),
+    'get_collector_group_list': ('name',),
+    'get_device_by_id': ('name', 'displayName', 'preferredCollectorId', 'type'),
+    'get_device_group_by_id': ('name',),
+    'get_device_group_list': ('name',),
+    'get_escalation_chain_list': ('name', 'destinations'),
+}
+
+def do_op(op: LMOp):
+    if op.kind == 'api':
+        kwargs = op.kwargs
+        if kwargs.get('fields') and op.target in SDK_REQUIRED_FIELDS and not isinstance(portal().api, LMRawApi):
+            fields = kwargs['fields'].split(',') + list(SDK_REQUIRED_FIELDS[op.target])
+            kwargs = dict(kwargs, fields=','.join(dict.fromkeys(fields)))
+        return getattr(portal().api, op.target)(**kwargs)
+    if op.kind == 'helper':
+        return globals()[op.target](*op.args, **op.kwargs)
+    if op.kind == 'sleep':
+        with trace_span('sleep', 'wait', seconds=op.args[0], reason=op.target):
+            return sleep(op.args[0])
+    if not op.kwargs['return_exceptions']:
+        return [do_op(o) for o in op.args]
+    results = []
+    for o in op.args:
+        try:
+            results.append(do_op(o))
+        except Exception as e:
+            results.append(e)
+    return results
+
+async def do_op_async(op: LMOp):
+    if op.kind == 'api':
+        return await getattr(portal().async_api, op.target)(**op.kwargs)
+    if op.kind == 'helper':
+        return await globals()[op.target + '_async'](*op.args, **op.kwargs)
+    if op.kind == 'sleep':
+        with trace_span('sleep', 'wait', seconds=op.args[0], reason=op.target):
+            return await asyncio.sleep(op.args[0])
+    return list(await asyncio.gather(*(do_op_async(o) for o in op.args), **op.kwargs))
+
+def run_steps(steps):
+    """Run a helper's generator to the end with the sync engine and return what it returns."""
+    result, error = None, None
+    while True:
+        try:
+            op = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = do_op(op), None
+        except Exception as e:
+            result, error = None, e
+
+async def run_steps_async(steps):
+    """asyncio version of run_steps()."""
+    result, error = None, None
+    while True:
+        try:
+            op = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await do_op_async(op), None
+        except Exception as e:
+            result, error = None, e
+
+# How long successful name lookups (collector group, device group and escalation chain names) are
+# reused for, set by the daemon and by preflights.  Concurrent async lookups of the same name
+# always share one request, whatever this is set to.
+name_cache_ttl = 0
+
+def cache_name_lookup(func):
+    """Decorator for the async by-name lookups, see name_cache_ttl."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        name_cache = portal().name_cache
+        entry = name_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1].result() if entry[1].done() else await entry[1]
+
+        lookup = asyncio.ensure_future(func(*args, **kwargs))
+        name_cache[key] = (float('inf'), lookup)
+        try:
+            response = await lookup
+        except BaseException:
+            name_cache.pop(key, None)
+            raise
+        if response and name_cache_ttl > 0:
+            name_cache[key] = (time.monotonic() + name_cache_ttl, lookup)
+        else:
+            name_cache.pop(key, None)
+
+        return response
+
+    return wrapper
+
+def cache_sync_name_lookup(func, cache_name: str):
+    """
+    Decorator for the sync by-name lookups, see name_cache_ttl.  Entries are kept under the name
+    of the async lookup, cache_name, so either engine reuses what the other found.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (cache_name, args, tuple(sorted(kwargs.items())))
+        name_cache = portal().name_cache
+        entry = name_cache.get(key)
+        if entry and entry[0] > time.monotonic() and entry[1].done():
+            return entry[1].result()
+
+        response = func(*args, **kwargs)
+        if response and name_cache_ttl > 0:
+            lookup = concurrent.futures.Future()
+            lookup.set_result(response)
+            name_cache[key] = (time.monotonic() + name_cache_ttl, lookup)
+
+        return response
+
+    return wrapper
+
+def both_engines(steps_func, cached: bool = False) -> tuple:
+    """
+    Return the traced sync and async functions running a helper written as a generator of LMOps.
+    With cached both go through the name cache.
+    """
+    @functools.wraps(steps_func)
+    def sync_helper(*args, **kwargs):
+        return run_steps(steps_func(*args, **kwargs))
+
+    @functools.wraps(steps_func)
+    async def async_helper(*args, **kwargs):
+        return await run_steps_async(steps_func(*args, **kwargs))
+    async_helper.__name__ = async_helper.__qualname__ = steps_func.__name__ + '_async'
+    async_helper.__doc__ = f'asyncio version of {steps_func.__name__}().'
+
+    if cached:
+        async_helper = cache_name_lookup(async_helper)
+        sync_helper = cache_sync_name_lookup(sync_helper, async_helper.__name__)
+    return traced(sync_helper), traced_async(async_helper)
 
 def gcbi(c_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector.Collector:
     """
@@ -32,7 +1350,7 @@ def gcbi(c_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector.Col
     logger.info('Searching for collector with ID %s', c_id)
 
     try:
-        response = lm_api.get_collector_by_id(id=c_id, fields=r_fields)
+        response = yield api('get_collector_by_id', id=c_id, fields=r_fields)
     except ApiException as e:
         logger.error('  LM API Exception: get_collector_by_id(): %s', e)
         response = {}
@@ -44,6 +1362,8 @@ def gcbi(c_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector.Col
 
     return response
 
+gcbi, gcbi_async = both_engines(gcbi)
+
 def gcgbi(cg_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector_group.CollectorGroup:
     """
     Return a dictionary containing information about a LogicMonitor collector group, searching by
@@ -57,7 +1377,7 @@ def gcgbi(cg_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector_g
     logger.info('Searching for collector group with ID %s', cg_id)
 
     try:
-        response = lm_api.get_collector_group_by_id(id=cg_id, fields=r_fields)
+        response = yield api('get_collector_group_by_id', id=cg_id, fields=r_fields)
     except ApiException as e:
         logger.error('  LM API Exception: get_collector_group_by_id(): %s', e)
         response = {}
@@ -69,6 +1389,8 @@ def gcgbi(cg_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector_g
 
     return response
 
+gcgbi, gcgbi_async = both_engines(gcgbi)
+
 def gcgbn(cg_name: str, r_fields: str = '') -> logicmonitor_sdk.models.collector_group.CollectorGroup:
     """
     Return a dictionary containing information about a LogicMonitor collector group, searching by
@@ -83,36 +1405,46 @@ def gcgbn(cg_name: str, r_fields: str = '') -> logicmonitor_sdk.models.collector
 
     try:
         r_filter   = 'name:"' + cg_name + '"'
-        response = lm_api.get_collector_group_list(filter=r_filter, fields=r_fields)
+        response = yield api('get_collector_group_list', filter=r_filter, fields=r_fields)
     except ApiException as e:
         logger.error('  LM API Exception: get_collector_group_list(): %s', e)
         response = {}
 
     if response and response.total == 1 and response.items and response.items[0].name == cg_name:
         logger.info('  SUCCESS: %s == %s', cg_name, response.items[0].id)
-        response = gcgbi(cg_id=response.items[0].id)
+        response = yield helper('gcgbi', cg_id=response.items[0].id)
     else:
         logger.error('  FAILURE: Could not find %s', cg_name)
         response = {}
 
     return response
 
+gcgbn, gcgbn_async = both_engines(gcgbn, cached=True)
+
 def gcicg(cg_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector_pagination_response.CollectorPaginationResponse:
     """
     Return a list of dictionaries containing information about LogicMonitor collectors which
-    belong in a specific collector group.
+    belong in a specific collector group.  Every page is fetched, so items holds all of them.
 
         cg_id    : LogicMonitor collector group ID to retrieve information about.
         r_fields : String containing comma separated values of dictionary key names to include
                    in the returned dictionary.  By default it will return all keys/values.
     """
     response = {}
+    page_size = 1000
     logger.info('Searching for collectors in collector group with ID %s', cg_id)
 
     try:
-        r_fields = 'id,backupAgentId,enableFailBack,enableFailOverOnCollectorDevice,description'
+        r_fields = 'id,backupAgentId,enableFailBack,enableFailOverOnCollectorDevice,description,numberOfInstances,numberOfHosts,collectorSize,collectorDeviceId'
         r_filter = 'collectorGroupId:"' + str(cg_id) + '"'
-        response = lm_api.get_collector_list(fields=r_fields, filter=r_filter)
+        items = []
+        while True:
+            page = yield api('get_collector_list', fields=r_fields, filter=r_filter, size=page_size, offset=len(items))
+            items.extend(page.items or [])
+            if len(page.items or []) < page_size or (page.total is not None and len(items) >= page.total):
+                break
+        response = page
+        response.items = items
     except ApiException as e:
         logger.error('  LM API Exception: get_collector_list(): %s', e)
         response = {}
@@ -127,6 +1459,8 @@ def gcicg(cg_id: int, r_fields: str = '') -> logicmonitor_sdk.models.collector_p
 
     return response
 
+gcicg, gcicg_async = both_engines(gcicg)
+
 def gdbi(d_id: int, r_fields: str = '') -> logicmonitor_sdk.models.device.Device:
     """
     Return a dictionary containing information about a LogicMonitor device/resource.
@@ -139,7 +1473,7 @@ def gdbi(d_id: int, r_fields: str = '') -> logicmonitor_sdk.models.device.Device
     logger.info('Searching for device with ID %s', d_id)
 
     try:
-        response = lm_api.get_device_by_id(id=d_id, fields=r_fields)
+        response = yield api('get_device_by_id', id=d_id, fields=r_fields)
     except ApiException as e:
         logger.error('  LM API Exception: get_device_by_id(): %s', e)
         response = {}
@@ -151,12 +1485,44 @@ def gdbi(d_id: int, r_fields: str = '') -> logicmonitor_sdk.models.device.Device
 
     return response
 
+gdbi, gdbi_async = both_engines(gdbi)
+
+def gdgbi(dg_id: int, r_fields: str = '') -> logicmonitor_sdk.models.device_group.DeviceGroup:
+    """
+    Return a dictionary containing information about a LogicMonitor device group.
+
+        dg_id    : LogicMonitor device group ID to retrieve information about.
+        r_fields : String containing comma separated values of dictionary key names to include
+                   in the returned dictionary.  By default it will return all keys/values.
+    """
+    response = {}
+    logger.info('Searching for device group with ID %s', dg_id)
+
+    try:
+        response = yield api('get_device_group_by_id', id=dg_id, fields=r_fields)
+    except ApiException as e:
+        logger.error('  LM API Exception: get_device_group_by_id(): %s', e)
+        response = {}
+
+    if response and response.id == dg_id:
+        logger.info('  SUCCESS: %s == %s', response.id, response.full_path)
+    else:
+        logger.error('  FAILURE: Could not find device group with ID %s', dg_id)
+
+    return response
+
+gdgbi, gdgbi_async = both_engines(gdgbi)
+
+def dg_full_path(dg_path: str) -> str:
+    """Return a device group path as the portal's fullPath has it, eg /B2C/Collectors/ as B2C/Collectors."""
+    return dg_path.strip('/')
+
 def gdgbn(dg_name: str, r_fields: str = '') -> logicmonitor_sdk.models.device_group_pagination_response.DeviceGroupPaginationResponse:
     """
     Return a dictionary containing information about a LogicMonitor device group, searching by
     device group name.
 
-        dg_name  : LogicMonitor device group name to retrieve information about.
+        dg_name  : LogicMonitor device group path to retrieve information about, see dg_full_path().
         r_fields : String containing comma separated values of dictionary key names to include
                    in the returned dictionary.  By default it will return all keys/values.
     """
@@ -164,13 +1530,13 @@ def gdgbn(dg_name: str, r_fields: str = '') -> logicmonitor_sdk.models.device_gr
     logger.info('Searching for device group named %s', dg_name)
 
     try:
-        r_filter = 'fullPath:"' + dg_name + '"'
-        response = lm_api.get_device_group_list(filter=r_filter, fields=r_fields, size=1)
+        r_filter = 'fullPath:"' + dg_full_path(dg_name) + '"'
+        response = yield api('get_device_group_list', filter=r_filter, fields=r_fields, size=1)
     except ApiException as e:
         logger.error('  LM API Exception: get_device_group_list(): %s', e)
         response = {}
 
-    if response and response.total == 1 and response.items and response.items[0].full_path == dg_name:
+    if response and response.total == 1 and response.items and response.items[0].full_path == dg_full_path(dg_name):
         logger.info('  SUCCESS: %s == %s', dg_name, response.items[0].id)
     else:
         logger.error('  FAILURE: Could not find device group named %s', dg_name)
@@ -178,6 +1544,8 @@ def gdgbn(dg_name: str, r_fields: str = '') -> logicmonitor_sdk.models.device_gr
 
     return response
 
+gdgbn, gdgbn_async = both_engines(gdgbn, cached=True)
+
 def gecbn(ec_name: str, r_fields: str = '') -> logicmonitor_sdk.models.escalation_chain_pagination_response.EscalationChainPaginationResponse:
     """
     Return a dictionary containing information about a LogicMonitor escalation chain.
@@ -191,7 +1559,7 @@ def gecbn(ec_name: str, r_fields: str = '') -> logicmonitor_sdk.models.escalatio
 
     try:
         r_filter = 'name:"' + ec_name + '"'
-        response = lm_api.get_escalation_chain_list(filter=r_filter, fields=r_fields)
+        response = yield api('get_escalation_chain_list', filter=r_filter, fields=r_fields)
     except ApiException as e:
         logger.error('  LM API Exception: get_escalation_chain_list(): %s', e)
         response = {}
@@ -204,7 +1572,9 @@ def gecbn(ec_name: str, r_fields: str = '') -> logicmonitor_sdk.models.escalatio
 
     return response
 
-def pdbi(d_id: int, payload: dict, patch_type: str = 'replace') -> bool:
+gecbn, gecbn_async = both_engines(gecbn, cached=True)
+
+def pdbi(d_id: int, payload: dict, patch_type: str = 'replace', verify: bool = True) -> bool:
     """
     Update a LogicMonitor device/resource properties with a properly formatted payload or object.
 
@@ -225,141 +1595,189 @@ def pdbi(d_id: int, payload: dict, patch_type: str = 'replace') -> bool:
         d_id       : LogicMonitor device ID to update.
         payload    : Properly formatted device property data used to update the target device.
         patch_type : See explanation above.
+        verify     : Look the device up before patching it.  Callers that have just fetched the
+                     device themselves can skip that.
     """
     is_success = False
     response = {}
     logger.info('Patching device with ID %s via method %s', d_id, patch_type)
 
-    gdbi_response = gdbi(d_id)
-    if gdbi_response.id:
+    gdbi_response = (yield helper('gdbi', d_id, 'id,displayName')) if verify else True
+    if gdbi_response:
         try:
-            response = lm_api.patch_device(id=d_id, body=payload, op_type=patch_type)
+            response = yield api('patch_device', id=d_id, body=payload, op_type=patch_type)
         except ApiException as e:
             logger.error('  LM API Exception: patch_device(): %s', e)
     else:
-        logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', gdbi_response)
+        logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', Dump(gdbi_response))
 
     if response and response.id:
         logger.info('  SUCCESS: Patched device ID %s with new data', d_id)
         is_success = True
     else:
-        logger.error('  FAILURE: Could not patch device ID %s.  Dump: %s', d_id, response)
+        logger.error('  FAILURE: Could not patch device ID %s.  Dump: %s', d_id, Dump(response))
 
     return is_success
 
-def pcbi(c_id: int, payload: dict) -> bool:
+pdbi, pdbi_async = both_engines(pdbi)
+
+def pcbi(c_id: int, payload: dict, verify: bool = True) -> bool:
     """
     Update a LogicMonitor collector properties with a properly formatted payload or object.
 
         c_id    : LogicMonitor collector ID to retrieve information about.
         payload : Properly formatted collector property data used to update the target collector.
+        verify  : See pdbi().
     """
     is_success = False
     response = {}
 
     logger.info('Patching collector with ID %s', c_id)
-    gcbi_response = gcbi(c_id)
-    if gcbi_response.id:
+    gcbi_response = (yield helper('gcbi', c_id, 'id,hostname')) if verify else True
+    if gcbi_response:
         try:
-            response = lm_api.patch_collector_by_id(id=c_id, body=payload)
+            response = yield api('patch_collector_by_id', id=c_id, body=payload)
         except ApiException as e:
             logger.error('  LM API Exception: patch_collector_by_id(): %s', e)
     else:
-        logger.error('  FAILURE: Error in gcbi() response.  Dump: %s', gcbi_response)
+        logger.error('  FAILURE: Error in gcbi() response.  Dump: %s', Dump(gcbi_response))
 
     if response and response.id:
         logger.info('  SUCCESS: Patched collector ID %s with new data', c_id)
         is_success = True
     else:
-        logger.error('  FAILURE: Could not patch collector ID %s.  Dump: %s', c_id, response)
+        logger.error('  FAILURE: Could not patch collector ID %s.  Dump: %s', c_id, Dump(response))
 
     return is_success
 
-def pcgbi(cg_id: int, payload: dict) -> bool:
+pcbi, pcbi_async = both_engines(pcbi)
+
+def pcgbi(cg_id: int, payload: dict, verify: bool = True) -> bool:
     """
     Update a LogicMonitor collector group properties with a properly formatted payload or object.
 
         cg_id   : LogicMonitor collector group ID to retrieve information about.
         payload : Properly formatted collector group property data used to update the target group.
+        verify  : See pdbi().
     """
     is_success = False
     response = {}
     logger.info('Patching collector group with ID %s', cg_id)
 
-    gcgbi_response = gcgbi(cg_id)
-    if gcgbi_response.id:
+    gcgbi_response = (yield helper('gcgbi', cg_id, 'id,name')) if verify else True
+    if gcgbi_response:
         try:
-            response = lm_api.patch_collector_group_by_id(id=cg_id, body=payload)
+            response = yield api('patch_collector_group_by_id', id=cg_id, body=payload)
         except ApiException as e:
             logger.error('  LM API Exception: patch_collector_group_by_id(): %s', e)
     else:
-        logger.error('  FAILURE: Error in gcgbi() response.  Dump: %s', gcgbi_response)
+        logger.error('  FAILURE: Error in gcgbi() response.  Dump: %s', Dump(gcgbi_response))
 
     if response and response.id:
         logger.info('  SUCCESS: Patched collector group id %s with new data', cg_id)
         is_success = True
     else:
-        logger.error('  FAILURE: Could not patch collector group ID %s.  Dump: %s', cg_id, response)
+        logger.error('  FAILURE: Could not patch collector group ID %s.  Dump: %s', cg_id, Dump(response))
 
     return is_success
 
-def run_autodiscovery(d_id: int) -> bool:
+pcgbi, pcgbi_async = both_engines(pcgbi)
+
+def pdgbi(dg_id: int, payload: dict, patch_type: str = 'replace') -> bool:
     """
-    Schedule an autodiscovery task on a LogicMonitor device.
+    Update a LogicMonitor device group's properties, see pdbi() for what patch_type does to
+    customProperties.  Every device in the group, and its subgroups, inherits them.
 
-        d_id : LogicMonitor device ID to autodiscover.
+        dg_id      : LogicMonitor device group ID to update.
+        payload    : Properly formatted device group property data used to update the target group.
+        patch_type : add, replace or refresh.
     """
     is_success = False
     response = {}
+    logger.info('Patching device group with ID %s via method %s', dg_id, patch_type)
+
+    gdgbi_response = yield helper('gdgbi', dg_id, 'id,fullPath')
+    if gdgbi_response:
+        try:
+            response = yield api('patch_device_group_by_id', id=dg_id, body=payload, op_type=patch_type)
+        except ApiException as e:
+            logger.error('  LM API Exception: patch_device_group_by_id(): %s', e)
+    else:
+        logger.error('  FAILURE: Error in gdgbi() response.  Dump: %s', Dump(gdgbi_response))
+
+    if response and response.id:
+        logger.info('  SUCCESS: Patched device group ID %s with new data', dg_id)
+        is_success = True
+    else:
+        logger.error('  FAILURE: Could not patch device group ID %s.  Dump: %s', dg_id, Dump(response))
+
+    return is_success
+
+pdgbi, pdgbi_async = both_engines(pdgbi)
+
+def run_autodiscovery(d_id: int, verify: bool = True) -> bool:
+    """
+    Schedule an autodiscovery task on a LogicMonitor device.
+
+        d_id   : LogicMonitor device ID to autodiscover.
+        verify : See pdbi().
+    """
+    is_success = False
     logger.info('Scheduling auto-discovery for device with ID %s', d_id)
 
-    gdbi_response = gdbi(d_id)
-    if gdbi_response and gdbi_response.id:
+    gdbi_response = (yield helper('gdbi', d_id, 'id,displayName')) if verify else True
+    if gdbi_response:
         try:
-            response = lm_api.schedule_auto_discovery_by_device_id(id=d_id)
+            yield api('schedule_auto_discovery_by_device_id', id=d_id)
+            is_success = True
         except ApiException as e:
             logger.error('  LM API Exception: schedule_auto_discovery_by_device_id(): %s', e)
     else:
-        logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', gdbi_response)
+        logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', Dump(gdbi_response))
 
     return is_success
 
-def wait_for_collector_assoc(c_id: str, max_try: int = 12, sleep_len: int = 10) -> bool:
+run_autodiscovery, run_autodiscovery_async = both_engines(run_autodiscovery)
+
+def wait_for_collector_assoc(c_id: int, max_try: int = 12, sleep_len: int = 10) -> int:
     """
     LogicMonitor sometimes takes 60-90 seconds to update their back end that associates a
     collector resource with the device resource the collector is running on.  Therefore, if we
     don't wait until that association is complete, our attempts to set custom properties on a 
     the collector VM resource or put that collector VM resource into a collector group will fail,
     since the information returned by get_collector_by_id() will not include a collector_device_id
-    property, therefore we don't know what device to actually set properties on.
+    property, therefore we don't know what device to actually set properties on.  Returns the
+    collector_device_id, or 0 on timeout or if the collector doesn't exist.
 
         c_id      : LogicMonitor collector ID to retrieve information about.
         max_try   : Maximum number of times to check for association between colletor and device
                     before failing.
         sleep_len : Number of seconds to wait between association checks
     """
-    is_success = False
+    r_fields = 'id,hostname,collectorDeviceId'
+    gcbi_response = yield helper('gcbi', c_id, r_fields)
+    if not gcbi_response:
+        return 0
+
     attempt = 1
+    while not gcbi_response.collector_device_id and attempt <= max_try:
+        logger.warning('  Waiting for collector-to-device association to finish, try again in %s s (attempt %s/%s)', sleep_len, attempt, max_try)
+        attempt += 1
+        yield pause(sleep_len, 'association')
+        gcbi_response = yield helper('gcbi', c_id, r_fields)
+        if not gcbi_response:
+            return 0
 
-    gcbi_response = gcbi(c_id)
-    if gcbi_response and gcbi_response.id:
-        while gcbi(c_id).collector_device_id == 0 and attempt <= max_try:
-            logger.warning('  Waiting for collector-to-device association to finish, try again in %s s (attempt %s/%s)', sleep_len, attempt, max_try)
-            attempt += 1
-            sleep(sleep_len)
-
-        gcbi_response = gcbi(c_id)
-        if attempt >= max_try or gcbi_response.collector_device_id == 0:
-            logger.error('  FAILURE: Timeout in waiting for collector resource and device to associate?')
-        elif gcbi_response.collector_device_id:
-            is_success = True
-            gcbi_response = gcbi(c_id)
-            logger.info('  Found association, %s -> %s', c_id, gcbi_response.collector_device_id)
-        else:
-            logger.error('  Unknown state.  attempt=%s max_try=%s gcbi_response=%s', attempt, max_try, gcbi(c_id))
+    if gcbi_response.collector_device_id:
+        logger.info('  Found association, %s -> %s', c_id, gcbi_response.collector_device_id)
+        return gcbi_response.collector_device_id
 
-    return is_success
+    logger.error('  FAILURE: Timeout in waiting for collector resource and device to associate?')
+    return 0
+
+wait_for_collector_assoc, wait_for_collector_assoc_async = both_engines(wait_for_collector_assoc)
 
+@traced
 def get_collector_installer(c_id: str, os_arch: str, size: str, use_ea: bool) -> str:
     """
     Download the collector-specific installer binary from LogicMonitor.
@@ -375,7 +1793,7 @@ def get_collector_installer(c_id: str, os_arch: str, size: str, use_ea: bool) ->
     gcbi_response = gcbi(c_id)
     if gcbi_response and gcbi_response.id:
         try:
-            response = lm_api.get_collector_installer(collector_id=c_id, os_and_arch=os_arch,
+            response = portal().api.get_collector_installer(collector_id=c_id, os_and_arch=os_arch,
                 collector_size=size, use_ea=use_ea)
         except ApiException as e:
             logger.error('  LM API Exception: get_collector_installer(): %s', e)
@@ -384,6 +1802,7 @@ def get_collector_installer(c_id: str, os_arch: str, size: str, use_ea: bool) ->
         if response and response.status == 200:
             logger.info('  Beginning download')
             dl_start_time = time.time()
+            import tempfile
             with tempfile.NamedTemporaryFile(delete=False) as installer:
                 installer.write(response.data)
                 installer.flush()
@@ -394,16 +1813,18 @@ def get_collector_installer(c_id: str, os_arch: str, size: str, use_ea: bool) ->
         else:
             logger.error('  FAILURE: Remote end sent non-OK response code (%s)', response.status)
     else:
-        logger.info('  FAILURE: Error in gcbi() response.  Dump: %s', gcbi_response)
+        logger.info('  FAILURE: Error in gcbi() response.  Dump: %s', Dump(gcbi_response))
 
     return installer.name if is_success else None
 
 # Run installer
+@traced
 def run_collector_installer(filename: str) -> bool:
     is_success = False
     logger.info('Running collector installer from %s', filename)
 
     if os.path.exists(filename):
+        import subprocess
         os.chmod(filename, 0o755)
         runner = subprocess.run([filename, '-y', '-m'])
         if runner.returncode == 0:
@@ -416,111 +1837,478 @@ def run_collector_installer(filename: str) -> bool:
 
     return is_success
 
-# Set collector escalation chain
-def set_collector_esc_chain(c_id: int, ec_name: str) -> bool:
+def get_local_collector_info(install_dir: str) -> dict:
+    """
+    Return what can be found out about a collector installed on this host, with None for anything
+    that can't be determined:
+
+        collector_id : Collector ID from id= in conf/agent.conf.
+        build        : Build from build= or version= in conf/agent.conf.
+        running      : Whether the collector services are running.
+    """
+    info = {'collector_id': None, 'build': None, 'running': None}
+
+    try:
+        with open(os.path.join(install_dir, 'conf', 'agent.conf')) as f:
+            for line in f:
+                key, _, value = line.strip().partition('=')
+                if key == 'id' and value.isdigit():
+                    info['collector_id'] = int(value)
+                elif key in ('build', 'version') and value:
+                    info['build'] = value
+    except OSError as e:
+        logger.info('  Could not read local collector config: %s', e)
+
+    import subprocess
+    try:
+        # Asked one unit at a time, with several units is-active succeeds if any one of them is active
+        returncodes = [subprocess.run(['systemctl', 'is-active', '--quiet', unit],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+                       for unit in ('logicmonitor-agent', 'logicmonitor-watchdog')]
+        # 0 is active, 3 is inactive and 4 is no such unit, anything else means systemd isn't usable
+        if all(returncode in (0, 3, 4) for returncode in returncodes):
+            info['running'] = all(returncode == 0 for returncode in returncodes)
+    except FileNotFoundError:
+        pass
+
+    if info['running'] is None:
+        # No systemd, look for any process started from the install directory instead
+        info['running'] = False
+        for pid in filter(str.isdigit, os.listdir('/proc')):
+            try:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    if install_dir.encode() in f.read():
+                        info['running'] = True
+                        break
+            except OSError:
+                continue
+
+    return info
+
+@traced
+def local_install_is_current(c_id: int, collector, install_dir: str) -> bool:
+    """
+    Return whether the collector installed on this host is the collector c_id, is running, and is
+    the same build the portal reports for it, in which case there is nothing to (re)install.
+
+        c_id        : LogicMonitor collector ID that should be installed.
+        collector   : gcbi() response for c_id, including the build and is_down fields.
+        install_dir : Directory the collector is installed in.
+    """
+    logger.info('Checking local collector installation in %s', install_dir)
+    if not os.path.isdir(install_dir):
+        logger.info('  No local installation')
+        return False
+    if not collector or not collector.build:
+        logger.info('  Portal did not return a build for collector ID %s', c_id)
+        return False
+
+    local = get_local_collector_info(install_dir)
+    logger.info('  Local: %s, portal: build=%s is_down=%s', local, collector.build, collector.is_down)
+    if local['collector_id'] != c_id:
+        logger.info('  Local installation is not collector ID %s', c_id)
+    elif not local['running']:
+        logger.info('  Local collector services are not running')
+    elif collector.is_down:
+        logger.info('  Portal reports collector ID %s as down', c_id)
+    elif local['build'] is None or str(local['build']) != str(collector.build):
+        logger.info('  Local build %s does not match portal build %s', local['build'], collector.build)
+    else:
+        logger.info('  SUCCESS: Collector ID %s build %s is installed and running', c_id, collector.build)
+        return True
+
+    return False
+
+@traced_async
+async def get_collector_installer_async(c_id: int, os_arch: str, size: str, use_ea: bool) -> str:
+    """asyncio version of get_collector_installer(), the installer is streamed straight to disk."""
+    import tempfile
+    logger.info('Downloading collector installer with ID %s', c_id)
+
+    if not await gcbi_async(c_id, 'id,hostname'):
+        logger.info('  FAILURE: Error in gcbi() response')
+        return None
+
+    logger.info('  Beginning download')
+    dl_start_time = time.time()
+    with tempfile.NamedTemporaryFile(delete=False) as installer:
+        try:
+            response = await portal().async_api.get_collector_installer(collector_id=c_id, os_and_arch=os_arch,
+                collector_size=size, use_ea=use_ea, sink=installer)
+        except ApiException as e:
+            logger.error('  LM API Exception: get_collector_installer(): %s', e)
+            response = None
+
+    if response and response.status == 200:
+        dl_time = round((time.time() - dl_start_time), 2)
+        logger.info('  SUCCESS: Downloaded collector installer in %s seconds', dl_time)
+        return installer.name
+
+    logger.error('  FAILURE: Remote end sent non-OK response code (%s)', response.status if response else None)
+    os.unlink(installer.name)
+    return None
+
+@traced_async
+async def run_collector_installer_async(filename: str) -> bool:
+    """asyncio version of run_collector_installer()."""
     is_success = False
-    logger.info('Setting escalation chain on collector ID %s to %s', c_id, ec_name)
+    logger.info('Running collector installer from %s', filename)
 
-    gcbi_response = gcbi(c_id)
-    if gcbi_response:
-        gecbn_response = gecbn(ec_name)
+    if filename and os.path.exists(filename):
+        os.chmod(filename, 0o755)
+        runner = await asyncio.create_subprocess_exec(filename, '-y', '-m')
+        returncode = await runner.wait()
+        if returncode == 0:
+            logger.info('  SUCCESS: Installer exited successfully')
+            is_success = True
+        else:
+            logger.error('  FAILURE: Installer exited with non-zero return code (%s)', returncode)
     else:
-        logger.error('  FAILURE: Error in gcbi() response.  Dump: %s', gcbi_response)
+        logger.error('  FAILURE: Could not access %s', filename)
 
-    if gcbi_response and gcbi_response.id and gecbn_response and gecbn_response.total == 1:
-        updated_data = gcbi_response
-        updated_data.escalating_chain_id = gecbn_response.items[0].id
+    return is_success
+
+# Set collector escalation chain
+def set_collector_esc_chain(c_id: int, ec_name: str) -> bool:
+    is_success = False
+    logger.info('Setting escalation chain on collector ID %s to %s', c_id, ec_name)
 
-        if pcbi(c_id, updated_data):
+    gcbi_response, gecbn_response = yield concurrently(helper('gcbi', c_id, 'id,hostname'), helper('gecbn', ec_name, 'id,name'))
+    if gcbi_response and gecbn_response and gecbn_response.total == 1:
+        if (yield helper('pcbi', c_id, {'escalatingChainId': gecbn_response.items[0].id}, verify=False)):
             logger.info('  SUCCESS')
             is_success = True
         else:
             logger.error('  FAILURE')
     else:
-        logger.error('  FAILURE: Error in gcbi() or gecbn() response.  Dumps: %s, %s', gcbi_response, gecbn_response)
+        logger.error('  FAILURE: Error in gcbi() or gecbn() response.  Dumps: %s, %s', Dump(gcbi_response), Dump(gecbn_response))
 
     return is_success
 
+set_collector_esc_chain, set_collector_esc_chain_async = both_engines(set_collector_esc_chain)
+
 # Set collector device name
 def set_collector_dev_name(c_id: int, display_name: str, ipaddr: str = '') -> bool:
     is_success = False
     logger.info('Setting device name on collector ID %s', c_id)
 
-    gcbi_response = gcbi(c_id)
-    if gcbi_response and gcbi_response.id and gcbi_response.collector_device_id:
-        gdbi_response = gdbi(gcbi_response.collector_device_id)
-        if gdbi_response and gdbi_response.id and gdbi_response.display_name:
+    gcbi_response = yield helper('gcbi', c_id, 'id,hostname,collectorDeviceId')
+    if gcbi_response and gcbi_response.collector_device_id:
+        gdbi_response = yield helper('gdbi', gcbi_response.collector_device_id, 'id,displayName')
+        if gdbi_response and gdbi_response.display_name:
             collector_dn = display_name if display_name else gcbi_response.hostname
             collector_ip = ipaddr if ipaddr else get_dflt_ipaddr()
-            updated_data = gdbi_response
-            updated_data.name = collector_ip
-            updated_data.display_name = collector_dn
 
-            if pdbi(gdbi_response.id, updated_data):
+            if (yield helper('pdbi', gdbi_response.id, {'name': collector_ip, 'displayName': collector_dn}, verify=False)):
                 logger.info('  SUCCESS: Set display name to %s and IP address to %s', collector_dn, collector_ip)
                 is_success = True
             else:
                 logger.error('  FAILURE: Could not set display name and/or IP address')
         else:
-            logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', gdbi_response)
+            logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', Dump(gdbi_response))
     else:
-        logger.error('  FAILURE: Error in gcbi() response.  Dump: %s', gcbi_response)
+        logger.error('  FAILURE: Error in gcbi() response.  Dump: %s', Dump(gcbi_response))
 
     return is_success
 
-# Set custom properties of a collector device resource, mostly used for SNMPv3
-def set_collector_dev_cp(c_id: int, ncp: list) -> bool:
+set_collector_dev_name, set_collector_dev_name_async = both_engines(set_collector_dev_name)
+
+# Set custom properties of a collector device resource, mostly used for SNMPv3.  If the caller
+# already knows the collector's collector_device_id it can pass it in to skip waiting for the association.
+def set_collector_dev_cp(c_id: int, ncp: list, collector_device_id: int = 0) -> bool:
     is_success = False
     logger.info('Setting custom properties for device ID %s', c_id)
 
-    if wait_for_collector_assoc(c_id):
-        gcbi_response = gcbi(c_id)
-        gdbi_response = gdbi(gcbi_response.collector_device_id)
+    if not collector_device_id:
+        collector_device_id = yield helper('wait_for_collector_assoc', c_id)
+    if collector_device_id:
+        if (yield helper('pdbi', collector_device_id, {'customProperties': ncp})):
+            logger.info('  SUCCESS')
+            yield helper('run_autodiscovery', collector_device_id, verify=False)
+            is_success = True
+        else:
+            logger.error('  FAILURE')
+    else:
+        logger.error('  FAILURE: Timed out waiting for collector to device association, or invalid collector id (%s)', c_id)
 
-        if gdbi_response and gdbi_response.id:
-            updated_data = gdbi_response
-            updated_data.custom_properties = ncp
+    return is_success
+
+set_collector_dev_cp, set_collector_dev_cp_async = both_engines(set_collector_dev_cp)
+
+# Set custom properties once on a device group, for every device in it to inherit
+def set_dev_grp_cp(dg_id: int, ncp: list) -> bool:
+    logger.info('Setting custom properties for device group ID %s', dg_id)
+    is_success = yield helper('pdgbi', dg_id, {'customProperties': ncp})
+    if is_success:
+        logger.info('  SUCCESS')
+    else:
+        logger.error('  FAILURE')
+
+    return is_success
+
+set_dev_grp_cp, set_dev_grp_cp_async = both_engines(set_dev_grp_cp)
+
+# Values the API returns in place of properties it treats as secrets, such as snmp.authToken
+MASKED_PROPERTY_VALUE = '********'
 
-            if pdbi(gdbi_response.id, updated_data):
+def check_inherited_props(device, ncp: list) -> list:
+    """
+    Return a description of each property of ncp a device doesn't inherit as given, either
+    because it has its own value overriding it or because it inherits something else.  Masked
+    values are only checked for being there.
+    """
+    own = {prop.name for prop in device.custom_properties or ()}
+    inherited = {prop.name: prop.value for prop in device.inherited_properties or ()}
+    problems = []
+    for prop in ncp:
+        if prop['name'] in own:
+            problems.append(f'{prop["name"]} is overridden on the device')
+        elif prop['name'] not in inherited:
+            problems.append(f'{prop["name"]} is not inherited')
+        elif inherited[prop['name']] not in (prop['value'], MASKED_PROPERTY_VALUE):
+            problems.append(f'{prop["name"]} is inherited as {inherited[prop["name"]]!r}')
+
+    return problems
+
+# Check that a collector device inherits custom properties set with set_dev_grp_cp(),
+# collector_device_id as for set_collector_dev_cp()
+def verify_collector_dev_cp(c_id: int, ncp: list, collector_device_id: int = 0) -> bool:
+    is_success = False
+    logger.info('Verifying inherited custom properties for device of collector ID %s', c_id)
+
+    if not collector_device_id:
+        collector_device_id = yield helper('wait_for_collector_assoc', c_id)
+    if collector_device_id:
+        gdbi_response = yield helper('gdbi', collector_device_id, 'id,displayName,customProperties,inheritedProperties')
+        if gdbi_response and gdbi_response.id:
+            problems = check_inherited_props(gdbi_response, ncp)
+            if problems:
+                logger.error('  FAILURE: Device ID %s: %s', gdbi_response.id, '; '.join(problems))
+            else:
                 logger.info('  SUCCESS')
-                run_autodiscovery(gcbi_response.collector_device_id)
                 is_success = True
-            else:
-                logger.error('  FAILURE')
         else:
-            logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', gdbi_response)
+            logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', Dump(gdbi_response))
     else:
         logger.error('  FAILURE: Timed out waiting for collector to device association, or invalid collector id (%s)', c_id)
 
     return is_success
 
+verify_collector_dev_cp, verify_collector_dev_cp_async = both_engines(verify_collector_dev_cp)
+
 # Set collector group auto-balance
-def set_collector_grp_ab(cg_id: int, ab_state: str, ab_threshold: int = '10000') -> bool:
+def set_collector_grp_ab(cg_id: int, ab_state: str, ab_threshold: int = 10000) -> bool:
     is_success = False
     logger.info('Setting auto-balance to %s on collector group ID %s', ab_state, cg_id)
 
-    gcgbi_response = gcgbi(cg_id)
-    if gcgbi_response and gcgbi_response.id == cg_id:
-        new_ab_state = 'true' if ab_state == 'enable' else 'false'
-
-        updated_data = gcgbi_response
-        updated_data.auto_balance = new_ab_state
-        updated_data.auto_balance_instance_count_threshold = ab_threshold
-
-        if pcgbi(cg_id, updated_data):
-            logger.info('  SUCCESS')
-            is_success = True
-        else:
-            logger.error('  FAILURE')
+    updated_data = {
+        'autoBalance': ab_state == 'enable',
+        'autoBalanceInstanceCountThreshold': ab_threshold,
+    }
+    if (yield helper('pcgbi', cg_id, updated_data)):
+        logger.info('  SUCCESS')
+        is_success = True
     else:
-        logger.error('  FAILURe: Error in gcgbi() response.  Dump: %s', gcgbi_response)
+        logger.error('  FAILURE')
 
     return is_success
 
-# Set collector group failover
-def set_collector_grp_fo(cg_id: str, fo_state: str, no_sleep: bool) -> bool:
-    is_success = False
-    tripped = False
+set_collector_grp_ab, set_collector_grp_ab_async = both_engines(set_collector_grp_ab)
+
+# Size the collector group auto-balance threshold from its members
+def compute_ab_threshold(cg_id: int, target_util: float) -> int:
+    logger.info('Computing auto-balance threshold for collector group ID %s at %.0f%% target utilisation', cg_id, target_util * 100)
+
+    gcicg_response = yield helper('gcicg', cg_id)
+    threshold = ab_threshold_for_group(gcicg_response.items if gcicg_response else [], target_util)
+    if threshold:
+        logger.info('  SUCCESS')
+    else:
+        logger.error('  FAILURE: Error in gcicg() response.  Dump: %s', Dump(gcicg_response))
+
+    return threshold
+
+compute_ab_threshold, compute_ab_threshold_async = both_engines(compute_ab_threshold)
+
+async def set_collector_grp_ab_periodic_async(cg_id: int, ab_state: str, target_util: float,
+                                              interval: int, min_change: float) -> bool:
+    """
+    Recompute the collector group's auto-balance threshold every interval seconds until
+    SIGTERM/SIGINT, so it follows the group as collectors are added.  The group is only patched
+    when the threshold moves by more than min_change (a fraction) from the one last set.
+    Returns False if the first update failed, network errors and timeouts are just retried.
+    """
+    import signal
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    logger.info('Recomputing auto-balance threshold for collector group ID %s every %s s', cg_id, interval)
+    applied = 0
+    while not stop.is_set():
+        try:
+            threshold = await compute_ab_threshold_async(cg_id, target_util)
+            if threshold and applied and abs(threshold - applied) <= applied * min_change:
+                logger.info('  Threshold %s is within %.0f%% of %s, leaving it', threshold, min_change * 100, applied)
+            elif threshold and await set_collector_grp_ab_async(cg_id, ab_state, threshold):
+                applied = threshold
+            elif not applied:
+                return False
+        except (*ApiException, OSError, asyncio.TimeoutError) as e:
+            logger.warning('  Collector group ID %s poll failed, trying again in %s s: %s', cg_id, interval, e)
+
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+    return True
+
+# Approximate number of instances a collector of each size can monitor comfortably.  Only the
+# ratios matter for failover planning, they let collectors of different sizes be compared.
+COLLECTOR_SIZE_CAPACITY = {
+    'nano': 2000,
+    'small': 7500,
+    'medium': 15000,
+    'large': 30000,
+    'extra_large': 60000,
+    'double_extra_large': 120000,
+}
+
+def ab_threshold_for_group(collectors: list, target_util: float) -> int:
+    """
+    Return an auto-balance instance count threshold for a collector group, so that rebalancing
+    starts as soon as a member passes target_util of its capacity.  Returns 0 if there are no members.
+
+        collectors  : gcicg() items, with number_of_instances and collector_size.
+        target_util : Fraction of COLLECTOR_SIZE_CAPACITY a collector should be kept under.
+
+    The group has a single threshold whatever the sizes of its members, so it is taken from the
+    smallest of them.  If the group as a whole is already past target_util, instances spread evenly
+    would still leave every member over that threshold and rebalancing would only move them around,
+    so the threshold is raised to the smallest member's even share and a warning is logged.
+    """
+    if not collectors:
+        return 0
+
+    capacity = {}
+    for c in collectors:
+        if c.collector_size not in COLLECTOR_SIZE_CAPACITY:
+            logger.info('  Collector %s has unknown size %s, assuming medium', c.id, c.collector_size)
+        capacity[c.id] = COLLECTOR_SIZE_CAPACITY.get(c.collector_size, COLLECTOR_SIZE_CAPACITY['medium'])
+    smallest = min(capacity.values())
+    util = target_util
+
+    if any(c.number_of_instances is None for c in collectors):
+        logger.info('  Collector instance counts are missing, sizing the threshold on capacity only')
+    else:
+        group_util = sum(c.number_of_instances for c in collectors) / sum(capacity.values())
+        logger.info('  Collector group is at %.0f%% of its capacity over %s collectors', group_util * 100, len(collectors))
+        if group_util > target_util:
+            logger.warning('  Collector group is past the %.0f%% target utilisation, it needs more collectors', target_util * 100)
+            util = group_util
+
+    threshold = max(int(smallest * util), 1)
+    logger.info('  Auto-balance threshold %s, %.0f%% of the smallest member\'s %s instances', threshold, util * 100, smallest)
+
+    return threshold
+
+def ring_failover_backups(collector_ids: list) -> dict:
+    """Return {collector_id: backup_id} with each collector backed up by the next one in the list."""
+    return {c_id: collector_ids[(index + 1) % len(collector_ids)] for index, c_id in enumerate(collector_ids)}
+
+def balanced_failover_backups(collectors: list) -> dict:
+    """
+    Return {collector_id: backup_id} for the members of a collector group so that, whichever single
+    collector fails, the collector taking over its load ends up as lightly loaded as possible.
+    Each collector backs up exactly one other, as with the ring, but the pairs are picked by load.
+    Returns an empty dict if any collector is missing its instance count.
+
+        collectors : gcicg() items, with number_of_instances, number_of_hosts and collector_size.
+
+    Load is the monitored instance count (device count if no collector reports instances), and
+    utilisation is load divided by COLLECTOR_SIZE_CAPACITY for the collector's size.  If f fails
+    and b is its backup, b ends up at (load[b] + load[f]) / capacity[b].  The largest of those over
+    all pairs is minimised by binary searching for the smallest limit under which every collector
+    can still be matched to a different backup, a bottleneck assignment.
+    """
+    if any(c.number_of_instances is None for c in collectors):
+        return {}
+
+    ids = [c.id for c in collectors]
+    use_hosts = not any(c.number_of_instances for c in collectors)
+    load = {c.id: (c.number_of_hosts or 0) if use_hosts else c.number_of_instances for c in collectors}
+    capacity = {}
+    for c in collectors:
+        if c.collector_size not in COLLECTOR_SIZE_CAPACITY:
+            logger.info('  Collector %s has unknown size %s, assuming medium', c.id, c.collector_size)
+        capacity[c.id] = COLLECTOR_SIZE_CAPACITY.get(c.collector_size, COLLECTOR_SIZE_CAPACITY['medium'])
+    if use_hosts:
+        # Scale to roughly 100 instances per device so utilisation stays comparable in the logs
+        load = {c_id: hosts * 100 for c_id, hosts in load.items()}
+
+    cost = {(f, b): (load[b] + load[f]) / capacity[b] for f in ids for b in ids if f != b}
+
+    def match(limit: float) -> dict:
+        """Kuhn's augmenting path matching of failed -> backup using only pairs within limit."""
+        backup_of = {}
+        failed_by = {}
+        candidates = {f: sorted((b for b in ids if f != b and cost[(f, b)] <= limit), key=lambda b: cost[(f, b)])
+                      for f in ids}
+
+        def augment(f, seen):
+            for b in candidates[f]:
+                if b in seen:
+                    continue
+                seen.add(b)
+                if b not in failed_by or augment(failed_by[b], seen):
+                    backup_of[f] = b
+                    failed_by[b] = f
+                    return True
+            return False
+
+        for f in ids:
+            if not augment(f, set()):
+                return {}
+        return backup_of
+
+    limits = sorted(set(cost.values()))
+    best = {}
+    lo, hi = 0, len(limits) - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        backups = match(limits[mid])
+        if backups:
+            best = backups
+            hi = mid - 1
+        else:
+            lo = mid + 1
+
+    for f, b in best.items():
+        logger.info('  Collector %s (%.0f%% used) -> backup %s (%.0f%% used, %.0f%% after failover)', f,
+            load[f] / capacity[f] * 100, b, load[b] / capacity[b] * 100, cost[(f, b)] * 100)
+    if best:
+        logger.info('  Worst case utilisation after a single failover: %.0f%%', max(cost[p] for p in best.items()) * 100)
+
+    return best
+
+def plan_failover_backups(collectors: list, strategy: str = 'balanced') -> dict:
+    """
+    Return {collector_id: backup_id} for failover in a collector group, using balanced_failover_backups()
+    when the strategy is balanced and the load metrics are available, or the ring otherwise.
+    """
+    if strategy == 'balanced':
+        backups = balanced_failover_backups(collectors)
+        if backups:
+            return backups
+        logger.warning('  Collector load metrics are missing, falling back to ring failover')
+
+    return ring_failover_backups([c.id for c in collectors])
+
+# Set collector group failover, every member is patched concurrently on the async engine
+def set_collector_grp_fo(cg_id: int, fo_state: str, no_sleep: bool, fo_strategy: str = 'balanced') -> bool:
     logger.info('Setting failover to %s on collector group ID %s', fo_state, cg_id)
 
     # Why are we sleeping a random time?  So we give all collectors a chance
@@ -531,89 +2319,1307 @@ def set_collector_grp_fo(cg_id: str, fo_state: str, no_sleep: bool) -> bool:
         sleep_max = 300
         sleep_time = randint(sleep_min, sleep_max)
         logger.info('  Sleeping %s seconds to allow all collectors to come up', sleep_time)
-        sleep(sleep_time)
-
-    gcgbi_response = gcgbi(cg_id)
-    if gcgbi_response and gcgbi_response.id and gcgbi_response.id == cg_id:
-        gcicg_response = gcicg(cg_id)
-        if gcicg_response and gcicg_response.items:
-            if gcicg_response.total < 2:
-                logger.error('  FAILURE: Not enough collectors to enable failover (%s)', gcicg_response.total)
-            else:
-                backup_index = 0
-                updated_data = gcicg_response.items
-                # This is a little tricky
-                for index, element in enumerate(updated_data):
-                    if index+1 >= gcicg_response.total:
-                        backup_index = 0
-                    else:
-                        backup_index += 1
-
-                    if fo_state == 'enable':
-                        updated_data[index].backup_agent_id = gcicg_response.items[backup_index].id
-                        updated_data[index].enable_fail_back = True
-                        updated_data[index].enable_fail_over_on_collector_device = False
-                    else:
-                        updated_data[index].backup_agent_id = 0
-                        updated_data[index].enable_fail_back = False
-                        updated_data[index].enable_fail_over_on_collector_device = False
-
-                    if pcbi(gcicg_response.items[index].id, updated_data[index]):
-                        logger.info('  SUCCESS: %s -> %s', updated_data[index].id, updated_data[index].backup_agent_id)
-                    else:
-                        logger.info('  FAILURE: %s -> %s', updated_data[index].id, updated_data[index].backup_agent_id)
-                        tripped = True
-
-                if not tripped:
-                    is_success = True
+        yield pause(sleep_time, 'failover')
+
+    gcicg_response = yield helper('gcicg', cg_id)
+    if not gcicg_response or not gcicg_response.items:
+        logger.error('  FAILURE: Error in gcicg() response.  Dump: %s', Dump(gcicg_response))
+        return False
+    if gcicg_response.total < 2:
+        logger.error('  FAILURE: Not enough collectors to enable failover (%s)', gcicg_response.total)
+        return False
+
+    members = gcicg_response.items
+    if fo_state == 'enable':
+        backups = plan_failover_backups(members, fo_strategy)
+    patches = []
+    for element in members:
+        if fo_state == 'enable':
+            backup_id = backups[element.id]
+            payload = {'backupAgentId': backup_id, 'enableFailBack': True, 'enableFailOverOnCollectorDevice': False}
         else:
-            logger.error('  FAILURE: Error in gcicg() response.  Dump: %s', gcicg_response)
-    else:
-        logger.error('FAILURE: Error in gcgbi() response.  Dump: %s', gcgbi_response)
+            backup_id = 0
+            payload = {'backupAgentId': 0, 'enableFailBack': False, 'enableFailOverOnCollectorDevice': False}
+        patches.append((element.id, backup_id, payload))
+
+    results = yield concurrently(*(helper('pcbi', c_id, payload, verify=False) for c_id, _, payload in patches))
+    for (c_id, backup_id, _), result in zip(patches, results):
+        if result:
+            logger.info('  SUCCESS: %s -> %s', c_id, backup_id)
+        else:
+            logger.info('  FAILURE: %s -> %s', c_id, backup_id)
 
-    return is_success
+    return all(results)
 
-# Add a collector device to a resource group by resource group ID
-def set_collector_dev_grp(c_id: int, dg_id: int) -> bool:
-    is_success = False
-    logger.info('Adding collector ID %s to device group %s', c_id, dg_id)
+set_collector_grp_fo, set_collector_grp_fo_async = both_engines(set_collector_grp_fo)
+
+def merge_host_group_ids(host_group_ids: str, add_dg_ids: list, remove_dg_ids: list = ()) -> str:
+    """
+    Return a device's comma separated hostGroupIds with groups added and removed, keeping the
+    existing groups in their current order.
+    """
+    remove = {str(dg_id) for dg_id in remove_dg_ids}
+    groups = [dg_id for dg_id in (host_group_ids or '').split(',') if dg_id and dg_id not in remove]
+    for dg_id in map(str, add_dg_ids):
+        if dg_id not in groups and dg_id not in remove:
+            groups.append(dg_id)
 
-    if wait_for_collector_assoc(c_id):
-        gcbi_response = gcbi(c_id)
-        gdbi_response = gdbi(gcbi_response.collector_device_id)
+    return ','.join(groups)
 
-        if gdbi_response and gdbi_response.id and gdbi_response.display_name:
-            updated_data = gdbi_response
-            new_hg_set = set((gdbi_response.host_group_ids + ',' + str(dg_id)).split(','))
-            new_hg = ",".join(new_hg_set)
-            updated_data.host_group_ids = new_hg
+def resolve_dg_paths(dg_paths: list) -> list:
+    """Return the device group IDs for a list of device group paths, or None if any can't be found."""
+    responses = yield concurrently(*(helper('gdgbn', dg_path, 'id,fullPath') for dg_path in dg_paths))
+    if not all(responses):
+        return None
 
-            if pdbi(gdbi_response.id, updated_data):
-                logger.info('  SUCCESS: %s', new_hg_set)
+    return [response.items[0].id for response in responses]
+
+resolve_dg_paths, resolve_dg_paths_async = both_engines(resolve_dg_paths)
+
+# Add a collector device to and/or remove it from resource groups by resource group ID,
+# collector_device_id as for set_collector_dev_cp()
+def set_collector_dev_grp(c_id: int, add_dg_ids: list, remove_dg_ids: list = (), collector_device_id: int = 0) -> bool:
+    is_success = False
+    logger.info('Adding collector ID %s to device groups %s, removing from %s', c_id, list(add_dg_ids), list(remove_dg_ids))
+
+    if not collector_device_id:
+        collector_device_id = yield helper('wait_for_collector_assoc', c_id)
+    if collector_device_id:
+        gdbi_response = yield helper('gdbi', collector_device_id, 'id,displayName,hostGroupIds')
+        if gdbi_response and gdbi_response.display_name:
+            new_hg = merge_host_group_ids(gdbi_response.host_group_ids, add_dg_ids, remove_dg_ids)
+            if not new_hg:
+                logger.error('  FAILURE: Refusing to remove device ID %s from all of its groups', gdbi_response.id)
+            elif new_hg == gdbi_response.host_group_ids:
+                logger.info('  SUCCESS: Already in the requested groups: %s', new_hg)
+                is_success = True
+            elif (yield helper('pdbi', gdbi_response.id, {'hostGroupIds': new_hg}, verify=False)):
+                logger.info('  SUCCESS: %s', new_hg)
                 is_success = True
             else:
-                logger.info('  FAILURE: %s', new_hg_set)
+                logger.info('  FAILURE: %s', new_hg)
         else:
-            logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', gdbi_response)
+            logger.error('  FAILURE: Error in gdbi() response.  Dump: %s', Dump(gdbi_response))
     else:
         logger.error('  FAILURE: Timed out waiting for collector to device association, or invalid collector id (%s)', c_id)
 
     return is_success
 
+set_collector_dev_grp, set_collector_dev_grp_async = both_engines(set_collector_dev_grp)
 
-def main():
-    global lm_api
-    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+@traced_async
+async def resolve_names_async(cg_name: str = '', dg_name: str = '', ec_name: str = '') -> dict:
+    """
+    Resolve any of a collector group name, device group path and escalation chain name to IDs,
+    all at the same time.  Returns a dict with cg_id, dg_id and ec_id keys for the names that were
+    given, with None for any that could not be resolved.
+    """
+    lookups = {}
+    if cg_name:
+        lookups['cg_id'] = gcgbn_async(cg_name, 'id,name')
+    if dg_name:
+        lookups['dg_id'] = gdgbn_async(dg_name, 'id,fullPath')
+    if ec_name:
+        lookups['ec_id'] = gecbn_async(ec_name, 'id,name')
+
+    responses = await asyncio.gather(*lookups.values())
+    resolved = {}
+    for key, response in zip(lookups, responses):
+        if key == 'cg_id':
+            resolved[key] = response.id if response else None
+        else:
+            resolved[key] = response.items[0].id if response else None
+
+    return resolved
+
+# Actions preflight() checks the arguments of before they start
+PREFLIGHT_ACTIONS = ('install', 'devgrp', 'devname', 'echain', 'snmp', 'cgab', 'cgfo', 'rad', 'bootstrap', 'watch')
+# How long preflight lookups by name stay in the name cache for the action to reuse
+PREFLIGHT_CACHE_TTL = 300
+
+def preflight(args: argparse.Namespace) -> list:
+    """
+    Check that the credentials work and that every collector, device, collector group, device
+    group and escalation chain the arguments refer to exists and can be read, all at the same
+    time on the async engine, before the action starts anything slow such as the installer
+    download.  Returns a description of each problem, or an empty list.  Names are looked up with
+    the same helpers and fields the actions use, so with name_cache_ttl set the action gets them
+    from the name cache.
+    """
+    def listed(value) -> list:
+        return [v for v in (value if isinstance(value, list) else [value]) if v]
+
+    # Where a name overrides an id (every action but devgrp and watch) only the name is checked
+    cg_names = listed(getattr(args, 'cg_name', None))
+    dg_names = listed(getattr(args, 'dg_name', None)) + listed(getattr(args, 'remove_dg_name', None))
+    overrides = args.action not in ('devgrp', 'watch')
+    cg_ids = [] if cg_names and overrides else listed(getattr(args, 'cg_id', None))
+    dg_ids = ([] if dg_names and overrides else listed(getattr(args, 'dg_id', None))) + listed(getattr(args, 'remove_dg_id', None))
+
+    checks = {}
+    for c_id in listed(getattr(args, 'collector_id', None)):
+        checks[f'collector ID {c_id}'] = helper('gcbi', c_id, 'id,hostname')
+    for d_id in listed(getattr(args, 'device_id', None)):
+        checks[f'device ID {d_id}'] = helper('gdbi', d_id, 'id,displayName')
+    for cg_id in cg_ids:
+        checks[f'collector group ID {cg_id}'] = helper('gcgbi', cg_id, 'id,name')
+    for cg_name in cg_names:
+        checks[f'collector group {cg_name}'] = helper('gcgbn', cg_name, 'id,name')
+    for dg_id in dg_ids:
+        checks[f'device group ID {dg_id}'] = helper('gdgbi', dg_id, 'id,fullPath')
+    for dg_name in dg_names:
+        checks[f'device group {dg_name}'] = helper('gdgbn', dg_name, 'id,fullPath')
+    for ec_name in listed(getattr(args, 'ec_name', None)):
+        checks[f'escalation chain {ec_name}'] = helper('gecbn', ec_name, 'id,name')
+
+    logger.info('Preflight checking credentials and %s references for %s', len(checks), args.action)
+    # The credentials are probed on their own so a 401/403 is reported once, not as every lookup failing
+    probe, *responses = yield concurrently(api('get_collector_list', fields='id', size=1), *checks.values(),
+                                           return_exceptions=True)
+    if isinstance(probe, ApiException):
+        if getattr(probe, 'status', 0) == 401:
+            return ['API credentials were rejected (401), check --access-id and --access-key']
+        if getattr(probe, 'status', 0) == 403:
+            return ['API token is not allowed to read collectors (403)']
+        return [f'API request failed: {probe}']
+    if isinstance(probe, BaseException):
+        raise probe
+
+    problems = []
+    for name, response in zip(checks, responses):
+        if isinstance(response, BaseException):
+            raise response
+        if not response:
+            problems.append(f'{name} was not found or can not be read')
+
+    return problems
+
+preflight, preflight_async = both_engines(preflight)
+
+def preflight_passed(args: argparse.Namespace) -> bool:
+    """Run preflight(), report any problems and return whether there were none."""
+    preflight_start = time.perf_counter()
+    problems = yield helper('preflight', args)
+    for problem in problems:
+        logger.error('  FAILURE: Preflight: %s', problem)
+        print(f'Preflight: {problem}')
+    if not problems:
+        logger.info('  SUCCESS: Preflight passed in %.2f s', time.perf_counter() - preflight_start)
+
+    return not problems
+
+preflight_passed, preflight_passed_async = both_engines(preflight_passed)
+
+async def run_action_checked_async(args: argparse.Namespace) -> bool:
+    """Run the action with the asyncio engine, after preflight() unless --no-preflight was given."""
+    if args.preflight and args.action in PREFLIGHT_ACTIONS and not await preflight_passed_async(args):
+        return False
+
+    return await run_action_async(args)
+
+async def list_all_async(list_method, page_size: int = 1000, **kwargs) -> list:
+    """
+    Return the items of every page of a list call on the portal's async_api, eg:
+    await list_all_async(portal().async_api.get_collector_list, fields='id', filter='...')
+    """
+    items = []
+    while True:
+        response = await list_method(size=page_size, offset=len(items), **kwargs)
+        page = response.items or []
+        items.extend(page)
+        if len(page) < page_size or (response.total is not None and len(items) >= response.total):
+            return items
+
+@traced_async
+async def get_autodiscovery_targets_async(device_ids: list = (), dg_id: int = 0, cg_id: int = 0) -> dict:
+    """
+    Return {device_id: verified} for the devices named directly, the devices directly in a device
+    group and the collector devices of a collector group's members.  Devices that came from a
+    group listing are known to exist and are marked verified.  Returns None if a group couldn't
+    be listed.
+    """
+    targets = {d_id: False for d_id in device_ids}
+
+    if dg_id:
+        logger.info('Listing devices in device group with ID %s', dg_id)
+        try:
+            devices = await list_all_async(portal().async_api.get_immediate_device_list_by_device_group_id, id=dg_id, fields='id')
+            logger.info('  SUCCESS: Found %s devices', len(devices))
+            targets.update({d.id: True for d in devices})
+        except ApiException as e:
+            logger.error('  LM API Exception: get_immediate_device_list_by_device_group_id(): %s', e)
+            return None
+
+    if cg_id:
+        logger.info('Listing collector devices in collector group with ID %s', cg_id)
+        try:
+            collectors = await list_all_async(portal().async_api.get_collector_list, fields='id,collectorDeviceId',
+                filter='collectorGroupId:"' + str(cg_id) + '"')
+            logger.info('  SUCCESS: Found %s collectors', len(collectors))
+            targets.update({c.collector_device_id: True for c in collectors if c.collector_device_id})
+        except ApiException as e:
+            logger.error('  LM API Exception: get_collector_list(): %s', e)
+            return None
+
+    return targets
+
+def load_autodiscovery_state(state_file: str, window: int) -> dict:
+    """Return {device_id: epoch} of autodiscovery runs scheduled within the last window seconds."""
+    try:
+        with open(state_file) as f:
+            scheduled = {int(k): v for k, v in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+    cutoff = time.time() - window
+    return {d_id: when for d_id, when in scheduled.items() if when >= cutoff}
+
+def save_autodiscovery_state(state_file: str, scheduled: dict) -> None:
+    """Write the autodiscovery schedule times back, replacing the file atomically."""
+    tmp_file = f'{state_file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(scheduled, f)
+        os.replace(tmp_file, state_file)
+    except OSError as e:
+        logger.error('  FAILURE: Could not save autodiscovery state to %s: %s', state_file, e)
+
+def update_autodiscovery_state(state_file: str, window: int, update):
+    """
+    Load the autodiscovery schedule times, let update() change them and save them, holding an
+    exclusive lock throughout so rad runs at the same time don't lose each other's changes.
+    Returns what update() returned.  The lock is on state_file.lock, as the state file itself is
+    replaced on every save.  Nothing awaits while the lock is held, so this is safe to call from
+    concurrent tasks in one process too.
+    """
+    import fcntl
+    lock = None
+    try:
+        lock = open(f'{state_file}.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    except OSError as e:
+        logger.warning('  Could not lock autodiscovery state %s, continuing without: %s', state_file, e)
+
+    try:
+        scheduled = load_autodiscovery_state(state_file, window)
+        result = update(scheduled)
+        save_autodiscovery_state(state_file, scheduled)
+    finally:
+        if lock:
+            lock.close()
+
+    return result
+
+@traced_async
+async def run_autodiscovery_batch_async(targets: dict, window: int, state_file: str, max_parallel: int) -> bool:
+    """
+    Schedule autodiscovery on many devices, skipping any that were scheduled less than window
+    seconds ago (according to state_file) and running at most max_parallel at a time.  Devices are
+    claimed in state_file before they are scheduled, so a run starting meanwhile skips them too,
+    and the claims of any that fail are dropped again afterwards.
+
+        targets : {device_id: verified} from get_autodiscovery_targets_async().
+    """
+    claimed_at = time.time()
+    def claim(scheduled):
+        pending = [d_id for d_id in targets if d_id not in scheduled]
+        scheduled.update({d_id: claimed_at for d_id in pending})
+        return pending
+
+    pending = update_autodiscovery_state(state_file, window, claim)
+    recent = [d_id for d_id in targets if d_id not in pending]
+    logger.info('Scheduling auto-discovery on %s devices, skipping %s scheduled in the last %s s',
+        len(pending), len(recent), window)
+    if recent:
+        logger.info('  Skipped: %s', recent)
+
+    slots = asyncio.Semaphore(max_parallel)
+    async def schedule(d_id):
+        async with slots:
+            return await run_autodiscovery_async(d_id, verify=not targets[d_id])
+
+    results = await asyncio.gather(*(schedule(d_id) for d_id in pending))
+    failed = [d_id for d_id, result in zip(pending, results) if not result]
+    if failed:
+        def release(scheduled):
+            for d_id in failed:
+                if scheduled.get(d_id) == claimed_at:
+                    del scheduled[d_id]
+        update_autodiscovery_state(state_file, window, release)
+    logger.info('  Scheduled %s of %s devices', sum(results), len(pending))
+
+    return all(results)
+
+# Local inventory snapshot kept by the sync action and read by the query action.  Collectors and
+# devices have updatedOn, so after the first sync only records changed since the previous one
+# are fetched, less INVENTORY_SKEW seconds for clock skew between us and the portal.  Groups have
+# no such field, but there are few of them and only the columns kept are fetched.  Records that
+# were deleted are found by listing IDs alone.
+INVENTORY_SKEW = 300
+# Most collector device IDs put in one device list filter, so the URL stays short
+INVENTORY_ID_BATCH = 100
+INVENTORY_FIELDS = {
+    'collectors': 'id,description,hostname,collectorGroupId,collectorGroupName,backupAgentId,enableFailBack,'
+                  'enableFailOverOnCollectorDevice,collectorDeviceId,collectorSize,numberOfInstances,'
+                  'numberOfHosts,isDown,build,escalatingChainId,updatedOn',
+    'collector_groups': 'id,name,description,autoBalance,autoBalanceInstanceCountThreshold,numOfCollectors',
+    'device_groups': 'id,name,fullPath,parentId,numOfHosts',
+    'devices': 'id,name,displayName,hostGroupIds,currentCollectorId,preferredCollectorId,updatedOn',
+}
+INVENTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS collectors (id INTEGER PRIMARY KEY, collector_group_id INTEGER,
+    collector_device_id INTEGER, backup_agent_id INTEGER, data TEXT);
+CREATE INDEX IF NOT EXISTS collectors_group ON collectors (collector_group_id);
+CREATE TABLE IF NOT EXISTS collector_groups (id INTEGER PRIMARY KEY, name TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS collector_groups_name ON collector_groups (name);
+CREATE TABLE IF NOT EXISTS device_groups (id INTEGER PRIMARY KEY, full_path TEXT, parent_id INTEGER, data TEXT);
+CREATE INDEX IF NOT EXISTS device_groups_path ON device_groups (full_path);
+CREATE TABLE IF NOT EXISTS devices (id INTEGER PRIMARY KEY, collector_id INTEGER, data TEXT);
+CREATE TABLE IF NOT EXISTS device_group_members (device_id INTEGER, group_id INTEGER,
+    PRIMARY KEY (group_id, device_id));
+"""
+
+def open_inventory(db_path: str, create: bool = True):
+    """Open the inventory database, creating it and its directory if needed and create is set."""
+    import sqlite3
+    if not create and not os.path.exists(db_path):
+        raise FileNotFoundError(f'No inventory at {db_path}, run the sync action first')
+    if create:
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    if create:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(INVENTORY_SCHEMA)
+    return conn
+
+def replace_inventory_rows(conn, table: str, rows: list, keep_ids=None) -> None:
+    """
+    Insert or replace rows, tuples in the table's column order, then drop every row whose ID is
+    not in keep_ids unless keep_ids is None.
+    """
+    if rows:
+        marks = ','.join('?' * len(rows[0]))
+        conn.executemany(f'INSERT OR REPLACE INTO {table} VALUES ({marks})', rows)
+    if keep_ids is not None:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS keep_ids (id INTEGER PRIMARY KEY)')
+        conn.execute('DELETE FROM keep_ids')
+        conn.executemany('INSERT OR IGNORE INTO keep_ids VALUES (?)', ((i,) for i in keep_ids))
+        conn.execute(f'DELETE FROM {table} WHERE id NOT IN (SELECT id FROM keep_ids)')
+
+@traced_async
+async def sync_inventory_async(db_path: str, full: bool = False) -> bool:
+    """
+    Mirror collectors, collector groups, device groups and collector devices into the SQLite
+    inventory at db_path.  Only records changed since the last sync are fetched unless full.
+    """
+    conn = open_inventory(db_path)
+    meta = dict(conn.execute('SELECT key, value FROM meta'))
+    synced_at = int(time.time())
+    since = 0 if full or 'synced_at' not in meta else int(meta['synced_at']) - INVENTORY_SKEW
+    updated_filter = f'updatedOn>{since}' if since > 0 else ''
+    logger.info('Syncing inventory to %s, %s', db_path, f'changes since {since}' if since else 'full')
+
+    try:
+        collector_ids, collectors, collector_groups, device_groups = await asyncio.gather(
+            list_all_async(portal().async_api.get_collector_list, fields='id'),
+            list_all_async(portal().async_api.get_collector_list, fields=INVENTORY_FIELDS['collectors'], filter=updated_filter),
+            list_all_async(portal().async_api.get_collector_group_list, fields=INVENTORY_FIELDS['collector_groups']),
+            list_all_async(portal().async_api.get_device_group_list, fields=INVENTORY_FIELDS['device_groups']))
+    except ApiException as e:
+        logger.error('  FAILURE: Could not list collectors and groups: %s', e)
+        conn.close()
+        return False
+
+    with conn:
+        replace_inventory_rows(conn, 'collectors',
+            [(c.id, c.collector_group_id, c.collector_device_id, c.backup_agent_id, json.dumps(c.to_dict()))
+             for c in collectors],
+            [c.id for c in collector_ids])
+        replace_inventory_rows(conn, 'collector_groups',
+            [(g.id, g.name, json.dumps(g.to_dict())) for g in collector_groups],
+            [g.id for g in collector_groups])
+        replace_inventory_rows(conn, 'device_groups',
+            [(g.id, g.full_path, g.parent_id, json.dumps(g.to_dict())) for g in device_groups],
+            [g.id for g in device_groups])
+
+    # Collector devices: new ones are fetched by ID, known ones only if they changed
+    collector_devices = dict(conn.execute(
+        'SELECT collector_device_id, id FROM collectors WHERE collector_device_id > 0'))
+    known_ids = {row[0] for row in conn.execute('SELECT id FROM devices')}
+    new_ids = [d_id for d_id in collector_devices if d_id not in known_ids]
+    devices = []
+    responses = await asyncio.gather(*(portal().async_api.get_device_by_id(d_id, fields=INVENTORY_FIELDS['devices'])
+                                       for d_id in new_ids), return_exceptions=True)
+    for d_id, response in zip(new_ids, responses):
+        if isinstance(response, ApiException):
+            # Left out, and so tried again by the next sync
+            logger.warning('  Could not get collector device %s: %s', d_id, response)
+        elif isinstance(response, BaseException):
+            raise response
+        else:
+            devices.append(response)
+    try:
+        known_devices = sorted(d_id for d_id in collector_devices if d_id in known_ids)
+        if updated_filter and known_devices:
+            # Only the collector devices are asked for, not every device in the portal that changed
+            device_filters = [f'{updated_filter},id:' + '|'.join(f'"{d_id}"' for d_id in known_devices[i:i + INVENTORY_ID_BATCH])
+                              for i in range(0, len(known_devices), INVENTORY_ID_BATCH)]
+            changed = await asyncio.gather(*(list_all_async(portal().async_api.get_device_list,
+                                                            fields=INVENTORY_FIELDS['devices'], filter=device_filter)
+                                             for device_filter in device_filters))
+            devices.extend(d for batch in changed for d in batch if d.id in collector_devices)
+    except ApiException as e:
+        logger.error('  FAILURE: Could not list changed devices: %s', e)
+        conn.close()
+        return False
+
+    with conn:
+        replace_inventory_rows(conn, 'devices',
+            [(d.id, collector_devices[d.id], json.dumps(d.to_dict())) for d in devices],
+            collector_devices)
+        conn.executemany('DELETE FROM device_group_members WHERE device_id = ?', ((d.id,) for d in devices))
+        conn.execute('DELETE FROM device_group_members WHERE device_id NOT IN (SELECT id FROM devices)')
+        conn.executemany('INSERT OR IGNORE INTO device_group_members VALUES (?, ?)',
+            ((d.id, int(g)) for d in devices for g in (d.host_group_ids or '').split(',') if g))
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('synced_at', str(synced_at)))
+    conn.close()
+
+    logger.info('  SUCCESS: Synced %s of %s collectors, %s collector groups, %s device groups and %s of %s collector devices',
+        len(collectors), len(collector_ids), len(collector_groups), len(device_groups), len(devices), len(collector_devices))
+    return True
+
+def query_inventory(args: argparse.Namespace) -> bool:
+    """
+    Answer the query action from the local inventory without calling the API, printing one JSON
+    object per matching record.
+    """
+    import sqlite3
+    try:
+        conn = open_inventory(args.db, create=False)
+        synced_at = int(dict(conn.execute('SELECT key, value FROM meta')).get('synced_at', 0))
+    except (OSError, sqlite3.Error) as e:
+        print(f'Cannot read inventory {args.db}: {e}')
+        return False
+
+    age = int(time.time()) - synced_at
+    logger.info('Querying %s from inventory synced %s s ago', args.what, age)
+    if args.max_age and age > args.max_age:
+        print(f'Inventory {args.db} was last synced {age} s ago, more than --max-age {args.max_age}')
+        conn.close()
+        return False
+
+    cg_id = args.cg_id
+    if args.cg_name:
+        row = conn.execute('SELECT id FROM collector_groups WHERE name = ?', (args.cg_name,)).fetchone()
+        if row is None:
+            print(f'Collector group {args.cg_name} is not in the inventory')
+            conn.close()
+            return False
+        cg_id = row[0]
+
+    if args.what == 'collectors' or args.what == 'failover':
+        sql, params = 'SELECT data FROM collectors', ()
+        if cg_id:
+            sql, params = sql + ' WHERE collector_group_id = ?', (cg_id,)
+        records = [json.loads(row[0]) for row in conn.execute(sql + ' ORDER BY id', params)]
+        if args.what == 'failover':
+            hostnames = dict(conn.execute('SELECT id, json_extract(data, \'$.hostname\') FROM collectors'))
+            records = [{'id': c['id'], 'hostname': c.get('hostname'), 'backupAgentId': c.get('backupAgentId'),
+                        'backupHostname': hostnames.get(c.get('backupAgentId')),
+                        'enableFailBack': c.get('enableFailBack')} for c in records]
+    elif args.what == 'collector-groups':
+        sql, params = 'SELECT data FROM collector_groups', ()
+        if cg_id:
+            sql, params = sql + ' WHERE id = ?', (cg_id,)
+        records = [json.loads(row[0]) for row in conn.execute(sql + ' ORDER BY id', params)]
+    elif args.what == 'device-groups':
+        sql, params = 'SELECT data FROM device_groups', ()
+        if args.dg_name:
+            sql, params = sql + ' WHERE full_path = ?', (dg_full_path(args.dg_name),)
+        records = [json.loads(row[0]) for row in conn.execute(sql + ' ORDER BY full_path', params)]
+    else:
+        sql, params = 'SELECT devices.data FROM devices', []
+        where = []
+        if args.dg_name:
+            sql += (' JOIN device_group_members ON device_group_members.device_id = devices.id'
+                    ' JOIN device_groups ON device_groups.id = device_group_members.group_id')
+            where.append('device_groups.full_path = ?')
+            params.append(dg_full_path(args.dg_name))
+        if cg_id:
+            where.append('devices.collector_id IN (SELECT id FROM collectors WHERE collector_group_id = ?)')
+            params.append(cg_id)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        records = [json.loads(row[0]) for row in conn.execute(sql + ' ORDER BY devices.id', params)]
+    conn.close()
+
+    for record in records:
+        print(json.dumps(record))
+    logger.info('  SUCCESS: %s %s from inventory', len(records), args.what)
+    return True
+
+# Fields the watch action polls, and the events it emits when they change.  Everything else about
+# a collector is left out of the list calls.
+WATCH_FIELDS = 'id,hostname,collectorGroupId,isDown,backupAgentId,collectorDeviceId,build'
+
+def diff_collector_states(old: dict, new: dict) -> list:
+    """
+    Compare two polls of {collector id: collector dict} and return the change events between
+    them, without the ts field.
+    """
+    events = []
+    for c_id in old.keys() - new.keys():
+        events.append({'event': 'removed', 'collector_id': c_id, 'hostname': old[c_id].get('hostname')})
+    for c_id, collector in new.items():
+        event = {'collector_id': c_id, 'hostname': collector.get('hostname')}
+        previous = old.get(c_id)
+        if previous is None:
+            events.append({'event': 'added', **event, 'is_down': collector.get('isDown'),
+                           'backup_agent_id': collector.get('backupAgentId')})
+            continue
+        if previous.get('isDown') != collector.get('isDown'):
+            events.append({'event': 'down' if collector.get('isDown') else 'up', **event})
+        if previous.get('backupAgentId') != collector.get('backupAgentId'):
+            events.append({'event': 'failover_changed', **event,
+                           'old': previous.get('backupAgentId'), 'new': collector.get('backupAgentId')})
+        if previous.get('collectorDeviceId') != collector.get('collectorDeviceId'):
+            events.append({'event': 'device_lost' if not collector.get('collectorDeviceId') else 'device_changed',
+                           **event, 'old': previous.get('collectorDeviceId'), 'new': collector.get('collectorDeviceId')})
+        if previous.get('build') != collector.get('build'):
+            events.append({'event': 'build_changed', **event, 'old': previous.get('build'), 'new': collector.get('build')})
+
+    return events
+
+async def poll_collector_groups_async(cg_ids: list) -> dict:
+    """One field-projected, paginated list call per collector group, returns {collector id: collector dict}."""
+    pages = await asyncio.gather(*(list_all_async(portal().async_api.get_collector_list, fields=WATCH_FIELDS,
+                                                  filter='collectorGroupId:"' + str(cg_id) + '"')
+                                   for cg_id in cg_ids))
+    return {c.id: c.to_dict() for page in pages for c in page}
+
+async def watch_collectors_async(args: argparse.Namespace) -> bool:
+    """
+    Poll the collectors of the given collector groups until SIGTERM/SIGINT, or --count polls, and
+    print each change as a JSON line.  The interval halves towards --min-interval while things are
+    changing and grows back towards --max-interval while they aren't, or after a failed poll.
+    """
+    import signal
+
+    cg_ids = list(args.cg_id)
+    if args.cg_name:
+        groups = await asyncio.gather(*(gcgbn_async(cg_name, 'id,name') for cg_name in args.cg_name))
+        if not all(groups):
+            print(f'Cannot resolve all of {args.cg_name} to collector group ids')
+            return False
+        cg_ids.extend(group.id for group in groups)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    logger.info('Watching collectors in collector groups %s', cg_ids)
+    interval = args.interval
+    state = None
+    polls = 0
+    while not stop.is_set():
+        polls += 1
+        try:
+            with trace_span('poll', 'watch', groups=len(cg_ids)):
+                current = await poll_collector_groups_async(cg_ids)
+        except (*ApiException, OSError, asyncio.TimeoutError) as e:
+            logger.warning('  Poll of collector groups %s failed: %s', cg_ids, e)
+            current = None
+            interval = min(interval * 2, args.max_interval)
+
+        if current is not None:
+            if state is None:
+                events = [{'event': 'present', 'collector_id': c_id, 'hostname': c.get('hostname'),
+                           'is_down': c.get('isDown'), 'backup_agent_id': c.get('backupAgentId'),
+                           'collector_device_id': c.get('collectorDeviceId')}
+                          for c_id, c in current.items()] if args.initial else []
+            else:
+                events = diff_collector_states(state, current)
+                if events:
+                    interval = max(interval / 2, args.min_interval)
+                else:
+                    interval = min(interval * 1.5, args.max_interval)
+            state = current
+
+            ts = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            for event in events:
+                print(json.dumps({'ts': ts, 'portal': portal().name, **event}), flush=True)
+            logger.info('  Poll %s: %s collectors, %s events, next in %.1f s', polls, len(current), len(events), interval)
+
+        if args.count and polls >= args.count:
+            break
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+    return state is not None
+
+class Step:
+    """
+    One node of a step graph for run_step_graph().
+
+        name   : Unique step name, used in logs and by other steps' deps.
+        deps   : Names of the steps that have to succeed before this one can start.
+        func   : Coroutine function taking the dict of results so far, returning a truthy value
+                 on success.  The value is stored in that dict under the step's name.
+        inputs : Function taking the same dict and returning everything the step's outcome
+                 depends on, as JSON-able values.  Only steps with inputs are journaled, and
+                 their result has to be JSON-able too.
+        check  : Optional coroutine function taking the results so far and the journaled result,
+                 returning whether it still holds.  It should be cheaper than running the step.
+    """
+    __slots__ = ('name', 'deps', 'func', 'inputs', 'check')
+
+    def __init__(self, name: str, deps: tuple, func, inputs=None, check=None):
+        self.name = name
+        self.deps = tuple(deps)
+        self.func = func
+        self.inputs = inputs
+        self.check = check
+
+class StepJournal:
+    """
+    Steps of a step graph that finished, with the hash of their inputs and their result, kept in
+    a JSON file that is rewritten after every step.  A later run of the same graph can take a
+    step's result from here instead of running it again, as long as its inputs hash the same.
+    Inputs can include secrets such as SNMP tokens, so they are hashed with an HMAC keyed by a
+    random salt of the journal's own, and the file is only readable by its owner.
+
+        path : Journal file, created with its directory if needed.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.salt = None
+        try:
+            with open(path) as f:
+                document = json.load(f)
+            self.entries = document.get('steps', {})
+            self.salt = document.get('salt')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning('  Ignoring unreadable journal %s: %s', path, e)
+        if not isinstance(self.salt, str) or not self.salt:
+            # A journal without a salt of its own can't match any inputs, start it over
+            self.salt = os.urandom(16).hex()
+            self.entries = {}
+
+    def hash(self, inputs: dict) -> str:
+        """Hash of a step's inputs, stored in the journal instead of the inputs themselves."""
+        message = json.dumps(inputs, sort_keys=True, default=str).encode()
+        return hmac.new(self.salt.encode(), message, hashlib.sha256).hexdigest()
+
+    def lookup(self, name: str, inputs_hash: str) -> tuple:
+        """Return (True, result) if the step finished with the same inputs, else (False, None)."""
+        entry = self.entries.get(name)
+        if entry and entry.get('inputs') == inputs_hash:
+            return True, entry.get('result')
+        return False, None
+
+    def record(self, name: str, inputs_hash: str, result) -> None:
+        """Remember that a step finished and write the journal out."""
+        self.entries[name] = {'inputs': inputs_hash, 'result': result, 'finished': int(time.time())}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+            tmp_file = f'{self.path}.tmp'
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'salt': self.salt, 'steps': self.entries}, f, indent=1)
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logger.warning('  Could not write journal %s: %s', self.path, e)
+
+async def run_step_graph(steps: list, journal: StepJournal = None) -> dict:
+    """
+    Run a list of Steps, each one as soon as all of its dependencies have succeeded, so steps that
+    don't depend on each other run concurrently.  A step whose dependency failed or was skipped
+    is skipped.  Steps have to be listed after their dependencies.  With a journal, steps that
+    already finished with the same inputs, and whose check passes, aren't run again.
+
+    Returns a dict of step name -> (state, result, seconds), state being ok, cached, failed or
+    skipped.
+    """
+    tasks = {}
+    report = {}
+    results = {}
+
+    async def run_step(step):
+        for dep in step.deps:
+            if not await tasks[dep]:
+                logger.warning('Skipping step %s, it depends on %s which did not succeed', step.name, dep)
+                report[step.name] = ('skipped', None, 0.0)
+                return False
+
+        set_log_context(step=step.name)
+        step_start = time.perf_counter()
+        inputs_hash = None
+        if journal is not None and step.inputs is not None:
+            inputs_hash = journal.hash(step.inputs(results))
+            found, cached = journal.lookup(step.name, inputs_hash)
+            if found and step.check is not None:
+                # A check that can't tell is a miss, the step itself decides whether it fails
+                try:
+                    found = await step.check(results, cached)
+                except Exception as e:
+                    logger.warning('  Could not check journaled step %s, running it again: %s', step.name, e)
+                    found = False
+            if found:
+                elapsed = time.perf_counter() - step_start
+                results[step.name] = cached
+                report[step.name] = ('cached', cached, elapsed)
+                logger.info('Reusing step %s from journal: %s', step.name, cached)
+                return True
+
+        logger.info('Starting step %s', step.name)
+        with trace_span(step.name, 'step') as span:
+            try:
+                result = await step.func(results)
+            except Exception:
+                logger.exception('  FAILURE: Unhandled exception in step %s', step.name)
+                result = None
+            span.set('ok', bool(result))
+        elapsed = time.perf_counter() - step_start
+
+        results[step.name] = result
+        report[step.name] = ('ok' if result else 'failed', result, elapsed)
+        if inputs_hash is not None and result:
+            journal.record(step.name, inputs_hash, result)
+        logger.info('Finished step %s (%s) in %.2f s', step.name, report[step.name][0], elapsed)
+        return bool(result)
+
+    for step in steps:
+        unknown = [dep for dep in step.deps if dep not in tasks]
+        if unknown:
+            raise ValueError(f'Step {step.name} depends on {unknown} which are not defined before it')
+        tasks[step.name] = asyncio.ensure_future(run_step(step))
+    await asyncio.gather(*tasks.values())
+
+    return report
+
+def build_bootstrap_steps(args: argparse.Namespace, skip_install: bool = False) -> list:
+    """
+    Return the step graph for the bootstrap action.  Only the steps the arguments ask for are
+    included.  Name resolution and the escalation chain don't need the collector installed, so
+    they run while the installer downloads.  The association wait only happens once, and devname,
+    snmp and devgrp all start from its collector_device_id.  snmp follows devname so that the
+    autodiscovery it schedules uses the device's final IP address.  With skip_install, or
+    --skip-install, the download and install steps are left out.
+    """
+    c_id = args.collector_id
+
+    async def resolve(results):
+        resolved = await resolve_names_async(dg_name=args.dg_name, ec_name=args.ec_name)
+        if args.dg_id and not args.dg_name:
+            resolved['dg_id'] = args.dg_id
+        if None in resolved.values():
+            logger.error('  FAILURE: Could not resolve all names: %s', resolved)
+            return None
+        return resolved or True
+
+    async def collector(results):
+        return await gcbi_async(c_id, 'id,hostname')
+
+    async def download(results):
+        return await get_collector_installer_async(c_id, args.os_arch, args.size, args.use_ea)
+
+    async def install(results):
+        return await run_collector_installer_async(results['download'])
+
+    async def assoc(results):
+        return await wait_for_collector_assoc_async(c_id)
+
+    async def echain(results):
+        return await pcbi_async(c_id, {'escalatingChainId': results['resolve']['ec_id']}, verify=False)
+
+    # Cheap GETs confirming journaled results still hold before they are reused
+    async def check_resolve(results, cached):
+        if not isinstance(cached, dict):
+            return True
+        try:
+            if cached.get('dg_id') and args.dg_name:
+                group = await portal().async_api.get_device_group_by_id(cached['dg_id'], fields='id,fullPath')
+                if group.full_path != dg_full_path(args.dg_name):
+                    return False
+            if cached.get('ec_id'):
+                chain = await portal().async_api.get_escalation_chain_by_id(cached['ec_id'], fields='id,name')
+                if chain.name != args.ec_name:
+                    return False
+        except ApiException as e:
+            logger.info('  Journaled names no longer resolve: %s', e)
+            return False
+        return True
+
+    async def check_assoc(results, cached):
+        collector = await gcbi_async(c_id, 'id,collectorDeviceId')
+        return bool(collector) and collector.collector_device_id == cached
+
+    async def check_echain(results, cached):
+        collector = await gcbi_async(c_id, 'id,escalatingChainId')
+        return bool(collector) and collector.escalating_chain_id == results['resolve']['ec_id']
+
+    async def check_devgrp(results, cached):
+        device = await gdbi_async(results['assoc'], 'id,displayName,hostGroupIds')
+        return bool(device) and str(results['resolve']['dg_id']) in (device.host_group_ids or '').split(',')
+
+    async def check_devname(results, cached):
+        device = await gdbi_async(results['assoc'], 'id,displayName,name')
+        return (bool(device) and device.display_name == (args.display_name or results['collector'].hostname)
+                and device.name == (args.ip_address or get_dflt_ipaddr()))
+
+    async def check_snmp(results, cached):
+        device = await gdbi_async(results['assoc'], 'id,displayName,customProperties')
+        if not device:
+            return False
+        own = {prop.name: prop.value for prop in device.custom_properties or ()}
+        return all(own.get(prop['name']) in (prop['value'], MASKED_PROPERTY_VALUE) for prop in build_snmp_props(args))
+
+    def host_inputs(results):
+        facts = get_host_facts()
+        return {'display_name': args.display_name, 'ip_address': args.ip_address, 'device': results['assoc'],
+                'hostname': facts['hostname'], 'ipaddr': facts['ipaddr']}
+
+    async def devname(results):
+        return await set_collector_dev_name_async(c_id, args.display_name, args.ip_address)
+
+    async def snmp(results):
+        return await set_collector_dev_cp_async(c_id, build_snmp_props(args), results['assoc'])
+
+    async def devgrp(results):
+        return await set_collector_dev_grp_async(c_id, [results['resolve']['dg_id']], collector_device_id=results['assoc'])
+
+    steps = [Step('resolve', (), resolve, lambda results: {'dg_name': args.dg_name, 'dg_id': args.dg_id,
+                                                           'ec_name': args.ec_name}, check_resolve),
+             Step('collector', (), collector)]
+    if skip_install or args.skip_install:
+        steps.append(Step('assoc', ('collector',), assoc, lambda results: {'collector_id': c_id}, check_assoc))
+    else:
+        steps.append(Step('download', ('collector',), download))
+        # Not journaled, bootstrap_async() already skips the install whenever the local one is current
+        steps.append(Step('install', ('download',), install))
+        steps.append(Step('assoc', ('install',), assoc, lambda results: {'collector_id': c_id}, check_assoc))
+    if args.ec_name:
+        steps.append(Step('echain', ('resolve', 'collector'), echain,
+                          lambda results: {'ec_id': results['resolve']['ec_id']}, check_echain))
+    steps.append(Step('devname', ('assoc',), devname, host_inputs, check_devname))
+    if args.snmp_auth_token and args.snmp_priv_token:
+        # Only a hash of the inputs is journaled, the tokens themselves are not written out
+        steps.append(Step('snmp', ('assoc', 'devname'), snmp,
+                          lambda results: {'props': build_snmp_props(args), 'device': results['assoc']}, check_snmp))
+    if args.dg_id or args.dg_name:
+        steps.append(Step('devgrp', ('assoc', 'resolve'), devgrp,
+                          lambda results: {'dg_id': results['resolve']['dg_id'], 'device': results['assoc']},
+                          check_devgrp))
+
+    return steps
+
+async def bootstrap_async(args: argparse.Namespace) -> bool:
+    """
+    Run the bootstrap step graph and log a summary of how each step went.  Unless --no-journal or
+    --force is given, finished steps are journaled per collector under --journal-dir, and a re-run
+    after an interruption reuses the ones that still hold.  The install is skipped whenever the
+    local install is current, journaled or not.
+    """
+    logger.info('Bootstrapping collector ID %s', args.collector_id)
+    bootstrap_start = time.perf_counter()
+
+    journal = None
+    if not args.no_journal:
+        journal = StepJournal(os.path.join(args.journal_dir, f'bootstrap-{args.collector_id}.json'))
+        if args.force:
+            journal.entries.clear()
+
+    skip_install = False
+    if not args.skip_install and not args.force:
+        collector = await gcbi_async(args.collector_id, 'id,hostname,build,isDown')
+        skip_install = local_install_is_current(args.collector_id, collector, args.install_dir)
+        if skip_install:
+            logger.info('  Skipping download and install, use --force to reinstall')
+
+    report = await run_step_graph(build_bootstrap_steps(args, skip_install), journal)
+
+    logger.info('Bootstrap finished in %.2f s:', time.perf_counter() - bootstrap_start)
+    for name, (state, _, elapsed) in report.items():
+        logger.info('  %-10s %-8s %7.2f s', name, state, elapsed)
+
+    return all(state in ('ok', 'cached') for state, _, _ in report.values())
+
+def bench_backends(args: argparse.Namespace) -> bool:
+    """
+    Time the hot read helpers against both backends and print wall-clock and CPU time per call,
+    then check that both backends returned the same values for the fields the helpers care about.
+    """
+    checks = [('gcbi', lambda: gcbi(args.collector_id),
+               ('id', 'hostname', 'collector_device_id', 'collector_group_id', 'backup_agent_id'))]
+    if args.device_id:
+        checks.append(('gdbi', lambda: gdbi(args.device_id),
+                       ('id', 'display_name', 'name', 'host_group_ids')))
+    if args.cg_id:
+        checks.append(('gcicg', lambda: gcicg(args.cg_id), ('total',)))
+
+    results = {}
+    print(f'{"backend":8} {"helper":6} {"calls":>5} {"wall ms/call":>13} {"cpu ms/call":>12}')
+    for backend in ('sdk', 'raw'):
+        portal().api = build_lm_api(backend, portal().company, portal().access_id, portal().access_key)
+        for name, func, _ in checks:
+            func()  # Warm up the connection pool, not counted
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            for _ in range(args.iterations):
+                response = func()
+            wall = (time.perf_counter() - wall_start) / args.iterations * 1000
+            cpu = (time.process_time() - cpu_start) / args.iterations * 1000
+            print(f'{backend:8} {name:6} {args.iterations:5} {wall:13.2f} {cpu:12.2f}')
+            results[(backend, name)] = response
+
+    is_success = True
+    for name, func, fields in checks:
+        for field in fields:
+            sdk_value = getattr(results[('sdk', name)], field, None)
+            raw_value = getattr(results[('raw', name)], field, None)
+            if sdk_value != raw_value:
+                print(f'MISMATCH {name}.{field}: sdk={sdk_value!r} raw={raw_value!r}')
+                is_success = False
+        if name == 'gcicg':
+            sdk_ids = [i.id for i in results[('sdk', name)].items]
+            raw_ids = [i.id for i in results[('raw', name)].items]
+            if sdk_ids != raw_ids:
+                print(f'MISMATCH gcicg item ids: sdk={sdk_ids} raw={raw_ids}')
+                is_success = False
+
+    return is_success
+
+class MockPortal:
+    """
+    Just enough of the LogicMonitor REST API, served on localhost over asyncio streams, for the
+    loadtest action to run bootstrap and cgfo against.  It holds one collector group of collectors,
+    each with a collector device it only associates with assoc_delay seconds after the collector is
+    first looked up, plus a device group and an escalation chain for bootstrap to resolve.  Every
+    resource has the fields the SDK's models require, so the SDK client can be pointed at it too.
+
+    Requests are counted per method in fixed windows and, past the method's limit, answered with
+    429 and the X-Rate-Limit-* headers the portal sends.  Signatures are not checked.
+
+        collectors  : Number of collectors in the group, their IDs are 1 to collectors.
+        assoc_delay : (min, max) seconds for a collector's device association, picked per collector.
+        latency     : Seconds added to every response.
+        window      : Length of the rate limit window in seconds.
+        limits      : {method: requests per window}, RATE_LIMITS by default.
+    """
+    # Per method requests per minute of a LogicMonitor portal
+    RATE_LIMITS = {'GET': 500, 'POST': 200, 'PUT': 200, 'PATCH': 250, 'DELETE': 300}
+    CG_NAME = 'Load Test Collectors'
+    DG_NAME = 'Load Test/Collectors'
+    EC_NAME = 'Load Test'
+
+    def __init__(self, collectors: int, assoc_delay: tuple = (60, 90), latency: float = 0.05,
+                 window: float = 60, limits: dict = None):
+        self.assoc_delay = assoc_delay
+        self.latency = latency
+        self.window = window
+        self.limits = limits or self.RATE_LIMITS
+        self.stats = {'calls': {}, 'throttled': 0}
+        self._window_start = {}
+        self._window_count = {}
+        self._assoc_at = {}
+        self._server = None
+        self.base_url = ''
+
+        self.resources = {
+            'collectors': {c_id: {'id': c_id, 'hostname': f'lt-collector-{c_id}', 'collectorGroupId': 1,
+                                  'collectorDeviceId': 0, 'backupAgentId': 0, 'enableFailBack': False,
+                                  'enableFailOverOnCollectorDevice': False, 'escalatingChainId': 0,
+                                  'build': '35000', 'isDown': False, 'collectorSize': 'medium',
+                                  'numberOfInstances': randint(2000, 8000), 'numberOfHosts': randint(20, 80),
+                                  'description': ''}
+                           for c_id in range(1, collectors + 1)},
+            'devices': {c_id + 1000: {'id': c_id + 1000, 'name': f'10.0.{c_id // 250}.{c_id % 250}',
+                                      'displayName': f'lt-collector-{c_id}', 'hostGroupIds': '2',
+                                      'type': '', 'preferredCollectorId': c_id, 'currentCollectorId': c_id,
+                                      'customProperties': [], 'inheritedProperties': []}
+                        for c_id in range(1, collectors + 1)},
+            'collector_groups': {1: {'id': 1, 'name': self.CG_NAME, 'autoBalance': False,
+                                     'autoBalanceInstanceCountThreshold': 10000, 'numOfCollectors': collectors}},
+            'device_groups': {1: {'id': 1, 'name': 'Collectors', 'fullPath': self.DG_NAME, 'customProperties': []},
+                              2: {'id': 2, 'name': 'Unsorted', 'fullPath': 'Unsorted', 'customProperties': []}},
+            'chains': {1: {'id': 1, 'name': self.EC_NAME, 'destinations': []}},
+        }
+
+    ROUTES = {
+        '/setting/collector/collectors': 'collectors',
+        '/setting/collector/groups': 'collector_groups',
+        '/device/devices': 'devices',
+        '/device/groups': 'device_groups',
+        '/setting/alert/chains': 'chains',
+    }
+
+    async def start(self) -> str:
+        """Start listening on a free localhost port and return the API base URL."""
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.base_url = f'http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}/santaba/rest'
+        return self.base_url
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _throttled(self, verb: str) -> bool:
+        now = time.monotonic()
+        if verb not in self._window_start or now - self._window_start[verb] >= self.window:
+            self._window_start[verb] = now
+            self._window_count[verb] = 0
+        self._window_count[verb] += 1
+        return self._window_count[verb] > self.limits.get(verb, self.limits['GET'])
+
+    @staticmethod
+    def _filtered(items: list, query: dict) -> list:
+        for key, value in re.findall(r'(\w+):"([^"]*)"', query.get('filter', '')):
+            items = [item for item in items if str(item.get(key)) == value]
+        return items
+
+    @staticmethod
+    def _projected(item: dict, query: dict) -> dict:
+        if not query.get('fields'):
+            return item
+        fields = query['fields'].split(',')
+        return {k: v for k, v in item.items() if k in fields}
+
+    def _collector(self, c_id: int, boot: bool = True) -> dict:
+        """
+        The collector, associated with its device once its association delay has passed.  The
+        delay starts when the collector is first looked up by ID, as bootstrap does when it boots,
+        or never with boot False: listing the group mustn't start every collector's clock.
+        """
+        collector = self.resources['collectors'][c_id]
+        if boot and c_id not in self._assoc_at:
+            self._assoc_at[c_id] = time.monotonic() + uniform(*self.assoc_delay)
+        if not collector['collectorDeviceId'] and time.monotonic() >= self._assoc_at.get(c_id, float('inf')):
+            collector['collectorDeviceId'] = c_id + 1000
+        return collector
+
+    def handle(self, verb: str, path: str, query: dict, body: bytes) -> tuple:
+        """Return (status, response object) for one request."""
+        path = path[len('/santaba/rest'):]
+        for prefix, kind in self.ROUTES.items():
+            if path == prefix and verb == 'GET':
+                resources = self.resources[kind]
+                if kind == 'collectors':
+                    items = [self._collector(c_id, boot=False) for c_id in resources]
+                else:
+                    items = list(resources.values())
+                items = self._filtered(items, query)
+                offset, size = int(query.get('offset') or 0), int(query.get('size') or 50)
+                return 200, {'total': len(items), 'items': [self._projected(i, query) for i in items[offset:offset + size]]}
+
+            match = re.fullmatch(re.escape(prefix) + r'/(\d+)(/\w+)?(/\w+)?', path)
+            if not match:
+                continue
+            r_id = int(match.group(1))
+            if r_id not in self.resources[kind]:
+                return 404, {'errorMessage': f'No such {kind} {r_id}'}
+            resource = self._collector(r_id) if kind == 'collectors' else self.resources[kind][r_id]
+            if match.group(2) == '/scheduleAutoDiscovery' and verb == 'POST':
+                return 200, {}
+            if match.group(2) == '/installers':
+                return 200, {}
+            if match.group(2):
+                break
+            if verb == 'PATCH':
+                resource.update(json.loads(body or b'{}'))
+            return 200, self._projected(resource, query)
+
+        return 404, {'errorMessage': f'No route for {verb} {path}'}
+
+    async def _serve(self, reader, writer) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                verb, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length') or 0))
+
+                url = urllib.parse.urlsplit(target)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                extra = ''
+                await asyncio.sleep(self.latency)
+                if not headers.get('authorization', '').startswith('LMv1 '):
+                    status, response = 401, {'errorMessage': 'Authentication failed'}
+                elif self._throttled(verb):
+                    self.stats['throttled'] += 1
+                    status, response = 429, {'errorMessage': 'Too Many Requests'}
+                    extra = (f'X-Rate-Limit-Limit: {self.limits.get(verb, self.limits["GET"])}\r\n'
+                             f'X-Rate-Limit-Remaining: 0\r\nX-Rate-Limit-Window: {self.window:g}\r\n')
+                else:
+                    self.stats['calls'][verb] = self.stats['calls'].get(verb, 0) + 1
+                    status, response = self.handle(verb, url.path, query, body)
+
+                data = json.dumps(response).encode()
+                writer.write(f'HTTP/1.1 {status} {"OK" if status < 400 else "Error"}\r\n'
+                             f'Content-Type: application/json\r\nContent-Length: {len(data)}\r\n{extra}\r\n'
+                             .encode('latin-1') + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+def percentile(values: list, pct: float) -> float:
+    """Return the nearest-rank pct percentile of values, 0 if there are none."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(int(len(ordered) * pct / 100 + 0.5) - 1, 0)]
+
+async def load_test_round_async(args: argparse.Namespace, collectors: int) -> dict:
+    """
+    Boot collectors simulated collectors against a fresh MockPortal, spread over --ramp seconds,
+    each with its own client as separate hosts would have, and optionally have each of them run
+    cgfo once it has booted.  Returns the round's results for run_load_test_async().
+    """
+    mock = MockPortal(collectors, tuple(args.assoc_delay), args.latency / 1000, args.window)
+    base_url = await mock.start()
+    parser = build_parser()
+
+    async def boot(c_id):
+        lm_portal = Portal(f'collector-{c_id}', 'loadtest', 'loadtest', 'loadtest', args.rate_limit, args.concurrency)
+        lm_portal.async_api = LMAsyncApi('loadtest', 'loadtest', 'loadtest', base_url=base_url,
+            max_connections=args.concurrency, rate_limit=args.rate_limit)
+        use_portal(lm_portal)
+        set_log_context(portal=lm_portal.name)
+        await asyncio.sleep(args.ramp * (c_id - 1) / max(collectors - 1, 1))
+
+        boot_args = parser.parse_args(['--portal', 'loadtest', '--access-id', 'loadtest', '--access-key', 'loadtest',
+            'bootstrap', '--collector-id', str(c_id), '--skip-install', '--no-journal',
+            '--ec-name', MockPortal.EC_NAME, '--dg-name', MockPortal.DG_NAME,
+            '--display-name', f'lt-collector-{c_id}', '--ip-address', f'10.0.{c_id // 250}.{c_id % 250}',
+            '--snmp-auth-token', 'loadtest', '--snmp-priv-token', 'loadtest'])
+        boot_args.preflight = args.preflight
+        result = {'ok': False, 'boot': None, 'cgfo': None}
+        start = time.perf_counter()
+        try:
+            result['ok'] = await run_action_checked_async(boot_args)
+            result['boot'] = time.perf_counter() - start
+            if result['ok'] and args.cgfo:
+                await asyncio.sleep(uniform(*args.cgfo_delay))
+                cgfo_start = time.perf_counter()
+                result['ok'] = await set_collector_grp_fo_async(1, 'enable', True)
+                result['cgfo'] = time.perf_counter() - cgfo_start
+        except Exception:
+            logger.exception('  FAILURE: Simulated collector %s', c_id)
+        finally:
+            await lm_portal.async_api.close()
+        result['throttled'] = lm_portal.async_api.stats['throttled']
+
+        return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(boot(c_id) for c_id in range(1, collectors + 1)))
+    elapsed = time.perf_counter() - start
+    await mock.stop()
+
+    boots = [r['boot'] for r in results if r['boot'] is not None]
+    cgfos = [r['cgfo'] for r in results if r['cgfo'] is not None]
+    return {
+        'collectors': collectors,
+        'failed': sum(not r['ok'] for r in results),
+        'elapsed': round(elapsed, 3),
+        'boot_p50': round(percentile(boots, 50), 3),
+        'boot_p90': round(percentile(boots, 90), 3),
+        'boot_p99': round(percentile(boots, 99), 3),
+        'boot_max': round(max(boots, default=0), 3),
+        'cgfo_p50': round(percentile(cgfos, 50), 3),
+        'cgfo_max': round(max(cgfos, default=0), 3),
+        'api_calls': sum(mock.stats['calls'].values()),
+        'calls_by_method': mock.stats['calls'],
+        'throttled': mock.stats['throttled'],
+    }
+
+async def run_load_test_async(args: argparse.Namespace) -> bool:
+    """
+    Run a load test round for each of --collectors in turn and print a line of results per round,
+    or one JSON object per round with --json.  Returns whether every simulated collector succeeded.
+    """
+    if not args.json:
+        print(f'{"collectors":>10} {"failed":>6} {"p50 s":>7} {"p90 s":>7} {"p99 s":>7} {"max s":>7} '
+              f'{"cgfo p50":>8} {"api calls":>9} {"429s":>6} {"wall s":>7}')
+    is_success = True
+    for collectors in args.collectors:
+        with trace_span(f'round {collectors}', 'loadtest', collectors=collectors):
+            result = await load_test_round_async(args, collectors)
+        logger.info('Load test round: %s', result)
+        if args.json:
+            print(json.dumps(result), flush=True)
+        else:
+            print(f'{result["collectors"]:>10} {result["failed"]:>6} {result["boot_p50"]:>7.2f} '
+                  f'{result["boot_p90"]:>7.2f} {result["boot_p99"]:>7.2f} {result["boot_max"]:>7.2f} '
+                  f'{result["cgfo_p50"]:>8.2f} {result["api_calls"]:>9} {result["throttled"]:>6} '
+                  f'{result["elapsed"]:>7.2f}', flush=True)
+        is_success = is_success and not result['failed']
+
+    return is_success
+
+def build_parser(parser_class: type = argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """
+    Build the command line parser.  Nothing in here may touch the LogicMonitor SDK.  Subparsers
+    are created with the same parser_class.
+    """
+    parser = parser_class(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     # Usual arguments which are applicable for the whole script / top-level args
-    parser.add_argument('--portal', required=True, type=str, help='LM Portal Name')
-    parser.add_argument('--access-id', required=True, type=str, help='LM API ID')
-    parser.add_argument('--access-key',  required=True, type=str, help='LM API Key')
+    parser.add_argument('--portal', required=False, type=str, help='LM Portal Name, required unless using --daemon-socket')
+    parser.add_argument('--access-id', required=False, type=str, help='LM API ID')
+    parser.add_argument('--access-key',  required=False, type=str, help='LM API Key')
+    parser.add_argument('--credentials-file', required=False, type=str,
+        help='INI file with a [name] section of portal, access_id and access_key per portal, used '
+             'instead of --portal/--access-id/--access-key')
+    parser.add_argument('--portals', required=False, type=str,
+        help='Comma separated sections of --credentials-file to run against concurrently, default is all of them')
     parser.add_argument('--log-file', required=False, type=str, nargs='?',
         default='/tmp/lm-collector-install-setup.log', help='Write to this log file')
     parser.add_argument('--log-level', required=False, type=str, nargs='?',
         choices=['DEBUG','INFO','WARNING','ERROR','CRITICAL'], default='INFO',
         help='Log level, default is INFO')
+    parser.add_argument('--log-format', required=False, type=str, choices=['text', 'json'], default='text',
+        help='Log line format, json writes one object per line with run and step correlation IDs')
+    parser.add_argument('--log-dump-limit', required=False, type=int, default=512,
+        help='Maximum number of characters of an API object to write when logging a failure')
+    parser.add_argument('--trace-file', required=False, type=str,
+        help='Record spans of the action, helpers and API calls and write them to this file at exit')
+    parser.add_argument('--trace-format', required=False, type=str, choices=['chrome', 'otlp'], default='chrome',
+        help='chrome opens in Perfetto or chrome://tracing, otlp is OpenTelemetry OTLP JSON')
+    parser.add_argument('--profile-file', required=False, type=str,
+        help='Write cProfile stats of the action to this file, for pstats or snakeviz')
+    parser.add_argument('--backend', required=False, type=str, choices=['sdk', 'raw'], default='sdk',
+        help='API client to use.  raw signs requests itself and skips SDK model deserialization')
+    parser.add_argument('--engine', required=False, type=str, choices=['sync', 'async'], default='sync',
+        help='Execution engine.  async uses its own HTTP client, runs independent lookups concurrently '
+             'and accepts several --collector-id values for echain, snmp and devgrp')
+    parser.add_argument('--rate-limit', required=False, type=float, default=0,
+        help='Requests per second to stay under with --engine async, 0 to only back off on 429s')
+    parser.add_argument('--daemon-socket', required=False, type=str,
+        help='Forward the action to a daemon listening on this socket instead of running it here.  '
+             '--portal/--access-id/--access-key are not needed')
+    parser.add_argument('--concurrency', required=False, type=int, default=8,
+        help='Maximum number of API requests in flight at once with --engine async')
+    parser.add_argument('--timings', required=False, action='store_true', default=False,
+        help='Print an import/startup time breakdown to stderr, it is always logged')
+    parser.add_argument('--no-preflight', required=False, dest='preflight', action='store_false', default=True,
+        help='Skip checking credentials and every referenced ID and name at once before the action starts')
 
     # Same subparsers as usual
     subparsers = parser.add_subparsers(help='Desired action to perform', dest='action')
@@ -638,22 +3644,30 @@ def main():
         choices=['Linux64', 'Windows64'], default='Linux64',
         help='OS and Arch string recognized by LM API')
     parser_install.add_argument('--size', required=False, type=str,
-        choices=['nano', 'small', 'medium', 'large', 'extra_large', 'double_extra_large'],
-        default='medium', help='Collector size')
+        choices=['nano', 'small', 'medium', 'large', 'extra_large', 'double_extra_large', 'auto'],
+        default='medium', help='Collector size, auto picks the largest this host has the CPUs and memory for')
     parser_install.add_argument('--use-ea', required=False, action='store_true', default=False,
         help='Download early access collector version')
     parser_install.add_argument('--dl-only', required=False, action='store_true', default=False,
         help='Download only, do not install')
+    parser_install.add_argument('--force', required=False, action='store_true', default=False,
+        help='Download and install even if the same build of this collector is already installed and running')
+    parser_install.add_argument('--install-dir', required=False, type=str, default='/usr/local/logicmonitor/agent',
+        help='Directory the collector is installed in, checked to see if installing can be skipped')
 
     parser_devgrp = subparsers.add_parser('devgrp', parents=[parent_parser],
         help='Add collector VM to a device group',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_devgrp.add_argument('--collector-id', required=True, type=int,
-        help='LM Collector ID')
-    parser_devgrp.add_argument('--dg-id', required=False, type=int,
-        help='Device Group ID')
-    parser_devgrp.add_argument('--dg-name', required=False, type=str,
-        help='Path to folder to place collector resource in.  Eg: "/B2C/DCOps/AZDC01/Collectors".  Overrides --dg-id')
+    parser_devgrp.add_argument('--collector-id', required=True, type=int, nargs='+',
+        help='LM Collector ID(s)')
+    parser_devgrp.add_argument('--dg-id', required=False, type=int, nargs='+', default=[],
+        help='Device Group ID(s) to add the collector resource to')
+    parser_devgrp.add_argument('--dg-name', required=False, type=str, nargs='+', default=[],
+        help='Path(s) to folders to place collector resource in.  Eg: "/B2C/DCOps/AZDC01/Collectors"')
+    parser_devgrp.add_argument('--remove-dg-id', required=False, type=int, nargs='+', default=[],
+        help='Device Group ID(s) to remove the collector resource from')
+    parser_devgrp.add_argument('--remove-dg-name', required=False, type=str, nargs='+', default=[],
+        help='Path(s) of folders to remove the collector resource from')
 
     parser_devname = subparsers.add_parser('devname', parents=[parent_parser],
         help='Set collector VM device name',
@@ -668,16 +3682,20 @@ def main():
     parser_echain = subparsers.add_parser('echain', parents=[parent_parser],
         help='Set collector escalation chain',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_echain.add_argument('--collector-id', required=True, type=int,
-        help='LM Collector ID')
+    parser_echain.add_argument('--collector-id', required=True, type=int, nargs='+',
+        help='LM Collector ID(s)')
     parser_echain.add_argument('--ec-name', required=True, type=str,
         help='Name of Escalation Chain to use if collector is unreachable')
 
     parser_snmp = subparsers.add_parser('snmp', parents=[parent_parser],
         help='Set collector SNMP custom properties',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_snmp.add_argument('--collector-id', required=True, type=int,
-        help='LM Collector ID')
+    parser_snmp.add_argument('--collector-id', required=False, type=int, nargs='+', default=[],
+        help='LM Collector ID(s).  With --dg-id or --dg-name their devices are only checked for inheriting the properties')
+    parser_snmp.add_argument('--dg-id', required=False, type=int,
+        help='Set the properties once on this device group instead of on each collector device')
+    parser_snmp.add_argument('--dg-name', required=False, type=str,
+        help='Device group path instead of id, overrides --dg-id')
     parser_snmp.add_argument('--snmp-security', required=False, type=str, default='lm-snmpv3',
         help='SNMPv3 Username')
     parser_snmp.add_argument('--snmp-auth', required=False, type=str, choices=['SHA', 'MD5'],
@@ -698,6 +3716,14 @@ def main():
         help='Collector Group name instead of id, overrides --cg-id')
     parser_cgab.add_argument('--ab-state', required=True, type=str, choices=['enable', 'disable'],
         default='disable', help='Collector group device resource auto balancing')
+    parser_cgab.add_argument('--ab-threshold', required=False, type=int, default=10000,
+        help='Instance count above which a collector\'s instances are rebalanced')
+    parser_cgab.add_argument('--target-util', required=False, type=float,
+        help='Compute --ab-threshold instead, to keep every member under this fraction of its capacity (0-1)')
+    parser_cgab.add_argument('--interval', required=False, type=int, default=0,
+        help='With --target-util, recompute the threshold every this many seconds until stopped, 0 to run once')
+    parser_cgab.add_argument('--min-change', required=False, type=float, default=0.05,
+        help='With --interval, only update the group when the threshold moves by more than this fraction')
 
     parser_cgfo = subparsers.add_parser('cgfo', parents=[parent_parser],
         help='Set collector group failover',
@@ -708,36 +3734,274 @@ def main():
         help='Collector Group name instead of id, overrides --cg-id')
     parser_cgfo.add_argument('--fo-state', required=True, type=str, choices=['enable', 'disable'],
         default='enable', help='Collector group device resource monitoring failover')
+    parser_cgfo.add_argument('--fo-strategy', required=False, type=str, choices=['balanced', 'ring'],
+        default='balanced', help='Pick backups by collector load and size, or each collector backs up the next one')
     parser_cgfo.add_argument('--no-sleep', required=False, action='store_true', default=True,
         help='Do not sleep before executing the failover setup')
 
     parser_rad = subparsers.add_parser('rad', parents=[parent_parser],
         help='Run device datasource auto-discovery',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_rad.add_argument('--device-id', required=True, type=int,
-        help='LM Device ID')
+    parser_rad.add_argument('--device-id', required=False, type=int, nargs='+',
+        help='LM Device ID(s)')
+    parser_rad.add_argument('--dg-id', required=False, type=int,
+        help='Run on every device directly in this device group')
+    parser_rad.add_argument('--dg-name', required=False, type=str,
+        help='Device group path instead of id, overrides --dg-id')
+    parser_rad.add_argument('--cg-id', required=False, type=int,
+        help='Run on the collector devices of every collector in this collector group')
+    parser_rad.add_argument('--cg-name', required=False, type=str,
+        help='Collector Group name instead of id, overrides --cg-id')
+    parser_rad.add_argument('--dedup-window', required=False, type=int, default=600,
+        help='When running on more than one device, skip devices scheduled less than this many seconds ago')
+    parser_rad.add_argument('--ad-state-file', required=False, type=str, default='/tmp/lm-autodiscovery-state.json',
+        help='Where to remember when autodiscovery was last scheduled on each device')
+    parser_rad.add_argument('--max-parallel', required=False, type=int, default=4,
+        help='Maximum number of devices to schedule at the same time')
+
+    parser_bootstrap = subparsers.add_parser('bootstrap', parents=[parent_parser],
+        help='Download, install and configure a collector in one run, overlapping independent steps',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_bootstrap.add_argument('--collector-id', required=True, type=int,
+        help='LM Collector ID')
+    parser_bootstrap.add_argument('--os-arch', required=False, type=str,
+        choices=['Linux64', 'Windows64'], default='Linux64',
+        help='OS and Arch string recognized by LM API')
+    parser_bootstrap.add_argument('--size', required=False, type=str,
+        choices=['nano', 'small', 'medium', 'large', 'extra_large', 'double_extra_large', 'auto'],
+        default='medium', help='Collector size, auto picks the largest this host has the CPUs and memory for')
+    parser_bootstrap.add_argument('--use-ea', required=False, action='store_true', default=False,
+        help='Download early access collector version')
+    parser_bootstrap.add_argument('--skip-install', required=False, action='store_true', default=False,
+        help='Collector is already installed, only configure it')
+    parser_bootstrap.add_argument('--force', required=False, action='store_true', default=False,
+        help='Download and install even if the same build of this collector is already installed and running')
+    parser_bootstrap.add_argument('--install-dir', required=False, type=str, default='/usr/local/logicmonitor/agent',
+        help='Directory the collector is installed in, checked to see if installing can be skipped')
+    parser_bootstrap.add_argument('--journal-dir', required=False, type=str, default='/var/lib/lmc-util',
+        help='Directory of the per-collector journal of finished steps that a re-run resumes from')
+    parser_bootstrap.add_argument('--no-journal', required=False, action='store_true', default=False,
+        help='Neither read nor write the journal, run every step')
+    parser_bootstrap.add_argument('--ec-name', required=False, type=str,
+        help='Name of Escalation Chain to use if collector is unreachable')
+    parser_bootstrap.add_argument('--display-name', required=False, type=str,
+        help='Override autodetected name text with this')
+    parser_bootstrap.add_argument('--ip-address', required=False, type=str,
+        help='Override IP addr of collector resource with this')
+    parser_bootstrap.add_argument('--dg-id', required=False, type=int,
+        help='Device Group ID')
+    parser_bootstrap.add_argument('--dg-name', required=False, type=str,
+        help='Path to folder to place collector resource in, overrides --dg-id')
+    parser_bootstrap.add_argument('--snmp-security', required=False, type=str, default='lm-snmpv3',
+        help='SNMPv3 Username')
+    parser_bootstrap.add_argument('--snmp-auth', required=False, type=str, choices=['SHA', 'MD5'],
+        default='SHA', help='SNMPv3 Authentication Algorithm')
+    parser_bootstrap.add_argument('--snmp-priv', required=False, type=str, choices=['AES', 'DES'],
+        default='AES', help='SNMPv3 Encryption Algorithm')
+    parser_bootstrap.add_argument('--snmp-auth-token', required=False, type=str,
+        help='SNMPv3 Authentication Password, SNMP properties are only set if both tokens are given')
+    parser_bootstrap.add_argument('--snmp-priv-token', required=False, type=str,
+        help='SNMPv3 Encrpytion Password')
 
-    args = parser.parse_args()
+    parser_sync = subparsers.add_parser('sync', parents=[parent_parser],
+        help='Mirror collectors, collector groups, device groups and collector devices into a local inventory',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_sync.add_argument('--db', required=False, type=str, default='/var/lib/lmc-util/inventory.db',
+        help='SQLite inventory file')
+    parser_sync.add_argument('--full', required=False, action='store_true', default=False,
+        help='Fetch everything instead of only what changed since the last sync')
 
-    numeric_loglevel = getattr(logging, args.log_level.upper(), None)
-    if not isinstance(numeric_loglevel, int):
-        raise ValueError('Invalid log level: %s' % args.loglevel)
-    log_format = "[%(asctime)s %(filename)s:%(lineno)s - %(levelname)s - %(funcName)20s()] %(message)s"
-    logging.basicConfig(filename=args.log_file, filemode='a', format=log_format, level=numeric_loglevel)
+    parser_query = subparsers.add_parser('query', parents=[parent_parser],
+        help='Answer from the local inventory without calling the API, one JSON object per line',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_query.add_argument('what', type=str,
+        choices=['collectors', 'collector-groups', 'device-groups', 'devices', 'failover'],
+        help='Records to list, devices being collector devices and failover the backup of each collector')
+    parser_query.add_argument('--db', required=False, type=str, default='/var/lib/lmc-util/inventory.db',
+        help='SQLite inventory file')
+    parser_query.add_argument('--cg-id', required=False, type=int,
+        help='Only collectors, devices or failover pairs in this collector group')
+    parser_query.add_argument('--cg-name', required=False, type=str,
+        help='Collector Group name instead of id, overrides --cg-id')
+    parser_query.add_argument('--dg-name', required=False, type=str,
+        help='Only this device group, or devices directly in it')
+    parser_query.add_argument('--max-age', required=False, type=int, default=0,
+        help='Fail if the inventory was synced longer than this many seconds ago, 0 to not check')
 
-    logger.info('----------------')
-    logger.info('Starting script')
-    for arg in vars(args):
-        logger.debug('Arg %s: %s', arg, getattr(args, arg))
+    parser_watch = subparsers.add_parser('watch', parents=[parent_parser],
+        help='Poll collectors and print each change of state as a JSON line until interrupted',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_watch.add_argument('--cg-id', required=False, type=int, nargs='+', default=[],
+        help='LM Collector Group ID(s) to watch')
+    parser_watch.add_argument('--cg-name', required=False, type=str, nargs='+', default=[],
+        help='LM Collector Group name(s) to watch')
+    parser_watch.add_argument('--interval', required=False, type=float, default=60,
+        help='Seconds between the first polls')
+    parser_watch.add_argument('--min-interval', required=False, type=float, default=15,
+        help='Shortest interval, used while collectors are changing')
+    parser_watch.add_argument('--max-interval', required=False, type=float, default=300,
+        help='Longest interval, reached while nothing changes')
+    parser_watch.add_argument('--initial', required=False, action='store_true', default=False,
+        help='Print a present event for every collector on the first poll')
+    parser_watch.add_argument('--count', required=False, type=int, default=0,
+        help='Stop after this many polls, 0 to run until interrupted')
+
+    parser_batch = subparsers.add_parser('batch', parents=[parent_parser],
+        help='Run a JSON list of operations from stdin on one client and write a JSON result per operation',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_batch.add_argument('--input', required=False, type=str, default='-',
+        help='File to read the operations from, - for stdin')
+    parser_batch.add_argument('--max-parallel', required=False, type=int, default=16,
+        help='Maximum number of operations to run at the same time')
+    parser_batch.add_argument('--cache-ttl', required=False, type=int, default=300,
+        help='Seconds to reuse collector group, device group and escalation chain name lookups for')
+
+    parser_daemon = subparsers.add_parser('daemon', parents=[parent_parser],
+        help='Stay running and accept actions over a Unix socket, see --daemon-socket',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_daemon.add_argument('--socket', required=False, type=str, default='/run/lmc-util.sock',
+        help='Unix socket to listen on')
+    parser_daemon.add_argument('--cache-ttl', required=False, type=int, default=300,
+        help='Seconds to reuse collector group, device group and escalation chain name lookups for')
 
-    lmsdk_cfg = logicmonitor_sdk.Configuration()
-    lmsdk_cfg.company = args.portal
-    lmsdk_cfg.access_id  = args.access_id
-    lmsdk_cfg.access_key = args.access_key
-    lm_api = logicmonitor_sdk.LMApi(logicmonitor_sdk.ApiClient(lmsdk_cfg))
+    parser_bench = subparsers.add_parser('bench', parents=[parent_parser],
+        help='Compare latency and CPU time of the sdk and raw backends on read calls',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_bench.add_argument('--collector-id', required=True, type=int,
+        help='LM Collector ID to read with gcbi()')
+    parser_bench.add_argument('--device-id', required=False, type=int,
+        help='LM Device ID to read with gdbi()')
+    parser_bench.add_argument('--cg-id', required=False, type=int,
+        help='LM Collector Group ID to list with gcicg()')
+    parser_bench.add_argument('--iterations', required=False, type=int, default=20,
+        help='Calls per helper per backend')
+
+    parser_loadtest = subparsers.add_parser('loadtest', parents=[parent_parser],
+        help='Boot simulated collectors at once against a local mock portal and report latencies and API calls',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_loadtest.add_argument('--collectors', required=False, type=int, nargs='+', default=[10, 50, 100],
+        help='Number of collectors to boot at once, one round per number')
+    parser_loadtest.add_argument('--assoc-delay', required=False, type=float, nargs=2, default=[60, 90],
+        metavar=('MIN', 'MAX'), help='Seconds the mock takes to associate each collector with its device')
+    parser_loadtest.add_argument('--latency', required=False, type=float, default=50,
+        help='Milliseconds the mock adds to every response')
+    parser_loadtest.add_argument('--window', required=False, type=float, default=60,
+        help='Seconds of the mock\'s per method rate limit window, the portal\'s limits are per minute')
+    parser_loadtest.add_argument('--ramp', required=False, type=float, default=0,
+        help='Spread the collectors\' boots evenly over this many seconds, 0 to boot them all at once')
+    parser_loadtest.add_argument('--cgfo', required=False, action='store_true', default=False,
+        help='Have every collector enable failover on the group after booting, as cloud-init does')
+    parser_loadtest.add_argument('--cgfo-delay', required=False, type=float, nargs=2, default=[120, 300],
+        metavar=('MIN', 'MAX'), help='Seconds each collector waits after booting before cgfo')
+    parser_loadtest.add_argument('--json', required=False, action='store_true', default=False,
+        help='Print one JSON object per round instead of a table')
+
+    return parser
+
+class BatchArgumentParser(argparse.ArgumentParser):
+    """ArgumentParser for the operations of a batch, raising ValueError instead of exiting on bad arguments."""
+    def error(self, message: str):
+        raise ValueError(message)
+
+def reject_args(parser: argparse.ArgumentParser, message: str) -> None:
+    """Report an invalid argument combination, exiting for the command line or raising for a batch operation."""
+    if isinstance(parser, BatchArgumentParser):
+        raise ValueError(message)
+    print(message)
+    exit_script(1)
+
+def validate_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """
+    Check argument combinations that argparse can't express.  This runs before logging is set up
+    and before the SDK is imported so that mistakes fail fast.
+    """
+    if args.action is None:
+        reject_args(parser, 'Try --help')
+
+    if args.portals and not args.credentials_file:
+        parser.error('--portals selects sections of --credentials-file')
+
+    if (args.action not in ('query', 'loadtest') and not args.daemon_socket and not args.credentials_file
+            and not (args.portal and args.access_id and args.access_key)):
+        parser.error('the following arguments are required: --portal, --access-id, --access-key')
+
+    if args.action == 'daemon':
+        if args.daemon_socket:
+            parser.error('--daemon-socket is for clients of the daemon, use daemon --socket')
+        args.engine = 'async'
 
+    if args.action in ('sync', 'batch'):
+        args.engine = 'async'
+
+    if args.action == 'cgab':
+        if args.target_util is not None and not 0 < args.target_util <= 1:
+            parser.error('cgab needs 0 < --target-util <= 1')
+        if args.interval:
+            if args.target_util is None or args.interval < 0:
+                parser.error('cgab --interval needs --target-util and a positive number of seconds')
+            args.engine = 'async'
+
+    if args.action == 'watch':
+        if not args.cg_id and not args.cg_name:
+            reject_args(parser, 'Need to specify at least one --cg-id or --cg-name')
+        if not 0 < args.min_interval <= args.interval <= args.max_interval:
+            parser.error('watch needs 0 < --min-interval <= --interval <= --max-interval')
+        args.engine = 'async'
+
+    if args.action == 'bootstrap':
+        if bool(args.snmp_auth_token) != bool(args.snmp_priv_token):
+            parser.error('bootstrap needs both --snmp-auth-token and --snmp-priv-token, or neither')
+        args.engine = 'async'
+
+    if args.action in ('cgab', 'cgfo') and not args.cg_id and not args.cg_name:
+        reject_args(parser, 'Need to specify either --cg-id or --cg-name, not both')
+
+    if args.action == 'snmp' and not (args.collector_id or args.dg_id or args.dg_name):
+        reject_args(parser, 'Need to specify at least one of --collector-id, --dg-id or --dg-name')
+
+    if args.action == 'devgrp' and not (args.dg_id or args.dg_name or args.remove_dg_id or args.remove_dg_name):
+        reject_args(parser, 'Need to specify at least one of --dg-id, --dg-name, --remove-dg-id or --remove-dg-name')
+
+    if args.action == 'rad':
+        if not (args.device_id or args.dg_id or args.dg_name or args.cg_id or args.cg_name):
+            reject_args(parser, 'Need to specify at least one of --device-id, --dg-id, --dg-name, --cg-id or --cg-name')
+        # Anything more than one device is scheduled as a batch, which needs the async engine
+        if len(args.device_id or ()) > 1 or args.dg_id or args.dg_name or args.cg_id or args.cg_name:
+            args.engine = 'async'
+
+    if args.action == 'bench' and args.engine != 'sync':
+        reject_args(parser, 'bench compares the sync backends, it can not be used with --engine async')
+
+    if args.action == 'loadtest':
+        if min(args.collectors) < 1:
+            parser.error('loadtest --collectors must all be at least 1')
+        if not (0 <= args.assoc_delay[0] <= args.assoc_delay[1] and 0 <= args.cgfo_delay[0] <= args.cgfo_delay[1]):
+            parser.error('loadtest needs 0 <= MIN <= MAX for --assoc-delay and --cgfo-delay')
+        if args.window <= 0:
+            parser.error('loadtest --window must be positive')
+        args.engine = 'async'
+
+def build_snmp_props(args: argparse.Namespace) -> list:
+    """Return the custom property list the snmp action sets on a collector device."""
+    return [
+        {'name': 'system.categories', 'value': 'snmpTCPUDP,Netsnmp,snmpHR,snmp,collector' },
+        {'name': 'snmp.security', 'value': args.snmp_security },
+        {'name': 'snmp.auth', 'value': args.snmp_auth },
+        {'name': 'snmp.priv', 'value': args.snmp_priv },
+        {'name': 'snmp.authToken', 'value': args.snmp_auth_token },
+        {'name': 'snmp.privToken', 'value': args.snmp_priv_token },
+    ]
+
+def run_action(args: argparse.Namespace) -> None:
+    """Run the action selected on the command line against the current portal's client."""
     # Download and optionally install the collector
     if args.action == 'install':
+        if not args.force and not args.dl_only:
+            collector = gcbi(args.collector_id, 'id,hostname,build,isDown')
+            if local_install_is_current(args.collector_id, collector, args.install_dir):
+                logger.info('  Skipping download and install, use --force to reinstall')
+                return
+
         lmc_bin_name = get_collector_installer(args.collector_id, args.os_arch, args.size, args.use_ea)
         if args.dl_only:
             logger.info('  Requested download-only, file is at %s', lmc_bin_name)
@@ -748,88 +4012,585 @@ def main():
         set_collector_dev_name(args.collector_id, args.display_name, args.ip_address)
     # Set the SNMPv3 properties on the collector resource/device
     elif args.action == 'snmp':
-        snmp_props = [
-            {'name': 'system.categories', 'value': 'snmpTCPUDP,Netsnmp,snmpHR,snmp,collector' },
-            {'name': 'snmp.security', 'value': args.snmp_security },
-            {'name': 'snmp.auth', 'value': args.snmp_auth },
-            {'name': 'snmp.priv', 'value': args.snmp_priv },
-            {'name': 'snmp.authToken', 'value': args.snmp_auth_token },
-            {'name': 'snmp.privToken', 'value': args.snmp_priv_token },
-        ]
-        set_collector_dev_cp(args.collector_id, snmp_props)
+        snmp_props = build_snmp_props(args)
+        if args.dg_id or args.dg_name:
+            dg_ids = resolve_dg_paths([args.dg_name]) if args.dg_name else [args.dg_id]
+            if dg_ids is None:
+                print(f'Cannot resolve {args.dg_name} to a device group id')
+                exit_script(1)
+            if not set_dev_grp_cp(dg_ids[0], snmp_props):
+                exit_script(1)
+            results = [verify_collector_dev_cp(c_id, snmp_props) for c_id in args.collector_id]
+            if not all(results):
+                exit_script(1)
+        else:
+            for c_id in args.collector_id:
+                set_collector_dev_cp(c_id, snmp_props)
     # Set the collector-down escalation chain on the collector
     elif args.action == 'echain':
-        set_collector_esc_chain(args.collector_id, args.ec_name)
+        for c_id in args.collector_id:
+            set_collector_esc_chain(c_id, args.ec_name)
     # Toggle collector group failover
     elif args.action == 'cgfo':
-        if not args.cg_id and not args.cg_name:
-            print('Need to specify either --cg-id or --cg-name, not both')
-            os._exit(1)
-
         if args.cg_name:
-            gcgbn_response = gcgbn(args.cg_name)
+            gcgbn_response = gcgbn(args.cg_name, 'id,name')
             if gcgbn_response and gcgbn_response.id:
                 resolved_cgid = gcgbn_response.id
             else:
                 print(f'Cannot resolve {args.cg_name} to a collector group id')
-                os._exit(1)
+                exit_script(1)
         else:
             resolved_cgid = args.cg_id
 
         if resolved_cgid:
-            set_collector_grp_fo(resolved_cgid, args.fo_state, args.no_sleep)
+            set_collector_grp_fo(resolved_cgid, args.fo_state, args.no_sleep, args.fo_strategy)
         else:
             print('Either collector group ID or name was invalid')
-            os._exit(1)
+            exit_script(1)
     elif args.action == 'devgrp':
-        if not args.dg_id and not args.dg_name:
-            print('Need to specify either --dg-id or --dg-name, not both')
-            os._exit(1)
-
-        if args.dg_name:
-            gdgbn_response = gdgbn(args.dg_name)
-            if gdgbn_response and gdgbn_response.items and gdgbn_response.items[0].id:
-                resolved_dgid = gdgbn_response.items[0].id
-            else:
-                print(f'Cannot resolve {args.dg_name} to a device group id')
-                os._exit(1)
-        else:
-            resolved_dgid = args.dg_id
-
-        if resolved_dgid:
-            set_collector_dev_grp(args.collector_id, resolved_dgid)
-        else:
-            print('Either device group ID or name was invalid')
-            os._exit(1)
+        add_dg_ids = resolve_dg_paths(args.dg_name)
+        remove_dg_ids = resolve_dg_paths(args.remove_dg_name)
+        if add_dg_ids is None or remove_dg_ids is None:
+            print(f'Cannot resolve all of {args.dg_name + args.remove_dg_name} to device group ids')
+            exit_script(1)
+
+        for c_id in args.collector_id:
+            set_collector_dev_grp(c_id, args.dg_id + add_dg_ids, args.remove_dg_id + remove_dg_ids)
     elif args.action == 'cgab':
-        if not args.cg_id and not args.cg_name:
-            print('Need to specify either --cg-id or --cg-name, not both')
-            os._exit(1)
         if args.cg_name:
-            gcgbn_response = gcgbn(args.cg_name)
+            gcgbn_response = gcgbn(args.cg_name, 'id,name')
             if gcgbn_response and gcgbn_response.id:
                 resolved_cgid = gcgbn_response.id
             else:
                 print(f'Cannot resolve {args.cg_name} to a collector group id')
-                os._exit(1)
+                exit_script(1)
         else:
             resolved_cgid = args.cg_id
 
         if resolved_cgid:
-            set_collector_grp_ab(resolved_cgid, args.ab_state, 10000)
+            ab_threshold = args.ab_threshold
+            if args.target_util is not None:
+                ab_threshold = compute_ab_threshold(resolved_cgid, args.target_util)
+                if not ab_threshold:
+                    exit_script(1)
+            set_collector_grp_ab(resolved_cgid, args.ab_state, ab_threshold)
         else:
             print('Either collector group ID or name was invalid')
-            os._exit(1)
+            exit_script(1)
     elif args.action == 'rad':
-        gdbi_response = gdbi(args.device_id)
-        if gdbi_response and gdbi_response.id:
-            run_autodiscovery(args.device_id)
+        run_autodiscovery(args.device_id[0])
+    elif args.action == 'bench':
+        if not bench_backends(args):
+            exit_script(1)
+
+async def run_action_async(args: argparse.Namespace) -> bool:
+    """
+    Run the action selected on the command line with the asyncio engine.  Unlike run_action() this
+    returns whether the action succeeded instead of exiting, and several collector IDs are worked
+    on concurrently.
+    """
+    if args.action == 'install':
+        if not args.force and not args.dl_only:
+            collector = await gcbi_async(args.collector_id, 'id,hostname,build,isDown')
+            if local_install_is_current(args.collector_id, collector, args.install_dir):
+                logger.info('  Skipping download and install, use --force to reinstall')
+                return True
+
+        lmc_bin_name = await get_collector_installer_async(args.collector_id, args.os_arch, args.size, args.use_ea)
+        if args.dl_only:
+            logger.info('  Requested download-only, file is at %s', lmc_bin_name)
+            return lmc_bin_name is not None
+        return await run_collector_installer_async(lmc_bin_name)
+    elif args.action == 'devname':
+        return await set_collector_dev_name_async(args.collector_id, args.display_name, args.ip_address)
+    elif args.action == 'snmp':
+        snmp_props = build_snmp_props(args)
+        if args.dg_id or args.dg_name:
+            dg_ids = await resolve_dg_paths_async([args.dg_name]) if args.dg_name else [args.dg_id]
+            if dg_ids is None:
+                print(f'Cannot resolve {args.dg_name} to a device group id')
+                return False
+            if not await set_dev_grp_cp_async(dg_ids[0], snmp_props):
+                return False
+            results = await asyncio.gather(*(verify_collector_dev_cp_async(c_id, snmp_props) for c_id in args.collector_id))
+        else:
+            results = await asyncio.gather(*(set_collector_dev_cp_async(c_id, snmp_props) for c_id in args.collector_id))
+        return all(results)
+    elif args.action == 'echain':
+        results = await asyncio.gather(*(set_collector_esc_chain_async(c_id, args.ec_name) for c_id in args.collector_id))
+        return all(results)
+    elif args.action in ('cgfo', 'cgab'):
+        resolved_cgid = args.cg_id
+        if args.cg_name:
+            resolved_cgid = (await resolve_names_async(cg_name=args.cg_name))['cg_id']
+            if not resolved_cgid:
+                print(f'Cannot resolve {args.cg_name} to a collector group id')
+                return False
+        if args.action == 'cgfo':
+            return await set_collector_grp_fo_async(resolved_cgid, args.fo_state, args.no_sleep, args.fo_strategy)
+        if args.interval:
+            return await set_collector_grp_ab_periodic_async(resolved_cgid, args.ab_state, args.target_util,
+                                                             args.interval, args.min_change)
+        ab_threshold = args.ab_threshold
+        if args.target_util is not None:
+            ab_threshold = await compute_ab_threshold_async(resolved_cgid, args.target_util)
+            if not ab_threshold:
+                return False
+        return await set_collector_grp_ab_async(resolved_cgid, args.ab_state, ab_threshold)
+    elif args.action == 'devgrp':
+        add_dg_ids, remove_dg_ids = await asyncio.gather(resolve_dg_paths_async(args.dg_name),
+                                                         resolve_dg_paths_async(args.remove_dg_name))
+        if add_dg_ids is None or remove_dg_ids is None:
+            print(f'Cannot resolve all of {args.dg_name + args.remove_dg_name} to device group ids')
+            return False
+        results = await asyncio.gather(*(set_collector_dev_grp_async(c_id, args.dg_id + add_dg_ids,
+            args.remove_dg_id + remove_dg_ids) for c_id in args.collector_id))
+        return all(results)
+    elif args.action == 'rad':
+        resolved = await resolve_names_async(cg_name=args.cg_name, dg_name=args.dg_name)
+        if None in resolved.values():
+            print('Cannot resolve collector group or device group name to an id')
+            return False
+        targets = await get_autodiscovery_targets_async(args.device_id or (),
+            resolved.get('dg_id', args.dg_id), resolved.get('cg_id', args.cg_id))
+        if targets is None:
+            return False
+        if len(targets) == 1 and args.device_id:
+            return await run_autodiscovery_async(args.device_id[0])
+        return await run_autodiscovery_batch_async(targets, args.dedup_window, args.ad_state_file, args.max_parallel)
+    elif args.action == 'bootstrap':
+        return await bootstrap_async(args)
+    elif args.action == 'sync':
+        return await sync_inventory_async(args.db, args.full)
+    elif args.action == 'watch':
+        return await watch_collectors_async(args)
+    elif args.action == 'batch':
+        return await run_batch_async(args)
+
+    return False
+
+# Actions a batch may contain, the ones that only talk to the portal.  The others are long running,
+# work on this host (install and bootstrap run the installer here, devname defaults to this host's
+# IP address), only read local state or write their own output to stdout.
+BATCH_ACTIONS = ('devgrp', 'echain', 'snmp', 'cgab', 'cgfo', 'rad', 'sync')
+
+def batch_operation_argv(operation: dict) -> list:
+    """
+    Turn one batch operation, {"action": "echain", "collector_id": [12], "ec_name": "x"}, into
+    the command line it stands for.  true is a flag, false and null are left out, and lists are
+    several values.
+    """
+    argv = [operation['action']]
+    for key, value in operation.items():
+        if key in ('id', 'action') or value is False or value is None:
+            continue
+        flag = '--' + key.replace('_', '-')
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, list):
+            argv += [flag] + [str(v) for v in value]
+        else:
+            argv += [flag, str(value)]
+
+    return argv
+
+def parse_batch_operation(parser: BatchArgumentParser, args: argparse.Namespace, operation: dict) -> argparse.Namespace:
+    """
+    Parse and validate one batch operation the same way as a command line, taking the global
+    options (portal, rate limit, ...) from the batch's own command line.  Raises ValueError.
+    """
+    if not isinstance(operation, dict) or operation.get('action') not in BATCH_ACTIONS:
+        raise ValueError(f'action must be one of {", ".join(BATCH_ACTIONS)}')
+    global_args = {k: getattr(args, k) for k in vars(parser.parse_args([])) if k != 'action'}
+    op_args = parser.parse_args(batch_operation_argv(operation), namespace=argparse.Namespace(**global_args))
+    validate_args(parser, op_args)
+    if is_long_running(op_args):
+        raise ValueError(f'{op_args.action} --interval runs until stopped and can not be batched')
+    if getattr(op_args, 'size', None) == 'auto':
+        op_args.size = choose_collector_size()
+
+    return portal_args(op_args, portal(), False)
+
+async def run_batch_async(args: argparse.Namespace) -> bool:
+    """
+    Run a JSON document of operations read from --input as one batch: every operation shares this
+    run's client, connection pool, rate limiter and name cache, and up to --max-parallel of them
+    run at once.  Writes {"ok": bool, "results": [{"id", "action", "ok", "error", "elapsed"}, ...]}
+    to stdout.
+
+    The input is either {"operations": [...]} (or just the list), or Terraform's external data
+    source query, {"operations": "<JSON encoded list>"}.  For the latter the output is flattened
+    to the string map Terraform expects, {"ok": "true", "failed": "<ids>", "results": "<JSON>"},
+    and True is returned whatever the operations did: Terraform discards the output of a program
+    that exits non-zero, so failures are only reported in failed.
+    """
+    import contextlib
+    import sys
+
+    try:
+        if args.input == '-':
+            document = json.load(sys.stdin)
+        else:
+            with open(args.input) as f:
+                document = json.load(f)
+        terraform = isinstance(document, dict) and isinstance(document.get('operations'), str)
+        operations = document.get('operations') if isinstance(document, dict) else document
+        if terraform:
+            operations = json.loads(operations)
+        if not isinstance(operations, list):
+            raise ValueError('expected a list of operations')
+    except (OSError, ValueError) as e:
+        logger.error('  FAILURE: Could not read batch from %s: %s', args.input, e)
+        print(f'Could not read batch from {args.input}: {e}', file=sys.stderr)
+        return False
+
+    logger.info('Running batch of %s operations', len(operations))
+    parser = build_parser(BatchArgumentParser)
+    limit = asyncio.Semaphore(args.max_parallel)
+
+    async def run_operation(index, operation):
+        op_id = str(operation.get('id', index)) if isinstance(operation, dict) else str(index)
+        result = {'id': op_id, 'action': operation.get('action') if isinstance(operation, dict) else None,
+                  'ok': False, 'error': ''}
+        set_log_context(step=op_id)
+        start = time.perf_counter()
+        try:
+            op_args = parse_batch_operation(parser, args, operation)
+            async with limit:
+                with trace_span(op_id, 'operation', action=op_args.action):
+                    result['ok'] = bool(await run_action_async(op_args))
+            if not result['ok']:
+                result['error'] = f'{op_args.action} failed, see {args.log_file}'
+        except ValueError as e:
+            result['error'] = f'Bad operation: {e}'
+        except Exception as e:
+            logger.exception('  FAILURE: Unhandled exception in batch operation %s', op_id)
+            result['error'] = f'{type(e).__name__}: {e}'
+        result['elapsed'] = round(time.perf_counter() - start, 3)
+        logger.info('Batch operation %s finished: %s', op_id, result)
+        return result
+
+    # Helpers print some failures, which must not end up in the JSON on stdout
+    stdout = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        results = await asyncio.gather(*(run_operation(i, op) for i, op in enumerate(operations)))
+    is_success = all(result['ok'] for result in results)
+
+    if terraform:
+        output = {'ok': str(is_success).lower(),
+                  'failed': ','.join(result['id'] for result in results if not result['ok']),
+                  'results': json.dumps(results)}
     else:
-        print('Try --help')
+        output = {'ok': is_success, 'results': results}
+    stdout.write(json.dumps(output) + '\n')
+    stdout.flush()
+
+    return is_success or terraform
+
+async def run_action_until_done(args: argparse.Namespace) -> bool:
+    """
+    Run one action with the asyncio engine, preflight included, and close the client's connections
+    afterwards.
+    """
+    try:
+        return await run_action_checked_async(args)
+    finally:
+        await portal().async_api.close()
+
+# Actions that act on the host the script runs on or write a single document to stdout, which
+# can't be run against several portals
+SINGLE_PORTAL_ACTIONS = ('install', 'devname', 'bootstrap', 'daemon', 'bench', 'batch')
+# Arguments naming local state files, which have to differ between portals
+PORTAL_FILE_ARGS = ('db', 'ad_state_file')
+
+def portal_args(args: argparse.Namespace, lm_portal: Portal, several: bool) -> argparse.Namespace:
+    """
+    Copy of args for running against lm_portal: {portal} in state file paths is replaced by the
+    portal's name, and when running against several portals the name is appended if it wasn't
+    there, so portals don't share state.
+    """
+    args = argparse.Namespace(**vars(args))
+    for name in PORTAL_FILE_ARGS:
+        path = getattr(args, name, None)
+        if not path:
+            continue
+        if '{portal}' in path:
+            setattr(args, name, path.replace('{portal}', lm_portal.name))
+        elif several:
+            setattr(args, name, f'{path}.{lm_portal.name}')
+
+    return args
+
+async def run_portals_async(args: argparse.Namespace, portals: list) -> bool:
+    """
+    Run the action against every portal at the same time, each in its own task with its own
+    client, rate limiter and name cache.  Returns whether it succeeded on all of them.
+    """
+    async def run_on_portal(lm_portal):
+        use_portal(lm_portal)
+        lm_portal.connect_async()
+        try:
+            with trace_span(lm_portal.name, 'portal'):
+                return await run_action_until_done(portal_args(args, lm_portal, len(portals) > 1))
+        except Exception:
+            logger.exception('  FAILURE: Unhandled exception running %s', args.action)
+            return False
+
+    results = await asyncio.gather(*(run_on_portal(lm_portal) for lm_portal in portals))
+    for lm_portal, is_success in zip(portals, results):
+        logger.info('Portal %s: %s', lm_portal.name, 'SUCCESS' if is_success else 'FAILURE')
+
+    return all(results)
+
+# Actions that only make sense in the process they were started in, and arguments that only
+# concern the client side of a daemon request
+DAEMON_REFUSED_ACTIONS = ('daemon', 'bench', 'watch', 'batch', 'loadtest')
+DAEMON_CLIENT_ONLY_ARGS = ('portal', 'access_id', 'access_key', 'credentials_file', 'portals', 'daemon_socket',
+                           'log_file', 'log_level',
+                           'log_format', 'log_dump_limit', 'timings', 'trace_file', 'trace_format', 'profile_file')
+
+def is_long_running(args: argparse.Namespace) -> bool:
+    """Return True for an otherwise one-shot action asked to repeat until stopped."""
+    return args.action == 'cgab' and bool(args.interval)
+
+async def handle_daemon_client(reader, writer) -> None:
+    """
+    Serve one client connection of the daemon.  Each line received is a JSON object holding the
+    parsed command line of a client run, {"args": {...}}, and is answered with one JSON line,
+    {"ok": bool, "error": str, "elapsed": seconds}.  Requests on different connections run
+    concurrently and share the daemon's client, connection pool, rate limiter and name cache.
+    """
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+
+        start = time.perf_counter()
+        reply = {'ok': False, 'error': ''}
+        set_log_context(run_id=uuid.uuid4().hex[:12])
+        try:
+            request_args = portal_args(argparse.Namespace(**json.loads(line)['args']), portal(), False)
+            if request_args.action in DAEMON_REFUSED_ACTIONS or is_long_running(request_args):
+                reply['error'] = f'Action {request_args.action} can not be run by the daemon'
+            else:
+                logger.info('Daemon running %s for client', request_args.action)
+                with trace_span(request_args.action, 'action', daemon=True):
+                    reply['ok'] = bool(await run_action_checked_async(request_args))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            reply['error'] = f'Bad request: {e}'
+        except Exception as e:
+            logger.exception('  FAILURE: Unhandled exception in daemon request')
+            reply['error'] = f'{type(e).__name__}: {e}'
+        reply['elapsed'] = round(time.perf_counter() - start, 3)
+        logger.info('Daemon request finished: %s', reply)
+
+        writer.write(json.dumps(reply).encode() + b'\n')
+        await writer.drain()
+
+    writer.close()
+
+async def serve_daemon(socket_path: str) -> bool:
+    """
+    Run the daemon on a Unix socket until SIGTERM or SIGINT.  The socket is only accessible to
+    the user the daemon runs as.
+    """
+    import signal
+    import socket
+
+    if os.path.exists(socket_path):
+        # Only replace the socket if nothing is listening on it any more
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+                logger.error('  FAILURE: A daemon is already listening on %s', socket_path)
+                print(f'A daemon is already listening on {socket_path}')
+                return False
+            except OSError:
+                os.unlink(socket_path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    old_umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle_daemon_client, path=socket_path)
+    finally:
+        os.umask(old_umask)
+    logger.info('Daemon listening on %s', socket_path)
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info('Daemon shutting down')
+        server.close()
+        await server.wait_closed()
+        await portal().async_api.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+    return True
+
+def forward_to_daemon(args: argparse.Namespace) -> bool:
+    """
+    Send this run's parsed command line to a running daemon and wait for it to finish the action.
+    The daemon uses its own credentials, so those are not sent.  Returns whether it succeeded.
+    """
+    import socket
+
+    request_args = {k: v for k, v in vars(args).items() if k not in DAEMON_CLIENT_ONLY_ARGS}
+    logger.info('Forwarding %s to daemon on %s', args.action, args.daemon_socket)
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(args.daemon_socket)
+            sock.sendall(json.dumps({'args': request_args}).encode() + b'\n')
+            with sock.makefile('rb') as replies:
+                reply = json.loads(replies.readline() or b'{}')
+    except (OSError, ValueError) as e:
+        logger.error('  FAILURE: Could not talk to daemon on %s: %s', args.daemon_socket, e)
+        print(f'Could not talk to daemon on {args.daemon_socket}: {e}')
+        return False
+
+    if reply.get('error'):
+        print(reply['error'])
+    logger.info('  Daemon reply: %s', reply)
+
+    return bool(reply.get('ok'))
+
+def main():
+    global asyncio, name_cache_ttl
+    startup_times['interpreter'] = get_process_age()
+    if startup_times['interpreter'] is not None:
+        # get_process_age() measures up to now, take off the time spent in our own imports
+        startup_times['interpreter'] -= time.perf_counter() - startup_times['script_start']
+
+    argparse_start = time.perf_counter()
+    parser = build_parser()
+    args = parser.parse_args()
+    validate_args(parser, args)
+    startup_times['argparse'] = time.perf_counter() - argparse_start
+
+    global dump_limit
+    dump_limit = args.log_dump_limit
+    setup_logging(args.log_file, args.log_level, args.log_format)
+    set_log_context(run_id=uuid.uuid4().hex[:12])
+
+    global tracer
+    if args.trace_file:
+        tracer = Tracer(args.trace_file, args.trace_format)
+        tracer.record('imports', 'startup', startup_times['script_start'], startup_times['imports_done'])
+        tracer.record('argparse', 'startup', argparse_start, argparse_start + startup_times['argparse'])
+    if args.profile_file:
+        start_profiler(args.profile_file)
+
+    logger.info('----------------')
+    logger.info('Starting script')
+    for arg in vars(args):
+        logger.debug('Arg %s: %s', arg, getattr(args, arg))
+
+    if getattr(args, 'size', None) == 'auto':
+        args.size = choose_collector_size()
+
+    portals = []
+    if args.action not in ('query', 'loadtest') and not args.daemon_socket:
+        try:
+            portals = load_portals(args)
+        except (OSError, KeyError, ValueError) as e:
+            logger.error('  FAILURE: Could not load portal credentials: %s', e)
+            print(f'Could not load portal credentials: {e}')
+            exit_script(1)
+        if len(portals) > 1 and args.action in SINGLE_PORTAL_ACTIONS:
+            print(f'{args.action} can only be run against one portal, pick one with --portals')
+            exit_script(1)
+
+    if args.action == 'query':
+        # Answered locally, even with --daemon-socket, so neither the API nor the daemon is needed
+        action_start = time.perf_counter()
+        with trace_span(args.action, 'action'):
+            is_success = query_inventory(args)
+        startup_times['action'] = time.perf_counter() - action_start
+        report_startup_times(args.timings)
+        if not is_success:
+            logger.info('Exiting script with failures')
+            logger.info('----------------')
+            exit_script(1)
+    elif args.action == 'loadtest':
+        # Runs against its own mock portal, so it needs no credentials and is never forwarded
+        import asyncio
+        if args.preflight:
+            name_cache_ttl = PREFLIGHT_CACHE_TTL
+        action_start = time.perf_counter()
+        with trace_span(args.action, 'action'):
+            is_success = asyncio.run(run_load_test_async(args))
+        startup_times['action'] = time.perf_counter() - action_start
+        report_startup_times(args.timings)
+        if not is_success:
+            logger.info('Exiting script with failures')
+            logger.info('----------------')
+            exit_script(1)
+    elif args.daemon_socket:
+        action_start = time.perf_counter()
+        with trace_span(args.action, 'action', daemon_socket=args.daemon_socket):
+            is_success = forward_to_daemon(args)
+        startup_times['action'] = time.perf_counter() - action_start
+        report_startup_times(args.timings)
+        if not is_success:
+            logger.info('Exiting script with failures')
+            logger.info('----------------')
+            exit_script(1)
+    elif args.engine == 'async' or len(portals) > 1:
+        import asyncio
+        action_start = time.perf_counter()
+        if args.action == 'daemon':
+            client_start = time.perf_counter()
+            use_portal(portals[0])
+            portal().connect_async()
+            startup_times['client_setup'] = time.perf_counter() - client_start
+            name_cache_ttl = args.cache_ttl
+            is_success = asyncio.run(serve_daemon(args.socket))
+        else:
+            if args.action == 'batch':
+                name_cache_ttl = args.cache_ttl
+            elif args.preflight and args.action in PREFLIGHT_ACTIONS:
+                name_cache_ttl = PREFLIGHT_CACHE_TTL
+            with trace_span(args.action, 'action'):
+                is_success = asyncio.run(run_portals_async(args, portals))
+        startup_times['action'] = time.perf_counter() - action_start
+        report_startup_times(args.timings)
+        if not is_success:
+            logger.info('Exiting script with failures')
+            logger.info('----------------')
+            exit_script(1)
+    else:
+        if args.backend == 'sdk':
+            load_sdk()
+        client_start = time.perf_counter()
+        use_portal(portals[0])
+        portal().connect(args.backend)
+        startup_times['client_setup'] = time.perf_counter() - client_start
+
+        if args.preflight and args.action in PREFLIGHT_ACTIONS:
+            # The names it finds stay in the name cache for the action to reuse
+            name_cache_ttl = PREFLIGHT_CACHE_TTL
+            with trace_span('preflight', 'action'):
+                if not preflight_passed(args):
+                    logger.info('Exiting script with failures')
+                    logger.info('----------------')
+                    exit_script(1)
+
+        action_start = time.perf_counter()
+        with trace_span(args.action, 'action'):
+            run_action(portal_args(args, portal(), False))
+        startup_times['action'] = time.perf_counter() - action_start
+        report_startup_times(args.timings)
 
     logger.info('Exiting script')
     logger.info('----------------')
-    os._exit(0)
+    exit_script(0)
+
+startup_times['imports_done'] = time.perf_counter()
 
 if __name__ == "__main__":
     main()
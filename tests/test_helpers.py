@@ -0,0 +1,162 @@
+"""Helpers that don't talk to a portal."""
+import asyncio
+import itertools
+import json
+import os
+import stat
+from types import SimpleNamespace
+
+import pytest
+
+
+def collector(c_id, instances, size='medium', hosts=0):
+    return SimpleNamespace(id=c_id, number_of_instances=instances, number_of_hosts=hosts, collector_size=size)
+
+
+def worst_failover(lmc, collectors, backups):
+    """Highest utilisation of a backup after any single collector fails."""
+    load = {c.id: c.number_of_instances for c in collectors}
+    capacity = {c.id: lmc.COLLECTOR_SIZE_CAPACITY[c.collector_size] for c in collectors}
+    return max((load[b] + load[f]) / capacity[b] for f, b in backups.items())
+
+
+@pytest.mark.parametrize('collectors', [
+    # One busy small collector among idle large ones
+    [(1, 7000, 'small'), (2, 1000, 'large'), (3, 1200, 'large'), (4, 900, 'medium')],
+    # Two heavy and two light, where the ring pairs the heavy ones together
+    [(1, 14000, 'medium'), (2, 13000, 'medium'), (3, 500, 'medium'), (4, 800, 'medium')],
+    [(1, 500, 'nano'), (2, 60000, 'double_extra_large'), (3, 20000, 'large')],
+])
+def test_balanced_failover_is_optimal(lmc, collectors):
+    collectors = [collector(*c) for c in collectors]
+    ids = [c.id for c in collectors]
+    backups = lmc.balanced_failover_backups(collectors)
+    assert sorted(backups) == ids and sorted(backups.values()) == ids
+    assert all(f != b for f, b in backups.items())
+    best = min(worst_failover(lmc, collectors, dict(zip(ids, perm)))
+               for perm in itertools.permutations(ids) if all(f != b for f, b in zip(ids, perm)))
+    assert worst_failover(lmc, collectors, backups) == pytest.approx(best)
+    assert worst_failover(lmc, collectors, backups) <= worst_failover(lmc, collectors, lmc.ring_failover_backups(ids))
+
+
+def test_balanced_failover_busy_collector_gets_roomiest_backup(lmc):
+    collectors = [collector(1, 7000, 'small'), collector(2, 1000, 'large'), collector(3, 1200, 'large'),
+                  collector(4, 900, 'medium')]
+    assert lmc.balanced_failover_backups(collectors)[1] in (2, 3)
+
+
+def test_balanced_failover_falls_back_on_hosts_and_ring(lmc):
+    by_hosts = [collector(1, 0, hosts=50), collector(2, 0, hosts=1), collector(3, 0, hosts=60)]
+    assert sorted(lmc.balanced_failover_backups(by_hosts).values()) == [1, 2, 3]
+    missing = [collector(1, None), collector(2, 10), collector(3, 20)]
+    assert lmc.balanced_failover_backups(missing) == {}
+    assert lmc.plan_failover_backups(missing) == {1: 2, 2: 3, 3: 1}
+
+
+@pytest.mark.parametrize('existing, add, remove, merged', [
+    ('2,5', [7, 5], [2], '5,7'),
+    ('5,2', [1], [], '5,2,1'),
+    ('', [3, 3], [], '3'),
+    (None, [4], [4], ''),
+    ('1,,8', ['8'], ['9'], '1,8'),
+])
+def test_merge_host_group_ids(lmc, existing, add, remove, merged):
+    assert lmc.merge_host_group_ids(existing, add, remove) == merged
+
+
+def test_diff_collector_states(lmc):
+    old = {
+        1: {'hostname': 'a', 'isDown': False, 'backupAgentId': 2, 'collectorDeviceId': 11, 'build': '34001'},
+        2: {'hostname': 'b', 'isDown': False, 'backupAgentId': 1, 'collectorDeviceId': 12, 'build': '34001'},
+        3: {'hostname': 'c', 'isDown': True, 'backupAgentId': 0, 'collectorDeviceId': 13, 'build': '34001'},
+    }
+    new = {
+        1: dict(old[1], isDown=True, backupAgentId=4, build='34002'),
+        2: dict(old[2], collectorDeviceId=0),
+        4: {'hostname': 'd', 'isDown': False, 'backupAgentId': 1, 'collectorDeviceId': 14, 'build': '34002'},
+    }
+    assert lmc.diff_collector_states(old, old) == []
+    assert lmc.diff_collector_states(old, new) == [
+        {'event': 'removed', 'collector_id': 3, 'hostname': 'c'},
+        {'event': 'down', 'collector_id': 1, 'hostname': 'a'},
+        {'event': 'failover_changed', 'collector_id': 1, 'hostname': 'a', 'old': 2, 'new': 4},
+        {'event': 'build_changed', 'collector_id': 1, 'hostname': 'a', 'old': '34001', 'new': '34002'},
+        {'event': 'device_lost', 'collector_id': 2, 'hostname': 'b', 'old': 12, 'new': 0},
+        {'event': 'added', 'collector_id': 4, 'hostname': 'd', 'is_down': False, 'backup_agent_id': 1},
+    ]
+    replaced = {2: dict(new[2], collectorDeviceId=15)}
+    assert lmc.diff_collector_states({2: new[2]}, replaced)[0]['event'] == 'device_changed'
+
+
+def test_batch_operation_argv(lmc):
+    operation = {'id': 'op-1', 'action': 'echain', 'collector_id': [12, 13], 'ec_name': 'On call',
+                 'interval': 0, 'json': True, 'dry_run': False, 'dg_id': None}
+    assert lmc.batch_operation_argv(operation) == ['echain', '--collector-id', '12', '13', '--ec-name', 'On call',
+                                                   '--interval', '0', '--json']
+    assert lmc.batch_operation_argv({'action': 'rad'}) == ['rad']
+
+
+@pytest.mark.parametrize('collectors, target_util, threshold', [
+    ([], 0.8, 0),
+    # Taken from the smallest member
+    ([(1, 1000, 'small'), (2, 1000, 'large')], 0.8, 6000),
+    # The group is at 28000 of 30000, past the target, so the threshold is its even share
+    ([(1, 14000), (2, 14000)], 0.8, 14000),
+    ([(1, 100, 'huge')], 0.5, 7500),
+    # Without instance counts the group can't be found past the target
+    ([(1, None), (2, 29000)], 0.5, 7500),
+    ([(1, 0, 'nano')], 0.0001, 1),
+])
+def test_ab_threshold_for_group(lmc, collectors, target_util, threshold):
+    assert lmc.ab_threshold_for_group([collector(*c) for c in collectors], target_util) == threshold
+
+
+def step_graph(lmc, journal, check=None, inputs=None):
+    """Run a one-step graph and return (report, number of times the step ran)."""
+    runs = []
+
+    async def func(results):
+        runs.append(1)
+        return {'device_id': 10}
+
+    step = lmc.Step('assoc', (), func, inputs=lambda results: inputs or {'collector_id': 1}, check=check)
+    report = asyncio.run(lmc.run_step_graph([step], journal))
+    return report, len(runs)
+
+
+def test_journal_reuses_finished_step(lmc, tmp_path):
+    path = str(tmp_path / 'journal' / 'bootstrap.json')
+    assert step_graph(lmc, lmc.StepJournal(path))[1] == 1
+    report, runs = step_graph(lmc, lmc.StepJournal(path))
+    assert runs == 0
+    assert report['assoc'][:2] == ('cached', {'device_id': 10})
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_journal_entry_stale_when_inputs_change(lmc, tmp_path):
+    path = str(tmp_path / 'bootstrap.json')
+    step_graph(lmc, lmc.StepJournal(path))
+    report, runs = step_graph(lmc, lmc.StepJournal(path), inputs={'collector_id': 2})
+    assert (report['assoc'][0], runs) == ('ok', 1)
+
+
+def test_journal_without_salt_starts_over(lmc, tmp_path):
+    path = tmp_path / 'bootstrap.json'
+    journal = lmc.StepJournal(str(path))
+    inputs_hash = journal.hash({'collector_id': 1})
+    path.write_text(json.dumps({'steps': {'assoc': {'inputs': inputs_hash, 'result': {'device_id': 10}}}}))
+    assert lmc.StepJournal(str(path)).lookup('assoc', inputs_hash) == (False, None)
+
+
+@pytest.mark.parametrize('outcome, state, runs', [(True, 'cached', 0), (False, 'ok', 1), (OSError('down'), 'ok', 1)])
+def test_journal_check(lmc, tmp_path, outcome, state, runs):
+    path = str(tmp_path / 'bootstrap.json')
+    step_graph(lmc, lmc.StepJournal(path))
+
+    async def check(results, cached):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    report, step_runs = step_graph(lmc, lmc.StepJournal(path), check=check)
+    assert (report['assoc'][0], step_runs) == (state, runs)
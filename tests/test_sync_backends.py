@@ -0,0 +1,97 @@
+"""Actions run with the sync engine against MockPortal, with both the SDK and the raw client."""
+import pytest
+
+
+def run(lmc, *argv):
+    args = lmc.build_parser().parse_args(['--portal', 'mock', *argv])
+    lmc.run_action(args)
+
+
+def test_devname(lmc, mock_portal, sync_portal):
+    # devname doesn't wait for the collector's device, bootstrap only runs it once snmp has
+    lmc.wait_for_collector_assoc(1)
+    run(lmc, 'devname', '--collector-id', '1', '--display-name', 'renamed', '--ip-address', '10.1.2.3')
+    device = mock_portal.resources['devices'][1001]
+    assert (device['displayName'], device['name']) == ('renamed', '10.1.2.3')
+
+
+def test_snmp_collector_id(lmc, mock_portal, sync_portal):
+    run(lmc, 'snmp', '--collector-id', '1', '--snmp-auth-token', 'a', '--snmp-priv-token', 'p')
+    props = {p['name']: p['value'] for p in mock_portal.resources['devices'][1001]['customProperties']}
+    assert props['snmp.security'] == 'lm-snmpv3'
+
+
+def test_echain(lmc, mock_portal, sync_portal):
+    run(lmc, 'echain', '--collector-id', '1', '2', '--ec-name', mock_portal.EC_NAME)
+    assert [mock_portal.resources['collectors'][c_id]['escalatingChainId'] for c_id in (1, 2)] == [1, 1]
+
+
+def test_rad(lmc, mock_portal, sync_portal):
+    run(lmc, 'rad', '--device-id', '1001')
+    assert mock_portal.stats['calls']['POST'] == 1
+    assert not lmc.run_autodiscovery(999)
+
+
+def test_devgrp(lmc, mock_portal, sync_portal):
+    run(lmc, 'devgrp', '--collector-id', '1', '--dg-name', mock_portal.DG_NAME, '--remove-dg-name', 'Unsorted')
+    assert mock_portal.resources['devices'][1001]['hostGroupIds'] == '1'
+
+
+def test_cgab(lmc, mock_portal, sync_portal):
+    run(lmc, 'cgab', '--cg-name', mock_portal.CG_NAME, '--ab-state', 'enable', '--ab-threshold', '500')
+    group = mock_portal.resources['collector_groups'][1]
+    assert (group['autoBalance'], group['autoBalanceInstanceCountThreshold']) == (True, 500)
+
+
+def test_cgfo(lmc, mock_portal, sync_portal):
+    run(lmc, 'cgfo', '--cg-id', '1', '--fo-state', 'enable')
+    backups = {c['id']: c['backupAgentId'] for c in mock_portal.resources['collectors'].values()}
+    assert all(backup and backup != c_id for c_id, backup in backups.items())
+
+
+
+@pytest.fixture
+def exit_code(lmc, monkeypatch):
+    """Make exit_script() raise SystemExit rather than end the test run."""
+    def exit_script(code):
+        raise SystemExit(code)
+    monkeypatch.setattr(lmc, 'exit_script', exit_script)
+
+
+@pytest.mark.parametrize('dg', [['--dg-id', '1'], ['--dg-name', 'Load Test/Collectors']])
+def test_snmp_dg(lmc, mock_portal, sync_portal, dg):
+    argv = ['snmp', *dg, '--collector-id', '1', '--snmp-auth-token', 'a', '--snmp-priv-token', 'p']
+    # MockPortal doesn't do inheritance, so give the collector's device what it would inherit
+    props = lmc.build_snmp_props(lmc.build_parser().parse_args(['--portal', 'mock', *argv]))
+    mock_portal.resources['devices'][1001]['inheritedProperties'] = props
+    run(lmc, *argv)
+    assert mock_portal.resources['device_groups'][1]['customProperties'] == props
+
+
+def test_snmp_dg_not_inherited(lmc, mock_portal, sync_portal, exit_code):
+    with pytest.raises(SystemExit) as exit_info:
+        run(lmc, 'snmp', '--dg-id', '1', '--collector-id', '1', '2', '--snmp-auth-token', 'a', '--snmp-priv-token', 'p')
+    assert exit_info.value.code == 1
+
+
+def test_preflight(lmc, mock_portal, sync_portal, monkeypatch):
+    monkeypatch.setattr(lmc, 'name_cache_ttl', lmc.PREFLIGHT_CACHE_TTL)
+    args = lmc.build_parser().parse_args(['--portal', 'mock', 'echain', '--collector-id', '1', '--ec-name', mock_portal.EC_NAME])
+    assert lmc.preflight_passed(args)
+    gets = mock_portal.stats['calls']['GET']
+    lmc.run_action(args)
+    # The chain comes from the name cache, only the collector is looked up again
+    assert mock_portal.stats['calls']['GET'] == gets + 1
+    assert mock_portal.resources['collectors'][1]['escalatingChainId'] == 1
+
+
+def test_preflight_problems(lmc, mock_portal, sync_portal):
+    args = lmc.build_parser().parse_args(['--portal', 'mock', 'devgrp', '--collector-id', '1', '9',
+                                          '--dg-name', 'Nowhere', '--dg-id', '1'])
+    assert lmc.preflight(args) == ['collector ID 9 was not found or can not be read',
+                                   'device group Nowhere was not found or can not be read']
+
+
+def test_dg_path_slashes(lmc, mock_portal, sync_portal):
+    response = lmc.gdgbn('/' + mock_portal.DG_NAME + '/', 'id,fullPath')
+    assert response.items[0].id == 1